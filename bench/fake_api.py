@@ -0,0 +1,81 @@
+"""
+Имитация Bot API для тестовых стендов и бенчмарков.
+
+FakeSession подставляется в Bot(session=...) и отвечает на запросы без сети,
+возвращая правдоподобные объекты (сообщения, ID сообщений, администраторов).
+"""
+import asyncio
+import itertools
+import time
+
+from aiogram.client.session.base import BaseSession
+from aiogram.methods.base import Response
+
+# ID администратора, которого FakeSession возвращает в getChatAdministrators
+FAKE_ADMIN_ID = 1
+FAKE_ADMIN_CHAT_ID = -1001
+# Конфигурация бота для стендов: фиктивный токен, лимиты отправки, не влияющие на замер, и отключённый анти-спам
+BENCH_OVERRIDES = {
+    'BOT_TOKEN': '123456:FAKE-TOKEN',
+    'ADMIN_CHAT_ID': FAKE_ADMIN_CHAT_ID,
+    'SEND_GLOBAL_RATE': 1e9,
+    'SEND_GLOBAL_BURST': 1e9,
+    'SEND_PRIVATE_CHAT_RATE': 1e9,
+    'SEND_PRIVATE_CHAT_BURST': 1e9,
+    'SEND_GROUP_CHAT_RATE': 1e9,
+    'SEND_GROUP_CHAT_BURST': 1e9,
+    'SPAM_RATE': 0,
+}
+
+
+class FakeSession(BaseSession):
+    """Сессия Bot API без сети с настраиваемой задержкой ответа."""
+
+    def __init__(self, latency: float = 0.0, admin_id: int = FAKE_ADMIN_ID, first_message_id: int = 1):
+        super().__init__()
+        self.latency = latency
+        self.admin_id = admin_id
+        self.calls: dict[str, int] = {}
+        self._message_ids = itertools.count(first_message_id)
+
+    @staticmethod
+    def _chat(chat_id) -> dict:
+        chat_id = int(chat_id)
+        return {'id': chat_id, 'type': 'supergroup' if chat_id < 0 else 'private'}
+
+    def _message(self, chat_id, text: str | None = None) -> dict:
+        message = {'message_id': next(self._message_ids), 'date': int(time.time()), 'chat': self._chat(chat_id)}
+        if text is not None:
+            message['text'] = text
+        return message
+
+    def _result(self, api_method: str, method):
+        if api_method in ('sendMessage', 'forwardMessage'):
+            return self._message(method.chat_id, getattr(method, 'text', None))
+        if api_method == 'copyMessage':
+            return {'message_id': next(self._message_ids)}
+        if api_method in ('forwardMessages', 'copyMessages'):
+            return [{'message_id': next(self._message_ids)} for _ in method.message_ids]
+        if api_method == 'createForumTopic':
+            return {'message_thread_id': next(self._message_ids), 'name': method.name, 'icon_color': 0x6FB9F0}
+        if api_method == 'getChatAdministrators':
+            return [{'status': 'creator', 'is_anonymous': False,
+                     'user': {'id': self.admin_id, 'is_bot': False, 'first_name': 'Admin'}}]
+        if api_method == 'getMe':
+            return {'id': 123456, 'is_bot': True, 'first_name': 'Bot', 'username': 'fake_bot'}
+        return True
+
+    async def make_request(self, bot, method, timeout=None):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        api_method = method.__api_method__
+        self.calls[api_method] = self.calls.get(api_method, 0) + 1
+        response = Response[method.__returning__].model_validate(
+            {'ok': True, 'result': self._result(api_method, method)}, context={'bot': bot})
+        return response.result
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b''
+
+    async def close(self):
+        pass
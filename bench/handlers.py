@@ -0,0 +1,212 @@
+"""
+Бенчмарк обработчиков бота на синтетических данных.
+
+Для каждого набора данных (число пользователей и хранилище) создаёт пользователей
+(1% заблокированы) и сопоставление сообщений за 30 дней, затем в отдельном процессе
+загружает их как при запуске бота и вызывает настоящие обработчики
+(handle_user_message, handle_admin_reply, _send_banlist_page, _send_find_page,
+stats_admin_command) с имитацией Bot API. Выводит задержку обработчика (p50/p99), обновлений в секунду
+и пиковое потребление памяти процесса.
+
+    python bench/handlers.py --users 1000 100000 1000000 --backend json sqlite
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+ADMIN_ID = 1
+# Доля заблокированных пользователей в наборе данных
+BANNED_SHARE = 0.01
+MAPPING_DAYS = 30
+# ID сообщений, которые выдаёт имитация Bot API, не пересекаются с ID из набора данных
+FIRST_FAKE_MESSAGE_ID = 10 ** 9
+
+
+def peak_rss_mb() -> float:
+    """Пиковое потребление памяти текущим процессом, МБ."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def generate(users_count: int, backend: str, mappings_per_day: int):
+    """Записывает набор данных в хранилище (выполняется в отдельном процессе)."""
+    import main
+
+    rng = random.Random(users_count)
+    now = time.time()
+    users = {}
+    for user_id in range(1000, 1000 + users_count):
+        first_launch = int(now - rng.uniform(0, 90 * 86400))
+        user_data = main.UserRecord(
+            first_launch=first_launch,
+            last_message_date=max(first_launch, int(now - rng.uniform(0, 30 * 86400))),
+            total_messages=rng.randint(1, 500),
+            monthly_messages=rng.randint(0, 100),
+            weekly_messages=rng.randint(0, 25),
+            username=f'user{user_id}',
+        )
+        if rng.random() < BANNED_SHARE:
+            user_data.banned_until = int(now + rng.uniform(3600, 30 * 86400))
+            user_data.ban_reason = 'спам'
+        users[str(user_id)] = user_data.to_row()
+
+    mappings_count = mappings_per_day * MAPPING_DAYS
+    started = now - MAPPING_DAYS * 86400 + 60
+    mappings = {
+        str(admin_message_id): {
+            'user_id': str(rng.randrange(1000, 1000 + users_count)),
+            'user_message_id': admin_message_id,
+            'timestamp': started + (admin_message_id - 1) * (MAPPING_DAYS * 86400 - 120) / mappings_count,
+        }
+        for admin_message_id in range(1, mappings_count + 1)
+    }
+
+    storage = main.create_storage(backend)
+    storage.save_users(users, set(users))
+    storage.save_mappings(mappings, mappings, set())
+    storage.close()
+
+
+def make_message(bot, chat_id: int, text: str, from_id: int, reply_to: int | None = None):
+    from aiogram.types import Message
+
+    data = {
+        'message_id': random.randrange(1, FIRST_FAKE_MESSAGE_ID),
+        'date': int(time.time()),
+        'chat': {'id': chat_id, 'type': 'private' if chat_id > 0 else 'supergroup'},
+        'from': {'id': from_id, 'is_bot': False, 'first_name': 'User'},
+        'text': text,
+    }
+    if reply_to is not None:
+        data['reply_to_message'] = {'message_id': reply_to, 'date': 0,
+                                    'chat': {'id': chat_id, 'type': 'supergroup'}}
+    return Message.model_validate(data, context={'bot': bot})
+
+
+async def measure_handler(handler, make_args, iterations: int) -> dict:
+    """Вызывает обработчик iterations раз и возвращает задержку и пропускную способность."""
+    latencies = []
+    started = time.perf_counter()
+    for _ in range(iterations):
+        args = make_args()
+        call_started = time.perf_counter()
+        await handler(*args)
+        latencies.append(time.perf_counter() - call_started)
+    elapsed = time.perf_counter() - started
+    percentiles = statistics.quantiles(latencies, n=100)
+    return {'p50_ms': percentiles[49] * 1000, 'p99_ms': percentiles[98] * 1000, 'updates_per_s': iterations / elapsed}
+
+
+async def measure(backend: str, iterations: int, latency: float, metrics_file: str) -> dict:
+    """Загружает набор данных и замеряет обработчики (выполняется в отдельном процессе)."""
+    import main
+    from aiogram import Bot
+    from bench.fake_api import BENCH_OVERRIDES, FakeSession
+
+    main.__dict__.update(BENCH_OVERRIDES, STORAGE_BACKEND=backend, METRICS_FILE=metrics_file)
+    main.configure_shard(0, 1)
+    admin_chat_id = main.ADMIN_CHAT_ID
+
+    started = time.perf_counter()
+    main.load_state()
+    results = {'load_s': time.perf_counter() - started, 'load_rss_mb': peak_rss_mb(), 'handlers': {}}
+
+    bot = Bot(token=main.BOT_TOKEN, session=FakeSession(latency=latency, admin_id=ADMIN_ID,
+                                                        first_message_id=FIRST_FAKE_MESSAGE_ID))
+    bot.session.middleware(main.RequestMetricsMiddleware())
+    background_tasks = main.start_services()
+    user_ids = [int(user_id) for user_id, _ in main.users_store.items()]
+    mapped_ids = [int(admin_message_id) for admin_message_id in main.message_mapping._entries]
+    total_pages = max(1, (len(main.ban_index) + main.PAGE_SIZE - 1) // main.PAGE_SIZE)
+
+    scenarios = {
+        'handle_user_message': (main.handle_user_message, lambda: (
+            make_message(bot, random.choice(user_ids), 'Сообщение', random.choice(user_ids)), bot)),
+        'handle_admin_reply': (main.handle_admin_reply, lambda: (
+            make_message(bot, admin_chat_id, 'Ответ', ADMIN_ID, random.choice(mapped_ids)), bot)),
+        '_send_banlist_page': (main._send_banlist_page, lambda: (
+            make_message(bot, admin_chat_id, '/banlist', ADMIN_ID), bot, random.randint(1, total_pages))),
+        '_send_find_page': (main._send_find_page, lambda: (
+            make_message(bot, admin_chat_id, '/find', ADMIN_ID), f'user{random.randint(1, 999)}', 1)),
+        'stats_admin_command': (main.stats_admin_command, lambda: (
+            make_message(bot, admin_chat_id, '/stats hours', ADMIN_ID), bot)),
+    }
+    for name, (handler, make_args) in scenarios.items():
+        results['handlers'][name] = await measure_handler(handler, make_args, iterations)
+
+    started = time.perf_counter()
+    await main.stop_services(background_tasks)
+    results['shutdown_s'] = time.perf_counter() - started
+    await bot.session.close()
+    results['peak_rss_mb'] = peak_rss_mb()
+    return results
+
+
+def run_dataset(users_count: int, backend: str, args) -> dict:
+    """Создаёт набор данных и замеряет его в отдельных процессах (память каждого замера независима)."""
+    meta_dir = tempfile.mkdtemp(prefix='handlers-bench-')
+    env = {**os.environ, 'BOT_META_DIR': meta_dir}
+    command = [sys.executable, os.path.abspath(__file__), '--backend', backend,
+               '--iterations', str(args.iterations), '--latency', str(args.latency),
+               '--mappings-per-day', str(args.mappings_per_day), '--users', str(users_count)]
+    if args.metrics_dir:
+        command += ['--metrics-dir', os.path.abspath(args.metrics_dir)]
+    try:
+        subprocess.run(command + ['--phase', 'generate'], env=env, check=True)
+        output = subprocess.run(command + ['--phase', 'measure'], env=env, check=True,
+                                stdout=subprocess.PIPE, text=True).stdout
+        return json.loads(output.splitlines()[-1])
+    finally:
+        shutil.rmtree(meta_dir, ignore_errors=True)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, nargs='+', default=[1000, 100000], help='размеры наборов данных')
+    parser.add_argument('--backend', nargs='+', choices=('json', 'log', 'sqlite'), default=['json', 'sqlite'],
+                        help='хранилища для сравнения')
+    parser.add_argument('--mappings-per-day', type=int, default=10000,
+                        help='записей сопоставления сообщений за день')
+    parser.add_argument('--iterations', type=int, default=2000, help='вызовов каждого обработчика')
+    parser.add_argument('--latency', type=float, default=0.0, help='задержка ответа Bot API, с')
+    parser.add_argument('--metrics-dir', default='',
+                        help='каталог для выгрузки метрик каждого прогона (формат Prometheus)')
+    parser.add_argument('--phase', choices=('generate', 'measure'), help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.phase is not None:
+        import logging
+        logging.disable(logging.INFO)
+        if args.phase == 'generate':
+            generate(args.users[0], args.backend[0], args.mappings_per_day)
+        else:
+            metrics_file = ''
+            if args.metrics_dir:
+                metrics_file = os.path.join(args.metrics_dir, f'metrics-{args.users[0]}-{args.backend[0]}.prom')
+            print(json.dumps(asyncio.run(measure(args.backend[0], args.iterations, args.latency, metrics_file))))
+        sys.exit(0)
+
+    print(f'{"польз.":>8} {"хранилище":>9} {"обработчик":<20} {"p50, мс":>8} {"p99, мс":>8} {"обн./с":>8}')
+    for users_count in args.users:
+        for backend in args.backend:
+            result = run_dataset(users_count, backend, args)
+            for name, stats in result['handlers'].items():
+                print(f'{users_count:>8} {backend:>9} {name:<20} {stats["p50_ms"]:>8.2f} '
+                      f'{stats["p99_ms"]:>8.2f} {stats["updates_per_s"]:>8.0f}')
+            print(f'{users_count:>8} {backend:>9} загрузка {result["load_s"]:.2f} с, '
+                  f'остановка {result["shutdown_s"]:.2f} с, '
+                  f'память после загрузки {result["load_rss_mb"]:.0f} МБ, пик {result["peak_rss_mb"]:.0f} МБ')
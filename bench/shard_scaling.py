@@ -0,0 +1,100 @@
+"""
+Стенд для проверки масштабирования шардированного режима.
+
+Запускает несколько процессов-шардов с имитацией Bot API, подаёт им поток
+сообщений пользователей (как это делает главный процесс) и измеряет
+пропускную способность для каждого числа шардов.
+
+    python bench/shard_scaling.py --users 10000 --messages 50000 --shards 1 2 4
+"""
+import argparse
+import functools
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+# Данные стенда не должны попасть в рабочий каталог meta/
+os.environ.setdefault('BOT_META_DIR', tempfile.mkdtemp(prefix='shard-bench-'))
+
+import main  # noqa: E402
+from bench.fake_api import BENCH_OVERRIDES, FakeSession  # noqa: E402
+
+# Конфигурация процессов-шардов: общее SQLite-хранилище
+OVERRIDES = {**BENCH_OVERRIDES, 'STORAGE_BACKEND': 'sqlite'}
+
+
+def seed_users(count: int) -> list[int]:
+    """Создаёт в общем хранилище count зарегистрированных пользователей."""
+    now = int(time.time())
+    users = {
+        str(user_id): main.UserRecord(first_launch=now, last_message_date=now, username=f'user{user_id}').to_row()
+        for user_id in range(1000, 1000 + count)
+    }
+    storage = main.SqliteStorage(main.SQLITE_DB_FILE)
+    storage.save_users(users, set(users))
+    storage.close()
+    return [int(user_id) for user_id in users]
+
+
+def make_update(update_id: int, user_id: int) -> dict:
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': update_id,
+            'date': int(time.time()),
+            'chat': {'id': user_id, 'type': 'private'},
+            'from': {'id': user_id, 'is_bot': False, 'first_name': 'User'},
+            'text': f'Сообщение {update_id}',
+        },
+    }
+
+
+def run(shard_count: int, user_ids: list[int], messages: int, latency: float) -> float:
+    """Прогоняет messages сообщений через shard_count шардов. Возвращает сообщений в секунду."""
+    context = multiprocessing.get_context('spawn')
+    result_queue = context.Queue()
+    session_factory = functools.partial(FakeSession, latency=latency)
+    queues, processes = main.start_shard_processes(shard_count, result_queue, OVERRIDES, session_factory)
+    for _ in range(shard_count):
+        result_queue.get()  # ('ready', shard_id)
+
+    main.SHARD_COUNT = shard_count
+    started = time.perf_counter()
+    for update_id in range(1, messages + 1):
+        user_id = user_ids[update_id % len(user_ids)]
+        queues[main.shard_for_user(user_id)].put(make_update(update_id, user_id))
+    for queue in queues:
+        queue.put(None)
+    processed = sum(result_queue.get()[2] for _ in range(shard_count))
+    elapsed = time.perf_counter() - started
+
+    for process in processes:
+        process.join()
+    assert processed == messages, f'обработано {processed} из {messages}'
+    return messages / elapsed
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=10000, help='число пользователей')
+    parser.add_argument('--messages', type=int, default=50000, help='число сообщений на прогон')
+    parser.add_argument('--shards', type=int, nargs='+', default=[1, 2, 4], help='числа шардов для сравнения')
+    parser.add_argument('--latency', type=float, default=0.0, help='задержка ответа Bot API, с')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    user_ids = seed_users(args.users)
+    print(f'Каталог данных: {main.META_DIR}')
+    print(f'{"шардов":>7} {"сообщ./с":>10} {"ускорение":>10}')
+    baseline = None
+    for shard_count in args.shards:
+        throughput = run(shard_count, user_ids, args.messages, args.latency)
+        baseline = baseline or throughput
+        print(f'{shard_count:>7} {throughput:>10.0f} {throughput / baseline:>9.2f}x')
@@ -0,0 +1,132 @@
+"""
+Бенчмарк записи и загрузки данных пользователей в разных хранилищах.
+
+Для каждого хранилища в отдельном процессе создаёт набор пользователей, затем
+замеряет фоновый сброс изменений (пачки по --batch изменённых пользователей) —
+время пачки и стоимость одного события, — и время загрузки при запуске.
+Для журнала изменений загрузка читает снимок и хвост журнала из --tail событий.
+
+    python bench/storage_writes.py --users 1000000 --backend json log sqlite
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+
+def make_rows(users_count: int) -> dict:
+    import main
+
+    now = int(time.time())
+    return {
+        str(user_id): main.UserRecord(first_launch=now - user_id % 86400, last_message_date=now,
+                                      total_messages=user_id % 500, username=f'user{user_id}').to_row()
+        for user_id in range(1000, 1000 + users_count)
+    }
+
+
+def measure(backend: str, users_count: int, batch: int, batches: int, tail: int) -> dict:
+    """Создаёт набор данных и замеряет запись и загрузку (выполняется в отдельном процессе)."""
+    import main
+
+    rng = random.Random(users_count)
+    rows = make_rows(users_count)
+    user_ids = list(rows)
+    storage = main.create_storage(backend)
+
+    # Исходные данные: для журнала изменений — сжатый снимок, как после сжатия журнала
+    started = time.perf_counter()
+    if backend == 'log':
+        main.JsonStorage.save_users(storage, rows, set(rows))
+    else:
+        storage.save_users(rows, set(rows))
+    results = {'initial_write_s': time.perf_counter() - started}
+
+    def touch(count: int) -> set:
+        changed = set(rng.sample(user_ids, count))
+        for user_id in changed:
+            row = list(rows[user_id])
+            row[1] += 1
+            rows[user_id] = tuple(row)
+        return changed
+
+    def flush(changed: set):
+        # Как UserStore.flush: полный снимок или только изменённые строки
+        snapshot_ids = rows.keys() if storage.full_snapshot else changed
+        storage.save_users({user_id: rows[user_id] for user_id in snapshot_ids}, changed)
+
+    batch_times = []
+    for _ in range(batches):
+        changed = touch(batch)
+        started = time.perf_counter()
+        flush(changed)
+        batch_times.append(time.perf_counter() - started)
+    results['batch_p50_ms'] = statistics.median(batch_times) * 1000
+    results['event_us'] = sum(batch_times) / (batch * batches) * 1e6
+
+    # Хвост журнала, который придётся применить при следующем запуске (остальные хранилища уже актуальны)
+    remaining = max(0, tail - batch * batches) if backend == 'log' else 0
+    while remaining:
+        count = min(batch, remaining)
+        flush(touch(count))
+        remaining -= count
+    storage.close()
+
+    started = time.perf_counter()
+    loaded = main.create_storage(backend).load_users()
+    results['load_s'] = time.perf_counter() - started
+    assert len(loaded) == users_count
+    assert all(loaded[user_id].total_messages == rows[user_id][1] for user_id in rng.sample(user_ids, 1000))
+    results['disk_mb'] = sum(os.path.getsize(os.path.join(main.META_DIR, name))
+                             for name in os.listdir(main.META_DIR)) / 1024 / 1024
+    return results
+
+
+def run(backend: str, args) -> dict:
+    """Запускает замер хранилища в отдельном процессе с собственным каталогом данных."""
+    meta_dir = tempfile.mkdtemp(prefix='storage-bench-')
+    env = {**os.environ, 'BOT_META_DIR': meta_dir}
+    command = [sys.executable, os.path.abspath(__file__), '--phase', 'measure', '--backend', backend,
+               '--users', str(args.users), '--batch', str(args.batch), '--batches', str(args.batches),
+               '--tail', str(args.tail)]
+    try:
+        output = subprocess.run(command, env=env, check=True, stdout=subprocess.PIPE, text=True).stdout
+        return json.loads(output.splitlines()[-1])
+    finally:
+        shutil.rmtree(meta_dir, ignore_errors=True)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--users', type=int, default=100000, help='число пользователей')
+    parser.add_argument('--backend', nargs='+', choices=('json', 'log', 'sqlite'), default=['json', 'log', 'sqlite'],
+                        help='хранилища для сравнения')
+    parser.add_argument('--batch', type=int, default=100, help='изменённых пользователей в одном сбросе')
+    parser.add_argument('--batches', type=int, default=20, help='число замеряемых сбросов')
+    parser.add_argument('--tail', type=int, default=100000, help='событий в журнале к моменту загрузки')
+    parser.add_argument('--phase', choices=('measure',), help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    if args.phase is not None:
+        import logging
+        logging.disable(logging.INFO)
+        print(json.dumps(measure(args.backend[0], args.users, args.batch, args.batches, args.tail)))
+        sys.exit(0)
+
+    print(f'{"хранилище":>9} {"сброс p50, мс":>14} {"событие, мкс":>13} {"загрузка, с":>12} {"на диске, МБ":>13}')
+    for backend in args.backend:
+        result = run(backend, args)
+        print(f'{backend:>9} {result["batch_p50_ms"]:>14.2f} {result["event_us"]:>13.1f} '
+              f'{result["load_s"]:>12.2f} {result["disk_mb"]:>13.1f}')
@@ -0,0 +1,83 @@
+"""
+Микробенчмарк каталога текстов бота.
+
+Для каждого шаблона из DEFAULT_MESSAGES сравнивает прежний способ — поиск в словаре
+и str.format при каждом вызове — с MessageCatalog.render (шаблоны проверены при загрузке),
+в том числе с выбором языка по language_code. Тексты берутся из messages.json.
+Выводит среднее время одного вызова, а также время загрузки и проверки каталога.
+
+    python bench/templates.py --number 100000 --per-template
+"""
+import argparse
+import json
+import os
+import string
+import sys
+import tempfile
+import timeit
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+# Импорт бота создаёт каталог данных: бенчмарку он не нужен
+os.environ.setdefault('BOT_META_DIR', tempfile.mkdtemp(prefix='templates-bench-'))
+
+
+def sample_values(text: str) -> dict:
+    """Значения для подстановок шаблона: число для полей со спецификацией формата, иначе строка."""
+    values = {}
+    for _, field, spec, _ in string.Formatter().parse(text):
+        if field is not None:
+            values[field] = 12345.678 if spec else '123456789'
+    return values
+
+
+def per_call_ns(func, number: int) -> float:
+    return min(timeit.repeat(func, number=number, repeat=3)) / number * 1e9
+
+
+def measure(number: int) -> list[tuple[str, float, float, float]]:
+    """Возвращает для каждого шаблона время вызова (нс): dict.get + format, render, render с языком."""
+    import main
+
+    with open(main.MESSAGES_FILE, encoding='utf-8') as f:
+        raw_messages = json.load(f)
+    catalog = main.MESSAGES
+    results = []
+    for key, default in main.DEFAULT_MESSAGES.items():
+        values = sample_values(default)
+        baseline = per_call_ns(lambda: raw_messages.get(key, default).format(**values), number)
+        rendered = per_call_ns(lambda: catalog.render(key, **values), number)
+        localized = per_call_ns(lambda: catalog.render(key, 'en-US', **values), number)
+        results.append((key, baseline, rendered, localized))
+    return results
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--number', type=int, default=100000, help='вызовов каждого шаблона в одном замере')
+    parser.add_argument('--per-template', action='store_true', help='вывести время для каждого шаблона')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    import logging
+    logging.disable(logging.INFO)
+    import main
+
+    load_ms = min(timeit.repeat(main.MESSAGES.load, number=10, repeat=3)) / 10 * 1000
+    results = measure(args.number)
+
+    if args.per_template:
+        print(f'{"шаблон":<36} {"format, нс":>11} {"render, нс":>11} {"с языком, нс":>13}')
+        for key, baseline, rendered, localized in results:
+            print(f'{key:<36} {baseline:>11.0f} {rendered:>11.0f} {localized:>13.0f}')
+        print()
+    print(f'шаблонов: {len(results)}, загрузка и проверка каталога: {load_ms:.2f} мс')
+    groups = {'без подстановок': [], 'с подстановками': []}
+    for result in results:
+        groups['с подстановками' if sample_values(main.DEFAULT_MESSAGES[result[0]]) else 'без подстановок'].append(result)
+    for name, group in groups.items():
+        baseline, rendered, localized = (sum(result[column] for result in group) / len(group) for column in (1, 2, 3))
+        print(f'{name} ({len(group)}): dict.get + str.format {baseline:.0f} нс, render {rendered:.0f} нс '
+              f'({baseline / rendered:.2f}x), render с языком {localized:.0f} нс')
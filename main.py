@@ -1,15 +1,41 @@
 import os
+import sys
 import json
+import gzip
+import shutil
+import html
+import hmac
+import re
+import string
+import time
+import dataclasses
+import heapq
+import bisect
+import itertools
+import operator
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from queue import Full as QueueFull
+import sqlite3
+import threading
+import zlib
+import multiprocessing
+import asyncio
+import contextlib
+import contextvars
 import logging
 import datetime
 from datetime import timedelta, timezone
-from aiogram import Bot, Dispatcher, types, F
-from aiogram.enums import ParseMode
+from aiohttp import web
+from aiogram import BaseMiddleware, Bot, Dispatcher, types, F
+from aiogram.enums import ContentType, ParseMode
 from aiogram.filters import Command, CommandStart
 from aiogram.utils.markdown import hbold
-from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, Message
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, Message, ReplyParameters
 from aiogram.client.default import DefaultBotProperties
-from aiogram.exceptions import TelegramAPIError
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramAPIError, TelegramBadRequest, TelegramForbiddenError, TelegramRetryAfter
 
 # --- Конфигурация ---
 # Замените на ваш токен
@@ -17,60 +43,2278 @@ BOT_TOKEN = "токен"
 # Группа администрации, нужно будет выдать админку боту
 ADMIN_CHAT_ID = "айди группы"
 PAGE_SIZE = 10
+# Режим получения обновлений: "polling" (long polling) или "webhook"
+RUN_MODE = "polling"
+# Параметры webhook-сервера. Если WEBHOOK_URL пуст, webhook не регистрируется в Telegram
+# (удобно для локальной проверки: обновления можно отправлять POST-запросами вручную)
+WEBHOOK_HOST = "0.0.0.0"
+WEBHOOK_PORT = 8080
+WEBHOOK_PATH = "/webhook"
+WEBHOOK_URL = ""
+WEBHOOK_SECRET = ""
+# Размер очереди обновлений, число обработчиков и таймауты (в секундах) webhook-сервера
+WEBHOOK_QUEUE_SIZE = 1000
+WEBHOOK_WORKERS = 16
+WEBHOOK_ENQUEUE_TIMEOUT = 5
+WEBHOOK_DRAIN_TIMEOUT = 10
+# Число процессов-шардов. При SHARD_COUNT > 1 главный процесс только принимает обновления
+# и распределяет их по шардам по user_id; требуется STORAGE_BACKEND = "sqlite"
+SHARD_COUNT = 1
+# Номер текущего шарда (устанавливается в процессе-шарде)
+SHARD_ID = 0
+# Размер очереди обновлений каждого шарда
+SHARD_QUEUE_SIZE = 1000
+# Интервал (в секундах) записи сопоставления сообщений в шардированном режиме:
+# главный процесс ищет в нём адресата ответов администраторов
+SHARD_MAPPING_FLUSH_INTERVAL = 0.2
+# Сколько секунд главный процесс ждёт появления записи сопоставления
+SHARD_MAPPING_WAIT = 2
+# Интервал (в секундах) отложенной записи данных пользователей на диск
+USERS_FLUSH_INTERVAL = 5
+# Сколько пользователей копируется в снимок для записи за один шаг цикла событий
+USERS_SNAPSHOT_CHUNK = 20000
+# Хранилище данных: "json" (файлы в meta/), "log" (файлы в meta/ с журналами изменений) или "sqlite" (meta/bot.db)
+STORAGE_BACKEND = "json"
+# Журналы изменений (STORAGE_BACKEND = "log"): размер журнала (в байтах), после которого он
+# сжимается в файл JSON в фоновом потоке, и fsync после каждой пачки записей
+EVENT_LOG_COMPACT_SIZE = 64 * 1024 * 1024
+EVENT_LOG_FSYNC = True
+# Архив неактивных пользователей: через сколько дней без сообщений пользователь переносится
+# из памяти и основного хранилища в сжатые файлы meta/archive/ (0 — не архивировать)
+ARCHIVE_AFTER_DAYS = 90
+ARCHIVE_CHECK_INTERVAL = 3600
+# Число сжатых файлов-корзин архива и максимум пользователей, переносимых за один проход
+ARCHIVE_BUCKETS = 256
+ARCHIVE_BATCH_SIZE = 50000
+# Время жизни (в секундах) кэша списка администраторов
+ADMINS_CACHE_TTL = 300
+# Как часто проверять, изменились ли файлы текстов messages*.json (в секундах, 0 — не перечитывать)
+MESSAGES_RELOAD_INTERVAL = 5
+# Интервал (в секундах) проверки истёкших банов
+BAN_EXPIRY_CHECK_INTERVAL = 30
+# Сколько дней хранить сопоставление пересланных сообщений
+MAPPING_RETENTION_DAYS = 30
+# Интервал (в секундах) удаления устаревших записей сопоставления
+MAPPING_CLEANUP_INTERVAL = 600
+# Сколько последних сообщений пользователя в чате администраторов помнит обратный индекс
+MAPPING_RECENT_PER_USER = 20
+# Интервал (в секундах) сохранения статистики на диск
+STATS_FLUSH_INTERVAL = 60
+# Максимальное число ожидающих операций записи на диск
+DISK_QUEUE_SIZE = 64
+# Интервал (в секундах) и размер буфера (в записях) для сброса лога администраторов
+ADMIN_LOG_FLUSH_INTERVAL = 5
+ADMIN_LOG_BUFFER_SIZE = 100
+# Ротация журнала аудита: по размеру (в байтах) или возрасту (в секундах); архивы сжимаются gzip
+AUDIT_ROTATE_SIZE = 10 * 1024 * 1024
+AUDIT_ROTATE_INTERVAL = 7 * 86400
+AUDIT_ARCHIVE_KEEP = 20
+# Сколько последних записей журнала аудита индекс хранит для каждого пользователя, администратора и действия
+AUDIT_INDEX_PER_KEY = 500
+# Максимальное число одновременно обрабатываемых обновлений (ожидание блокировки пользователя
+# и очереди отправки не считается) и число обновлений, которые шард принимает в обработку
+MAX_CONCURRENT_UPDATES = 100
+MAX_PENDING_UPDATES = 10000
+# Лимиты исходящих запросов Telegram (сообщений в секунду) и допустимые всплески
+SEND_GLOBAL_RATE = 30
+SEND_GLOBAL_BURST = 30
+SEND_PRIVATE_CHAT_RATE = 1
+SEND_PRIVATE_CHAT_BURST = 3
+SEND_GROUP_CHAT_RATE = 20 / 60
+SEND_GROUP_CHAT_BURST = 20
+# Число параллельных отправителей и повторов при ошибке flood control
+SEND_WORKERS = 8
+SEND_MAX_RETRIES = 5
+# Максимум пересылок в очереди отправки: пересылки сверх него отбрасываются с записью в лог
+SEND_QUEUE_LIMIT = 10000
+# Сколько секунд при остановке бота ждать отправки пересылок из очереди
+SEND_DRAIN_TIMEOUT = 10
+
+# Приоритеты исходящих сообщений (меньше — важнее)
+PRIORITY_ADMIN_REPLY = 0
+PRIORITY_FORWARD = 1
+PRIORITY_NOTIFICATION = 2
+PRIORITY_BROADCAST = 3
+# Рассылка: число одновременно отправляемых сообщений и интервал сохранения прогресса (в секундах)
+BROADCAST_CONCURRENCY = 20
+BROADCAST_SAVE_INTERVAL = 5
+
+# Время (в секундах) ожидания остальных элементов альбома перед пересылкой
+MEDIA_GROUP_WINDOW = 1.0
+# Максимальное число элементов в альбоме Telegram
+MEDIA_GROUP_MAX_SIZE = 10
+# Анти-спам: сообщения пользователя сверх SPAM_BURST подряд и SPAM_RATE в секунду
+# не пересылаются (SPAM_RATE = 0 — отключено)
+SPAM_RATE = 1
+SPAM_BURST = 10
+# Автоматический бан: SPAM_BAN_THRESHOLD отброшенных сообщений за SPAM_VIOLATION_WINDOW секунд
+SPAM_BAN_THRESHOLD = 20
+SPAM_VIOLATION_WINDOW = 60
+# Длительность автоматического бана (в секундах); каждый повторный бан длиннее в SPAM_BAN_ESCALATION раз
+SPAM_BAN_DURATION = 3600
+SPAM_BAN_ESCALATION = 4
+SPAM_BAN_MAX_DURATION = 30 * 86400
+# Отдельная тема форума для каждого пользователя (чат администраторов должен быть форумом,
+# а бот — иметь право управлять темами)
+FORUM_TOPICS = False
+# Метрики в формате Prometheus: порт HTTP-эндпоинта /metrics (0 — отключён; шард N слушает порт + N)
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 0
+# Файл, в который метрики периодически выгружаются (пустая строка — не выгружать)
+METRICS_FILE = ""
+METRICS_DUMP_INTERVAL = 60
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
 logger = logging.getLogger(__name__)
 
-# Определение путей
-BOT_DIR = os.path.dirname(os.path.abspath(__file__))
-META_DIR = os.path.join(BOT_DIR, 'meta')
+# Определение путей
+BOT_DIR = os.path.dirname(os.path.abspath(__file__))
+META_DIR = os.environ.get('BOT_META_DIR', os.path.join(BOT_DIR, 'meta'))
+
+# Создание директории meta
+os.makedirs(META_DIR, exist_ok=True)
+
+# Пути к файлам данных
+USERS_DATA_FILE = os.path.join(META_DIR, 'users_data.json')
+MESSAGES_MAPPING_FILE = os.path.join(META_DIR, 'messages_mapping.json')
+REPLY_MAPPING_FILE = os.path.join(META_DIR, 'reply_mapping.json')
+AUDIT_LOG_FILE = os.path.join(META_DIR, 'audit.jsonl')
+# Текстовый журнал действий администраторов прежних версий (импортируется в журнал аудита)
+LEGACY_ADMIN_LOG_FILE = os.path.join(META_DIR, 'admin_log.txt')
+MESSAGES_FILE = os.path.join(BOT_DIR, 'messages.json')
+SQLITE_DB_FILE = os.path.join(META_DIR, 'bot.db')
+STATS_FILE = os.path.join(META_DIR, 'stats.json')
+BROADCAST_FILE = os.path.join(META_DIR, 'broadcast.json')
+ARCHIVE_DIR = os.path.join(META_DIR, 'archive')
+
+
+# --- Утилиты для работы с данными ---
+
+def load_data(file_path: str, strict: bool = False) -> dict:
+    """
+    Загружает данные из JSON-файла. Повреждённый файл не подменяется пустыми данными молча:
+    при strict=True выбрасывается исключение, иначе ошибка записывается в лог.
+    """
+    if not os.path.exists(file_path):
+        return {}
+    try:
+        with open(file_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+    except ValueError as e:
+        if strict:
+            raise RuntimeError(f"Файл данных '{file_path}' повреждён: {e}. "
+                               f"Восстановите его из резервной копии, чтобы не потерять данные") from e
+        logger.error(f"Файл '{file_path}' повреждён ({e}), используются пустые данные")
+        return {}
+
+
+def save_data(file_path: str, data: dict):
+    """Атомарно сохраняет данные в JSON-файл (через временный файл и переименование)."""
+    tmp_path = f"{file_path}.tmp"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, file_path)
+
+
+# --- Хранилища данных ---
+
+# Значение banned_until для бессрочного бана
+PERMANENT_BAN_UNTIL = 2 ** 62
+
+
+def to_epoch(value) -> int | None:
+    """Приводит дату к секундам Unix; строки ISO 8601 (старый формат данных) разбираются."""
+    if value is None or isinstance(value, int):
+        return value
+    if isinstance(value, float):
+        return int(value)
+    if value.lstrip('-').isdigit():
+        return int(value)
+    moment = datetime.datetime.fromisoformat(value)
+    if moment.year == datetime.MAXYEAR:
+        return PERMANENT_BAN_UNTIL
+    return int(moment.timestamp())
+
+
+@dataclasses.dataclass(slots=True)
+class UserRecord:
+    """Запись пользователя. Даты хранятся в секундах Unix, username интернируется."""
+
+    first_launch: int = 0
+    total_messages: int = 0
+    monthly_messages: int = 0
+    weekly_messages: int = 0
+    last_message_date: int = 0
+    username: str | None = None
+    banned_until: int | None = None
+    ban_reason: str | None = None
+    topic_id: int | None = None
+    blocked_at: int | None = None
+
+    def __post_init__(self):
+        if self.username is not None:
+            self.username = sys.intern(self.username)
+
+    @classmethod
+    def from_values(cls, values: dict) -> 'UserRecord':
+        """Создаёт запись из словаря полей (в том числе в старом формате с датами ISO 8601)."""
+        record = cls(**{field: values[field] for field in USER_FIELDS if values.get(field) is not None})
+        for field in USER_TIME_FIELDS:
+            setattr(record, field, to_epoch(getattr(record, field)))
+        return record
+
+    @classmethod
+    def from_row(cls, row) -> 'UserRecord':
+        """Создаёт запись из значений полей в порядке USER_FIELDS."""
+        return cls.from_values(dict(zip(USER_FIELDS, row)))
+
+    def to_row(self) -> tuple:
+        """Возвращает значения полей в порядке USER_FIELDS."""
+        return user_row(self)
+
+
+# Поля записи пользователя (в SQLite — отдельные колонки, в JSON — элементы массива)
+USER_FIELDS = tuple(field.name for field in dataclasses.fields(UserRecord))
+user_row = operator.attrgetter(*USER_FIELDS)
+USER_TIME_FIELDS = ('first_launch', 'last_message_date', 'banned_until', 'blocked_at')
+USER_TEXT_FIELDS = ('username', 'ban_reason')
+# Версия компактного формата users_data.json (старый формат — словарь полей для каждого пользователя)
+USERS_FILE_FORMAT = 2
+
+# Таблицы сопоставления: пересланные сообщения пользователей и ответы администраторов
+MAPPING_TABLES = ('messages', 'replies')
+
+
+class JsonStorage:
+    """Хранилище на JSON-файлах: каждый файл перезаписывается целиком."""
+
+    # Для записи нужен полный снимок данных, а не только изменения
+    full_snapshot = True
+
+    @staticmethod
+    def trim_row(row: tuple) -> tuple:
+        """Отбрасывает пустые хвостовые поля строки пользователя."""
+        end = len(row)
+        while end and row[end - 1] is None:
+            end -= 1
+        return row[:end]
+
+    @staticmethod
+    def parse_users(data: dict) -> dict:
+        """Разбирает содержимое users_data.json (компактный или старый формат)."""
+        if data.get('format') != USERS_FILE_FORMAT:
+            return {user_id: UserRecord.from_values(values) for user_id, values in data.items()}
+        fields = data['fields']
+        return {user_id: UserRecord.from_values(dict(zip(fields, row))) for user_id, row in data['users'].items()}
+
+    def load_users(self) -> dict:
+        return self.parse_users(load_data(USERS_DATA_FILE, strict=True))
+
+    @classmethod
+    def users_file_data(cls, rows: dict) -> dict:
+        """Содержимое users_data.json: массивы значений полей без пустых хвостовых полей."""
+        users = {user_id: cls.trim_row(row) for user_id, row in rows.items()}
+        return {'format': USERS_FILE_FORMAT, 'fields': USER_FIELDS, 'users': users}
+
+    def save_users(self, rows: dict, changed_ids: set):
+        save_data(USERS_DATA_FILE, self.users_file_data(rows))
+
+    mapping_files = {'messages': MESSAGES_MAPPING_FILE, 'replies': REPLY_MAPPING_FILE}
+
+    def load_mappings(self, table: str = 'messages') -> dict:
+        return load_data(self.mapping_files[table], strict=True)
+
+    def save_mappings(self, mappings: dict, added: dict, removed: set, table: str = 'messages'):
+        save_data(self.mapping_files[table], mappings)
+
+    def close(self):
+        pass
+
+
+class SqliteStorage:
+    """
+    Хранилище в SQLite (режим WAL).
+    Пользователи и баны обновляются построчно, сопоставление сообщений
+    читается по первичному ключу, а устаревшие записи удаляются по индексу.
+    """
+
+    full_snapshot = False
+    mapping_tables = {'messages': 'messages_mapping', 'replies': 'reply_mapping'}
+
+    def __init__(self, db_path: str):
+        self.db_path = db_path
+        self._conn = sqlite3.connect(db_path, timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        # Даты в базах, созданных до перехода на секунды Unix, хранятся в колонках TEXT;
+        # UserRecord.from_row приводит их к числам при чтении
+        column_types = {field: 'TEXT' if field in USER_TEXT_FIELDS else 'INTEGER' for field in USER_FIELDS}
+        columns = ', '.join(f"{field} {column_type}" for field, column_type in column_types.items())
+        with self._conn:
+            self._conn.execute(f"CREATE TABLE IF NOT EXISTS users (user_id TEXT PRIMARY KEY, {columns})")
+            # Базы, созданные предыдущими версиями, дополняются новыми полями
+            existing = {row[1] for row in self._conn.execute("PRAGMA table_info(users)")}
+            for field, column_type in column_types.items():
+                if field not in existing:
+                    self._conn.execute(f"ALTER TABLE users ADD COLUMN {field} {column_type}")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_users_banned ON users (banned_until) "
+                               "WHERE banned_until IS NOT NULL")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_users_topic ON users (topic_id) "
+                               "WHERE topic_id IS NOT NULL")
+            # Поиск /find при шардировании: по началу username без учёта регистра и по активности
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_users_username ON users (username COLLATE NOCASE)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_users_activity ON users (last_message_date)")
+            for table_name in self.mapping_tables.values():
+                self._conn.execute(f"CREATE TABLE IF NOT EXISTS {table_name} ("
+                                   "admin_message_id INTEGER PRIMARY KEY, user_id TEXT NOT NULL, "
+                                   "user_message_id INTEGER, timestamp REAL NOT NULL)")
+                self._conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table_name}_timestamp "
+                                   f"ON {table_name} (timestamp)")
+        placeholders = ', '.join('?' for _ in USER_FIELDS)
+        updates = ', '.join(f"{field} = excluded.{field}" for field in USER_FIELDS)
+        self._upsert_user_sql = (f"INSERT INTO users (user_id, {', '.join(USER_FIELDS)}) "
+                                 f"VALUES (?, {placeholders}) ON CONFLICT (user_id) DO UPDATE SET {updates}")
+
+    @staticmethod
+    def _shard_filter() -> tuple[str, tuple]:
+        """Условие выборки записей текущего шарда."""
+        if SHARD_COUNT == 1:
+            return "", ()
+        return " WHERE abs(CAST(user_id AS INTEGER)) % ? = ?", (SHARD_COUNT, SHARD_ID)
+
+    def load_users(self) -> dict:
+        users = {}
+        where, params = self._shard_filter()
+        cursor = self._conn.execute(f"SELECT user_id, {', '.join(USER_FIELDS)} FROM users{where}", params)
+        for row in cursor:
+            users[row[0]] = UserRecord.from_row(row[1:])
+        return users
+
+    def save_users(self, rows: dict, changed_ids: set):
+        """Обновляет изменённых пользователей; изменённые, которых нет в rows, удаляются (перенесены в архив)."""
+        removed = [(user_id,) for user_id in changed_ids if user_id not in rows]
+        rows = [(user_id, *rows[user_id]) for user_id in changed_ids if user_id in rows]
+        with self._conn:
+            self._conn.executemany(self._upsert_user_sql, rows)
+            self._conn.executemany("DELETE FROM users WHERE user_id = ?", removed)
+
+    def load_bans(self) -> dict:
+        """Возвращает заблокированных пользователей всех шардов (по частичному индексу)."""
+        cursor = self._conn.execute("SELECT user_id, banned_until, ban_reason, username FROM users "
+                                    "WHERE banned_until IS NOT NULL")
+        return {
+            user_id: UserRecord.from_values({'banned_until': banned_until, 'ban_reason': ban_reason,
+                                             'username': username})
+            for user_id, banned_until, ban_reason, username in cursor
+        }
+
+    def search_users(self, prefix: str, start: int, count: int) -> tuple[int, dict]:
+        """
+        Поиск пользователей всех шардов по началу username (без префикса — от недавно писавших).
+        Возвращает общее число найденных и срез [start, start + count) с username и датой последнего сообщения.
+        """
+        if prefix:
+            upper_bound = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+            condition = "WHERE username >= ? COLLATE NOCASE AND username < ? COLLATE NOCASE"
+            params, order = (prefix, upper_bound), "username COLLATE NOCASE"
+        else:
+            condition, params, order = "", (), "last_message_date DESC"
+        total = self._conn.execute(f"SELECT COUNT(*) FROM users {condition}", params).fetchone()[0]
+        cursor = self._conn.execute(f"SELECT user_id, username, last_message_date FROM users {condition} "
+                                    f"ORDER BY {order} LIMIT ? OFFSET ?", params + (count, start))
+        return total, {
+            user_id: UserRecord.from_values({'username': username, 'last_message_date': last_message_date})
+            for user_id, username, last_message_date in cursor
+        }
+
+    def find_topic_user(self, thread_id) -> str | None:
+        """Возвращает пользователя темы форума (используется главным процессом при шардировании)."""
+        row = self._conn.execute("SELECT user_id FROM users WHERE topic_id = ?", (int(thread_id),)).fetchone()
+        return row[0] if row else None
+
+    def get_mapping(self, admin_message_id) -> dict | None:
+        """Точечный поиск записи сопоставления (используется главным процессом при шардировании)."""
+        for table_name in self.mapping_tables.values():
+            row = self._conn.execute(
+                f"SELECT user_id, user_message_id, timestamp FROM {table_name} WHERE admin_message_id = ?",
+                (int(admin_message_id),)).fetchone()
+            if row is not None:
+                return {'user_id': row[0], 'user_message_id': row[1], 'timestamp': row[2]}
+        return None
+
+    def load_mappings(self, table: str = 'messages') -> dict:
+        where, params = self._shard_filter()
+        cursor = self._conn.execute("SELECT admin_message_id, user_id, user_message_id, timestamp "
+                                    f"FROM {self.mapping_tables[table]}{where} ORDER BY timestamp", params)
+        return {
+            str(row[0]): {'user_id': row[1], 'user_message_id': row[2], 'timestamp': row[3]}
+            for row in cursor
+        }
+
+    def save_mappings(self, mappings: dict, added: dict, removed: set, table: str = 'messages'):
+        table_name = self.mapping_tables[table]
+        rows = [
+            (int(admin_message_id), str(entry['user_id']), entry.get('user_message_id'), entry.get('timestamp', 0))
+            for admin_message_id, entry in added.items()
+        ]
+        with self._conn:
+            self._conn.executemany(
+                f"INSERT OR REPLACE INTO {table_name} (admin_message_id, user_id, user_message_id, timestamp) "
+                "VALUES (?, ?, ?, ?)", rows)
+            self._conn.executemany(f"DELETE FROM {table_name} WHERE admin_message_id = ?",
+                                   [(int(admin_message_id),) for admin_message_id in removed])
+
+    def close(self):
+        self._conn.close()
+
+
+class EventLogStorage(JsonStorage):
+    """
+    Хранилище на JSON-файлах с журналами изменений: изменения дописываются в журнал
+    (<файл>.log) короткими записями с контрольной суммой, а файл JSON служит снимком
+    и перезаписывается только при сжатии журнала в фоновом потоке.
+    При загрузке к снимку применяются записи журнала; запись, оборванная сбоем, отбрасывается.
+    """
+
+    full_snapshot = False
+
+    def __init__(self):
+        self._logs: dict = {}
+        self._compactions: dict[str, threading.Thread] = {}
+
+    @staticmethod
+    def log_path(snapshot_path: str) -> str:
+        return os.path.splitext(snapshot_path)[0] + '.log'
+
+    @staticmethod
+    def _encode(record: list) -> bytes:
+        payload = json.dumps(record, ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+        return b'%08x ' % zlib.crc32(payload) + payload + b'\n'
+
+    @staticmethod
+    def read_log(path: str) -> list:
+        """Читает записи журнала; повреждённый хвост (недописанную запись) обрезает."""
+        records = []
+        try:
+            f = open(path, 'r+b')
+        except FileNotFoundError:
+            return records
+        with f:
+            valid_size = 0
+            for line in f:
+                checksum, _, payload = line.rstrip(b'\n').partition(b' ')
+                try:
+                    if not line.endswith(b'\n') or int(checksum, 16) != zlib.crc32(payload):
+                        raise ValueError('контрольная сумма не совпадает')
+                    records.append(json.loads(payload))
+                except ValueError:
+                    logger.warning(f"Журнал '{path}' повреждён после байта {valid_size}, остаток отброшен")
+                    f.truncate(valid_size)
+                    break
+                valid_size += len(line)
+        return records
+
+    def _log_records(self, snapshot_path: str) -> list:
+        """Записи журнала, ещё не сжатые в снимок (включая журнал, сжатие которого прервалось)."""
+        log_path = self.log_path(snapshot_path)
+        return self.read_log(log_path + '.1') + self.read_log(log_path)
+
+    @staticmethod
+    def _apply_mapping(mappings: dict, record: list):
+        if len(record) == 1:
+            mappings.pop(record[0], None)
+        else:
+            admin_message_id, user_id, user_message_id, timestamp = record
+            mappings[admin_message_id] = {'user_id': user_id, 'user_message_id': user_message_id,
+                                          'timestamp': timestamp}
+
+    @staticmethod
+    def _apply_user(users: dict, record: list):
+        user_id, row = record
+        if row is None:
+            users.pop(user_id, None)
+        else:
+            users[user_id] = UserRecord.from_row(row)
+
+    def load_users(self) -> dict:
+        users = super().load_users()
+        for record in self._log_records(USERS_DATA_FILE):
+            self._apply_user(users, record)
+        return users
+
+    def save_users(self, rows: dict, changed_ids: set):
+        """Дописывает изменённых пользователей в журнал: [user_id, строка полей] или [user_id, null] для удаления."""
+        records = [[user_id, None] for user_id in changed_ids if user_id not in rows]
+        records += [[user_id, self.trim_row(row)] for user_id, row in rows.items()]
+        self._append(USERS_DATA_FILE, records, self._compact_users)
+
+    def load_mappings(self, table: str = 'messages') -> dict:
+        mappings = super().load_mappings(table)
+        for record in self._log_records(self.mapping_files[table]):
+            self._apply_mapping(mappings, record)
+        return mappings
+
+    def save_mappings(self, mappings: dict, added: dict, removed: set, table: str = 'messages'):
+        """Дописывает изменения в журнал: [ID, user_id, ID сообщения пользователя, время] или [ID] для удаления."""
+        records = [[admin_message_id] for admin_message_id in removed]
+        records += [[admin_message_id, entry['user_id'], entry.get('user_message_id'), entry.get('timestamp')]
+                    for admin_message_id, entry in added.items()]
+        self._append(self.mapping_files[table], records, self._compact_mappings)
+
+    def _append(self, snapshot_path: str, records: list, compact):
+        if not records:
+            return
+        log_path = self.log_path(snapshot_path)
+        f = self._logs.get(log_path)
+        if f is None:
+            f = self._logs[log_path] = open(log_path, 'ab')
+        start = f.tell()
+        try:
+            f.write(b''.join(map(self._encode, records)))
+            f.flush()
+            if EVENT_LOG_FSYNC:
+                os.fsync(f.fileno())
+        except OSError:
+            # Не оставляем в журнале недописанную пачку: следующие записи должны читаться
+            f.truncate(start)
+            raise
+        if f.tell() >= EVENT_LOG_COMPACT_SIZE:
+            self._start_compaction(snapshot_path, compact)
+
+    def _start_compaction(self, snapshot_path: str, compact):
+        """Переименовывает журнал в <журнал>.1 и сжимает его в снимок в фоновом потоке."""
+        log_path = self.log_path(snapshot_path)
+        running = self._compactions.get(log_path)
+        if running is not None and running.is_alive():
+            return
+        rotated = log_path + '.1'
+        # Если прошлое сжатие прервалось, сначала доводим до конца его
+        if not os.path.exists(rotated):
+            self._logs.pop(log_path).close()
+            os.replace(log_path, rotated)
+        thread = threading.Thread(target=self._compact, args=(snapshot_path, rotated, compact),
+                                  name='event-log-compaction')
+        self._compactions[log_path] = thread
+        thread.start()
+
+    def _compact(self, snapshot_path: str, rotated: str, compact):
+        try:
+            compact(snapshot_path, self.read_log(rotated))
+            # Если сбой произойдёт до удаления, записи повторно применятся к новому снимку с тем же результатом
+            os.remove(rotated)
+        except (OSError, RuntimeError) as e:
+            logger.error(f"Не удалось сжать журнал '{rotated}': {e}")
+
+    def _compact_users(self, snapshot_path: str, records: list):
+        users = self.parse_users(load_data(snapshot_path, strict=True))
+        for record in records:
+            self._apply_user(users, record)
+        save_data(snapshot_path, self.users_file_data({user_id: user_data.to_row()
+                                                       for user_id, user_data in users.items()}))
+
+    def _compact_mappings(self, snapshot_path: str, records: list):
+        mappings = load_data(snapshot_path, strict=True)
+        for record in records:
+            self._apply_mapping(mappings, record)
+        save_data(snapshot_path, mappings)
+
+    def close(self):
+        for thread in self._compactions.values():
+            thread.join()
+        for f in self._logs.values():
+            f.close()
+        self._logs.clear()
+
+
+def create_storage(backend: str | None = None):
+    """Создаёт хранилище указанного типа (по умолчанию — STORAGE_BACKEND)."""
+    backend = backend or STORAGE_BACKEND
+    if backend == "sqlite":
+        return SqliteStorage(SQLITE_DB_FILE)
+    if backend == "json":
+        return JsonStorage()
+    if backend == "log":
+        return EventLogStorage()
+    raise ValueError(f"Неизвестный тип хранилища: {backend}")
+
+
+def migrate_json_to_sqlite():
+    """Однократно переносит данные из JSON-файлов meta/ (с журналами изменений, если они есть) в SQLite."""
+    source = EventLogStorage()
+    target = SqliteStorage(SQLITE_DB_FILE)
+    try:
+        users = source.load_users()
+        target.save_users({user_id: record.to_row() for user_id, record in users.items()}, set(users))
+        migrated = 0
+        for table in MAPPING_TABLES:
+            mappings = {
+                admin_message_id: entry
+                for admin_message_id, entry in source.load_mappings(table).items()
+                if 'user_id' in entry
+            }
+            target.save_mappings(mappings, mappings, set(), table)
+            migrated += len(mappings)
+        logger.info(f"Миграция завершена: пользователей {len(users)}, сообщений {migrated}")
+    finally:
+        target.close()
+
+
+storage = create_storage()
+
+
+# Границы корзин гистограмм длительности, в секундах
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами (накопительные значения считаются при выводе)."""
+
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self):
+        self.counts = [0] * len(LATENCY_BUCKETS)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        index = bisect.bisect_left(LATENCY_BUCKETS, value)
+        if index < len(self.counts):
+            self.counts[index] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    """
+    Реестр метрик в текстовом формате Prometheus: счётчики, гистограммы
+    длительности и показатели (gauges), значения которых вычисляются при выводе.
+    """
+
+    def __init__(self):
+        self._help: dict[str, tuple[str, str]] = {}
+        self._counters: dict[str, dict[tuple, float]] = {}
+        self._histograms: dict[str, dict[tuple, Histogram]] = {}
+        self._gauges: dict[str, dict[tuple, object]] = {}
+
+    def describe(self, name: str, metric_type: str, help_text: str):
+        self._help[name] = (metric_type, help_text)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        series = self._counters.setdefault(name, {})
+        key = tuple(labels.items())
+        series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        series = self._histograms.setdefault(name, {})
+        key = tuple(labels.items())
+        histogram = series.get(key)
+        if histogram is None:
+            histogram = series[key] = Histogram()
+        histogram.observe(value)
+
+    def gauge(self, name: str, func, **labels):
+        """Регистрирует показатель: func() вызывается при каждом выводе метрик."""
+        self._gauges.setdefault(name, {})[tuple(labels.items())] = func
+
+    @contextlib.contextmanager
+    def timer(self, name: str, **labels):
+        """Замеряет длительность блока (<name>_seconds) и считает ошибки (<name>_errors_total)."""
+        started = time.perf_counter()
+        try:
+            yield
+        except BaseException as e:
+            if not isinstance(e, asyncio.CancelledError):
+                self.inc(f'{name}_errors_total', error=type(e).__name__, **labels)
+            raise
+        finally:
+            self.observe(f'{name}_seconds', time.perf_counter() - started, **labels)
+
+    @staticmethod
+    def _labels(key: tuple, extra: tuple = ()) -> str:
+        pairs = key + extra
+        if not pairs:
+            return ''
+        return '{' + ','.join(f'{label}="{value}"' for label, value in pairs) + '}'
+
+    def _header(self, name: str, default_type: str) -> list[str]:
+        metric_type, help_text = self._help.get(name, (default_type, ''))
+        lines = [f'# HELP {name} {help_text}'] if help_text else []
+        lines.append(f'# TYPE {name} {metric_type}')
+        return lines
+
+    def render(self) -> str:
+        """Возвращает все метрики в текстовом формате Prometheus."""
+        lines = []
+        # Хранилище обновляет метрики из потока записи, поэтому словари копируются перед обходом
+        for name, series in sorted(self._counters.items()):
+            lines += self._header(name, 'counter')
+            lines += [f'{name}{self._labels(key)} {value:g}' for key, value in list(series.items())]
+        for name, series in sorted(self._histograms.items()):
+            lines += self._header(name, 'histogram')
+            for key, histogram in list(series.items()):
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS, histogram.counts):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{self._labels(key, (("le", f"{bound:g}"),))} {cumulative}')
+                lines.append(f'{name}_bucket{self._labels(key, (("le", "+Inf"),))} {histogram.count}')
+                lines.append(f'{name}_sum{self._labels(key)} {histogram.sum:.6f}')
+                lines.append(f'{name}_count{self._labels(key)} {histogram.count}')
+        for name, series in sorted(self._gauges.items()):
+            lines += self._header(name, 'gauge')
+            for key, func in list(series.items()):
+                try:
+                    lines.append(f'{name}{self._labels(key)} {func():g}')
+                except Exception as e:
+                    logger.debug(f"Не удалось вычислить метрику {name}: {e}")
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+metrics.describe('bot_handler_seconds', 'histogram', 'Длительность обработчиков обновлений')
+metrics.describe('bot_handler_errors_total', 'counter', 'Ошибки в обработчиках обновлений')
+metrics.describe('bot_api_request_seconds', 'histogram', 'Длительность запросов к Bot API')
+metrics.describe('bot_api_request_errors_total', 'counter', 'Ошибки запросов к Bot API')
+metrics.describe('bot_storage_seconds', 'histogram', 'Длительность операций с хранилищем')
+metrics.describe('bot_storage_errors_total', 'counter', 'Ошибки операций с хранилищем')
+metrics.describe('bot_spam_dropped_total', 'counter', 'Сообщения пользователей, отброшенные анти-спамом')
+metrics.describe('bot_spam_bans_total', 'counter', 'Автоматические баны за спам')
+metrics.describe('bot_users_archived_total', 'counter', 'Пользователи, перенесённые в архив')
+metrics.describe('bot_send_queue_overflow_total', 'counter', 'Пересылки, отброшенные из-за переполнения очереди отправки')
+metrics.describe('bot_users_rehydrated_total', 'counter', 'Пользователи, возвращённые из архива')
+
+
+def _timed_storage_call(func, *args):
+    with metrics.timer('bot_storage', operation=func.__qualname__):
+        return func(*args)
+
+
+class DiskWriter:
+    """
+    Выполняет операции с диском в отдельном потоке, не блокируя цикл событий.
+    Операции выполняются строго по очереди; если ожидающих операций слишком много,
+    новые вызовы ждут освобождения места в очереди.
+    """
+
+    def __init__(self, max_pending: int = DISK_QUEUE_SIZE):
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='disk-writer')
+        self._slots = asyncio.Semaphore(max_pending)
+        self.pending = 0
+
+    async def run(self, func, *args):
+        """Выполняет func(*args) в потоке записи и возвращает результат."""
+        async with self._slots:
+            self.pending += 1
+            try:
+                return await asyncio.get_running_loop().run_in_executor(self._executor, _timed_storage_call,
+                                                                        func, *args)
+            finally:
+                self.pending -= 1
+
+    def shutdown(self):
+        """Дожидается завершения всех операций и останавливает поток."""
+        self._executor.shutdown(wait=True)
+
+
+disk_writer = DiskWriter()
+
+
+class WriteBehindStore:
+    """Базовый класс для данных в памяти, которые пакетно сбрасываются в хранилище в фоне."""
+
+    def __init__(self, backend, flush_interval: float):
+        self.backend = backend
+        self.flush_interval = flush_interval
+        self._flush_task: asyncio.Task | None = None
+
+    async def flush(self):
+        raise NotImplementedError
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def start(self):
+        """Запускает фоновую запись на диск."""
+        if self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        """Останавливает фоновую запись и сбрасывает несохранённые изменения."""
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            try:
+                await self._flush_task
+            except asyncio.CancelledError:
+                pass
+            self._flush_task = None
+        await self.flush()
+
+
+class UserStore(WriteBehindStore):
+    """
+    Хранилище пользователей в памяти.
+    Данные читаются один раз при запуске, изменения сбрасываются на диск
+    пакетно в фоне (write-behind) и при остановке бота.
+    """
+
+    def __init__(self, backend, flush_interval: float = USERS_FLUSH_INTERVAL):
+        super().__init__(backend, flush_interval)
+        self._users: dict[str, UserRecord] = {}
+        self._dirty: set = set()
+        # Пользователи из сброса, который ещё не дописан на диск
+        self._flushing: set = set()
+
+    def load(self):
+        """Загружает пользователей из хранилища."""
+        with metrics.timer('bot_storage', operation='load_users'):
+            self._users = self.backend.load_users()
+        self._dirty = set()
+        logger.info(f"Загружено пользователей: {len(self._users)}")
+
+    def get(self, user_id) -> UserRecord | None:
+        return self._users.get(str(user_id))
+
+    def __contains__(self, user_id) -> bool:
+        return str(user_id) in self._users
+
+    def __len__(self) -> int:
+        return len(self._users)
+
+    def items(self):
+        return self._users.items()
+
+    def values(self):
+        return self._users.values()
+
+    def add(self, user_id, user_data: UserRecord):
+        """Добавляет нового пользователя."""
+        self._users[str(user_id)] = user_data
+        self._dirty.add(str(user_id))
+
+    def mark_dirty(self, user_id):
+        """Помечает пользователя как изменённого (будет записан при следующем сбросе)."""
+        self._dirty.add(str(user_id))
+
+    def remove(self, user_id):
+        """Удаляет пользователя из памяти, а при следующем сбросе — из хранилища."""
+        self._users.pop(str(user_id), None)
+        self._dirty.add(str(user_id))
+
+    def persisted_ids(self) -> set:
+        """ID пользователей, чьи текущие данные уже записаны в хранилище."""
+        return self._users.keys() - self._dirty - self._flushing
+
+    async def flush(self):
+        """Записывает изменённых пользователей в хранилище."""
+        if not self._dirty:
+            return
+        changed_ids, self._dirty = self._dirty, set()
+        self._flushing |= changed_ids
+        try:
+            snapshot = await self._snapshot(changed_ids)
+            await disk_writer.run(self.backend.save_users, snapshot, changed_ids)
+        except (OSError, sqlite3.Error) as e:
+            self._dirty |= changed_ids
+            logger.error(f"Не удалось сохранить данные пользователей: {e}")
+        except asyncio.CancelledError:
+            self._dirty |= changed_ids
+            raise
+        finally:
+            self._flushing -= changed_ids
+
+    async def _snapshot(self, changed_ids: set) -> dict:
+        """
+        Копирует значения полей пользователей для записи: все записи, если хранилищу нужен
+        полный снимок, иначе только изменённые. Копирование идёт частями по USERS_SNAPSHOT_CHUNK,
+        между которыми цикл событий обрабатывает другие обновления; пользователи, изменённые
+        за это время, уже снова помечены и попадут в следующий сброс.
+        """
+        user_ids = list(self._users) if self.backend.full_snapshot else list(changed_ids)
+        snapshot = {}
+        for start in range(0, len(user_ids), USERS_SNAPSHOT_CHUNK):
+            if start:
+                await asyncio.sleep(0)
+            for user_id in user_ids[start:start + USERS_SNAPSHOT_CHUNK]:
+                user_data = self._users.get(user_id)
+                if user_data is not None:
+                    snapshot[user_id] = user_row(user_data)
+        return snapshot
+
+
+class UserArchive:
+    """
+    Архив неактивных пользователей (холодное хранилище).
+    Записи лежат в сжатых gzip файлах-корзинах (корзина выбирается по ID пользователя),
+    а в памяти остаётся только компактный индекс: отсортированные ID, время последней
+    активности и признак того, что пользователь заблокировал бота (для отбора получателей рассылки).
+    Запись архива действительна, пока пользователя нет среди активных: копия вернувшегося
+    пользователя удаляется из корзины при следующей её перезаписи.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.index_path = os.path.join(directory, 'index.bin')
+        self._ids = array('q')
+        self._active = array('q')
+        self._blocked = bytearray()
+        # Пользователи, вернувшиеся из архива или заблокировавшие бота, пока записывалась новая пачка
+        self._returned: list[int] | None = None
+        self._marked_blocked: list[int] | None = None
+        # В индексе есть отметки о блокировке бота, ещё не записанные на диск
+        self._index_changed = False
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __contains__(self, user_id) -> bool:
+        return self._position(user_id) is not None
+
+    def _position(self, user_id) -> int | None:
+        try:
+            user_id = int(user_id)
+        except ValueError:
+            return None
+        position = bisect.bisect_left(self._ids, user_id)
+        if position < len(self._ids) and self._ids[position] == user_id:
+            return position
+        return None
+
+    @staticmethod
+    def bucket(user_id) -> int:
+        # У всех пользователей шарда одинаковый остаток от деления на SHARD_COUNT, поэтому он отбрасывается
+        return abs(int(user_id)) // SHARD_COUNT % ARCHIVE_BUCKETS
+
+    def bucket_path(self, bucket: int) -> str:
+        return os.path.join(self.directory, f'bucket-{bucket:04d}.json.gz')
+
+    def read_bucket(self, bucket: int) -> dict:
+        """Читает корзину: {user_id: UserRecord}."""
+        path = self.bucket_path(bucket)
+        try:
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                return JsonStorage.parse_users(json.load(f))
+        except FileNotFoundError:
+            return {}
+        except (OSError, EOFError, ValueError) as e:
+            raise RuntimeError(f"Файл архива '{path}' повреждён: {e}") from e
+
+    def _write_bucket(self, bucket: int, users: dict):
+        path = self.bucket_path(bucket)
+        if not users:
+            with contextlib.suppress(FileNotFoundError):
+                os.remove(path)
+            return
+        data = JsonStorage.users_file_data({user_id: user_data.to_row() for user_id, user_data in users.items()})
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            with gzip.GzipFile(fileobj=f, mode='wb') as target:
+                target.write(json.dumps(data, ensure_ascii=False, separators=(',', ':')).encode('utf-8'))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def _write_index(self, ids: array, active: array, blocked: bytearray):
+        tmp_path = f"{self.index_path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            array('q', [len(ids)]).tofile(f)
+            ids.tofile(f)
+            active.tofile(f)
+            f.write(blocked)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, self.index_path)
+
+    def _read_index(self) -> tuple[array, array, bytearray]:
+        ids, active, count = array('q'), array('q'), array('q')
+        with open(self.index_path, 'rb') as f:
+            count.fromfile(f, 1)
+            ids.fromfile(f, count[0])
+            active.fromfile(f, count[0])
+            blocked = bytearray(f.read())
+        if len(blocked) != count[0]:
+            raise EOFError('индекс обрезан')
+        return ids, active, blocked
+
+    @staticmethod
+    def _entry(user_data: UserRecord) -> tuple[int, bool]:
+        return max(user_data.last_message_date, user_data.first_launch), user_data.blocked_at is not None
+
+    def _index_from_buckets(self) -> tuple[array, array, bytearray]:
+        entries = {}
+        for bucket in range(ARCHIVE_BUCKETS):
+            for user_id, user_data in self.read_bucket(bucket).items():
+                entries[int(user_id)] = self._entry(user_data)
+        return self._build_index(entries)
+
+    @staticmethod
+    def _build_index(entries: dict) -> tuple[array, array, bytearray]:
+        ids = array('q', sorted(entries))
+        return (ids, array('q', (entries[user_id][0] for user_id in ids)),
+                bytearray(entries[user_id][1] for user_id in ids))
+
+    def load(self, active_users):
+        """Загружает индекс архива, пропуская пользователей, которые уже есть среди активных (active_users)."""
+        os.makedirs(self.directory, exist_ok=True)
+        try:
+            ids, active, blocked = self._read_index()
+        except FileNotFoundError:
+            ids, active, blocked = self._index_from_buckets()
+        except (OSError, EOFError) as e:
+            logger.warning(f"Индекс архива повреждён ({e}), он будет построен заново по корзинам")
+            ids, active, blocked = self._index_from_buckets()
+        keep = [str(user_id) not in active_users for user_id in ids]
+        if not all(keep):
+            ids = array('q', itertools.compress(ids, keep))
+            active = array('q', itertools.compress(active, keep))
+            blocked = bytearray(itertools.compress(blocked, keep))
+        self._ids, self._active, self._blocked = ids, active, blocked
+        logger.info(f"Пользователей в архиве: {len(ids)}")
+
+    def load_user(self, user_id) -> UserRecord | None:
+        """Читает запись пользователя из корзины (выполняется в потоке записи)."""
+        return self.read_bucket(self.bucket(user_id)).get(str(user_id))
+
+    def entries(self):
+        """Возвращает тройки (user_id, время последней активности, заблокировал ли бота) по возрастанию ID."""
+        return zip(self._ids, self._active, self._blocked)
+
+    def _write(self, users: dict, persisted: set, index: tuple) -> tuple:
+        """
+        Записывает пользователей в корзины и индекс (выполняется в потоке записи).
+        Из перезаписываемых корзин удаляются копии пользователей, уже сохранённых среди активных.
+        """
+        by_bucket: dict[int, dict] = {}
+        for user_id, row in users.items():
+            by_bucket.setdefault(self.bucket(user_id), {})[user_id] = UserRecord.from_row(row)
+        entries = dict(zip(index[0], zip(index[1], index[2])))
+        for bucket, bucket_users in by_bucket.items():
+            stored = self.read_bucket(bucket)
+            for user_id in stored.keys() & persisted:
+                del stored[user_id]
+                entries.pop(int(user_id), None)
+            stored.update(bucket_users)
+            self._write_bucket(bucket, stored)
+            for user_id, user_data in bucket_users.items():
+                entries[int(user_id)] = self._entry(user_data)
+        index = self._build_index(entries)
+        self._write_index(*index)
+        return index
+
+    async def add(self, users: dict, persisted: set):
+        """Записывает пользователей {user_id: строка полей} в архив; возвращается после записи на диск."""
+        self._returned, self._marked_blocked = [], []
+        try:
+            self._ids, self._active, self._blocked = await disk_writer.run(
+                self._write, users, persisted, (array('q', self._ids), array('q', self._active), bytes(self._blocked)))
+            for user_id in self._returned:
+                self.discard(user_id)
+            marked_blocked, self._marked_blocked = self._marked_blocked, None
+            for user_id in marked_blocked:
+                self.mark_blocked(user_id)
+        finally:
+            self._returned = self._marked_blocked = None
+
+    def discard(self, user_id):
+        """Убирает из индекса пользователя, вернувшегося из архива."""
+        position = self._position(user_id)
+        if position is not None:
+            del self._ids[position]
+            del self._active[position]
+            del self._blocked[position]
+        if self._returned is not None:
+            self._returned.append(int(user_id))
+
+    def is_blocked(self, user_id) -> bool:
+        position = self._position(user_id)
+        return position is not None and bool(self._blocked[position])
+
+    def mark_blocked(self, user_id):
+        """Отмечает в индексе, что пользователь из архива заблокировал бота (на диск — в save_index)."""
+        position = self._position(user_id)
+        if position is not None and not self._blocked[position]:
+            self._blocked[position] = 1
+            self._index_changed = True
+        if self._marked_blocked is not None:
+            self._marked_blocked.append(int(user_id))
+
+    async def save_index(self):
+        """Записывает индекс с новыми отметками о блокировке бота."""
+        # Пока записывается пачка, индекс в памяти устарел: отметки попадут на диск при следующем вызове
+        if not self._index_changed or self._returned is not None:
+            return
+        self._index_changed = False
+        try:
+            await disk_writer.run(self._write_index, array('q', self._ids), array('q', self._active),
+                                  bytes(self._blocked))
+        except OSError as e:
+            self._index_changed = True
+            logger.error(f"Не удалось записать индекс архива: {e}")
+
+
+class MessageMapping(WriteBehindStore):
+    """
+    Сопоставление сообщений в чате администраторов с сообщениями пользователей.
+    Записи хранятся в порядке добавления, поэтому устаревшие удаляются
+    со старого конца за амортизированное O(1) на запись. Обратные индексы
+    (пользователь -> последние сообщения, сообщение пользователя -> сообщение
+    администраторов) позволяют искать в обе стороны без обращения к диску.
+    """
+
+    def __init__(self, backend, table: str = 'messages', retention_days: float = MAPPING_RETENTION_DAYS,
+                 flush_interval: float = USERS_FLUSH_INTERVAL):
+        super().__init__(backend, flush_interval)
+        self.table = table
+        self.retention = timedelta(days=retention_days)
+        self._entries: OrderedDict[str, dict] = OrderedDict()
+        self._by_user: dict[str, deque] = {}
+        self._by_user_message: dict[tuple[str, int], str] = {}
+        self._added: dict = {}
+        self._removed: set = set()
+
+    def load(self):
+        """Загружает сопоставление из хранилища, упорядочивая записи по времени."""
+        with metrics.timer('bot_storage', operation='load_mappings'):
+            entries = self.backend.load_mappings(self.table)
+        self._entries = OrderedDict(sorted(entries.items(), key=lambda item: item[1].get('timestamp', 0)))
+        self._by_user = {}
+        self._by_user_message = {}
+        for key, entry in self._entries.items():
+            self._index(key, entry)
+        self._added = {}
+        self._removed = set()
+
+    def _index(self, key: str, entry: dict):
+        user_id = entry['user_id']
+        recent = self._by_user.get(user_id)
+        if recent is None:
+            recent = self._by_user[user_id] = deque(maxlen=MAPPING_RECENT_PER_USER)
+        recent.append(key)
+        if entry.get('user_message_id') is not None:
+            self._by_user_message[(user_id, entry['user_message_id'])] = key
+
+    def _unindex(self, key: str, entry: dict):
+        user_id = entry['user_id']
+        recent = self._by_user.get(user_id)
+        if recent is not None:
+            # Записи удаляются от старых к новым, поэтому ключ обычно первый в очереди
+            if recent and recent[0] == key:
+                recent.popleft()
+            elif key in recent:
+                recent.remove(key)
+            if not recent:
+                del self._by_user[user_id]
+        user_message = (user_id, entry.get('user_message_id'))
+        if self._by_user_message.get(user_message) == key:
+            del self._by_user_message[user_message]
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, admin_message_id) -> dict | None:
+        return self._entries.get(str(admin_message_id))
+
+    def find_admin_message(self, user_id, user_message_id) -> str | None:
+        """Возвращает ID сообщения в чате администраторов по сообщению в чате пользователя."""
+        return self._by_user_message.get((str(user_id), user_message_id))
+
+    def recent_admin_messages(self, user_id) -> list[str]:
+        """Возвращает ID последних сообщений пользователя в чате администраторов (от старых к новым)."""
+        return list(self._by_user.get(str(user_id), ()))
+
+    def add(self, admin_message_id, user_id, user_message_id, timestamp: float):
+        """Добавляет запись о сообщении."""
+        key = str(admin_message_id)
+        old_entry = self._entries.get(key)
+        if old_entry is not None:
+            self._unindex(key, old_entry)
+        entry = {'user_id': str(user_id), 'user_message_id': user_message_id, 'timestamp': timestamp}
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        self._index(key, entry)
+        self._added[key] = entry
+        self._removed.discard(key)
+
+    def add_many(self, pairs, user_id, timestamp: float):
+        """Добавляет записи для пар (ID в чате администраторов, ID сообщения пользователя)."""
+        for admin_message_id, user_message_id in pairs:
+            self.add(admin_message_id, user_id, user_message_id, timestamp)
+
+    def evict_expired(self, now: datetime.datetime | None = None) -> int:
+        """Удаляет записи старше срока хранения. Возвращает количество удалённых."""
+        cutoff = ((now or datetime.datetime.now()) - self.retention).timestamp()
+        evicted = 0
+        while self._entries:
+            key, entry = next(iter(self._entries.items()))
+            if entry.get('timestamp', 0) > cutoff:
+                break
+            self._entries.popitem(last=False)
+            self._unindex(key, entry)
+            if self._added.pop(key, None) is None:
+                self._removed.add(key)
+            evicted += 1
+        return evicted
+
+    async def flush(self):
+        """Записывает изменения сопоставления в хранилище."""
+        if not self._added and not self._removed:
+            return
+        added, removed = self._added, self._removed
+        self._added, self._removed = {}, set()
+        # Записи не изменяются после добавления, поэтому достаточно поверхностной копии
+        snapshot = dict(self._entries) if self.backend.full_snapshot else {}
+        try:
+            await disk_writer.run(self.backend.save_mappings, snapshot, added, removed, self.table)
+        except (OSError, sqlite3.Error) as e:
+            self._added = {**added, **self._added}
+            self._removed |= removed - self._added.keys()
+            logger.error(f"Не удалось сохранить сопоставление сообщений ({self.table}): {e}")
+
+
+class RollingWindow:
+    """
+    Кольцевой буфер счётчиков по фиксированным интервалам времени.
+    Для каждого окна (в числе интервалов) поддерживается текущая сумма,
+    поэтому добавление и чтение суммы выполняются за O(1).
+    """
+
+    __slots__ = ('bucket_seconds', 'windows', 'current', 'buckets', 'sums')
+
+    def __init__(self, bucket_seconds: int, size: int, windows: tuple, typecode: str = 'q'):
+        self.bucket_seconds = bucket_seconds
+        self.windows = windows
+        self.current = 0
+        self.buckets = array(typecode, bytes(array(typecode).itemsize * size))
+        self.sums = [0] * len(windows)
+
+    def _advance(self, bucket: int):
+        size = len(self.buckets)
+        if bucket <= self.current:
+            return
+        if bucket - self.current >= size:
+            for i in range(size):
+                self.buckets[i] = 0
+            self.sums = [0] * len(self.windows)
+        else:
+            for step in range(self.current + 1, bucket + 1):
+                # Вычитаем интервалы, которые выходят за границы окон
+                for i, window in enumerate(self.windows):
+                    self.sums[i] -= self.buckets[(step - window) % size]
+                self.buckets[step % size] = 0
+        self.current = bucket
+
+    def add(self, timestamp: float, count: int = 1):
+        bucket = int(timestamp // self.bucket_seconds)
+        self._advance(bucket)
+        if bucket <= self.current - len(self.buckets):
+            return
+        self.buckets[bucket % len(self.buckets)] += count
+        for i, window in enumerate(self.windows):
+            if bucket > self.current - window:
+                self.sums[i] += count
+
+    def totals(self, timestamp: float) -> list[int]:
+        """Возвращает суммы по всем окнам на момент timestamp."""
+        self._advance(int(timestamp // self.bucket_seconds))
+        return list(self.sums)
+
+    def last(self, count: int, timestamp: float) -> list[tuple[int, int]]:
+        """Возвращает последние count интервалов как пары (номер интервала, значение)."""
+        self._advance(int(timestamp // self.bucket_seconds))
+        size = len(self.buckets)
+        return [(bucket, self.buckets[bucket % size])
+                for bucket in range(self.current - min(count, size) + 1, self.current + 1)]
+
+    def to_dict(self) -> dict:
+        return {'current': self.current, 'buckets': list(self.buckets)}
+
+    def load_dict(self, data: dict):
+        buckets = data.get('buckets', [])
+        if len(buckets) != len(self.buckets):
+            return
+        self.current = data.get('current', 0)
+        self.buckets = array(self.buckets.typecode, buckets)
+        size = len(self.buckets)
+        self.sums = [
+            sum(self.buckets[(self.current - offset) % size] for offset in range(window))
+            for window in self.windows
+        ]
+
+
+class StatsEngine(WriteBehindStore):
+    """
+    Статистика сообщений по скользящим окнам.
+    Глобальные счётчики ведутся по часам за 30 дней, счётчики пользователей — по дням,
+    поэтому /stats отвечает за O(1) без обхода всех пользователей.
+    """
+
+    HOUR = 3600
+    DAY = 24 * HOUR
+    # Окна глобальной статистики в часах: сутки, неделя, месяц
+    GLOBAL_WINDOWS = (24, 7 * 24, 30 * 24)
+    # Окна статистики пользователя в днях: неделя, месяц
+    USER_WINDOWS = (7, 30)
+
+    def __init__(self, file_path: str, flush_interval: float = STATS_FLUSH_INTERVAL):
+        super().__init__(None, flush_interval)
+        self.file_path = file_path
+        self.total_messages = 0
+        self.hourly = RollingWindow(self.HOUR, self.GLOBAL_WINDOWS[-1], self.GLOBAL_WINDOWS)
+        self._users: dict[str, RollingWindow] = {}
+        self._dirty = False
+
+    def _new_user_window(self) -> RollingWindow:
+        return RollingWindow(self.DAY, self.USER_WINDOWS[-1], self.USER_WINDOWS, typecode='I')
+
+    def load(self, users):
+        """Загружает статистику с диска или инициализирует её по данным пользователей (при первом запуске)."""
+        data = load_data(self.file_path)
+        if not data:
+            self.total_messages = sum(user.total_messages for _, user in users)
+            self._dirty = True
+            return
+        self.total_messages = data.get('total_messages', 0)
+        self.hourly.load_dict(data.get('hourly', {}))
+        for user_id, user_stats in data.get('users', {}).items():
+            window = self._new_user_window()
+            window.load_dict(user_stats)
+            self._users[user_id] = window
+
+    def record(self, user_id, timestamp: float) -> tuple[int, int]:
+        """Учитывает сообщение пользователя. Возвращает его счётчики за неделю и месяц."""
+        self.total_messages += 1
+        self.hourly.add(timestamp)
+        window = self._users.get(str(user_id))
+        if window is None:
+            window = self._users[str(user_id)] = self._new_user_window()
+        window.add(timestamp)
+        self._dirty = True
+        weekly, monthly = window.sums
+        return weekly, monthly
+
+    def totals(self, timestamp: float | None = None) -> dict:
+        """Возвращает общее число сообщений и суммы за сутки, неделю и месяц."""
+        daily, weekly, monthly = self.hourly.totals(timestamp or time.time())
+        return {
+            'total_messages': self.total_messages,
+            'daily_messages': daily,
+            'weekly_messages': weekly,
+            'monthly_messages': monthly,
+        }
+
+    def hourly_histogram(self, hours: int = 24, timestamp: float | None = None) -> list[tuple[int, int]]:
+        """Возвращает пары (начало часа в Unix-времени, количество сообщений) за последние hours часов."""
+        return [(bucket * self.HOUR, count) for bucket, count in self.hourly.last(hours, timestamp or time.time())]
+
+    def prune(self, timestamp: float | None = None) -> int:
+        """Удаляет счётчики пользователей без сообщений за последние 30 дней."""
+        current_day = int((timestamp or time.time()) // self.DAY)
+        stale = [user_id for user_id, window in self._users.items()
+                 if current_day - window.current >= self.USER_WINDOWS[-1]]
+        for user_id in stale:
+            del self._users[user_id]
+        if stale:
+            self._dirty = True
+        return len(stale)
+
+    async def flush(self):
+        """Сохраняет статистику на диск, если она изменилась."""
+        if not self._dirty:
+            return
+        self._dirty = False
+        self.prune()
+        data = {
+            'total_messages': self.total_messages,
+            'hourly': self.hourly.to_dict(),
+            'users': {user_id: window.to_dict() for user_id, window in self._users.items()},
+        }
+        try:
+            await disk_writer.run(save_data, self.file_path, data)
+        except OSError as e:
+            self._dirty = True
+            logger.error(f"Не удалось сохранить статистику: {e}")
+
+
+class AdminLog(WriteBehindStore):
+    """
+    Журнал аудита действий администраторов: записи в формате JSON Lines дописываются
+    в файл пакетами, файл ротируется по размеру и возрасту и сжимается gzip.
+    Индекс в памяти хранит последние записи по пользователю, администратору и действию.
+    """
+
+    # Виды ключей индекса
+    KINDS = ('user', 'admin', 'action')
+
+    def __init__(self, file_path: str, flush_interval: float = ADMIN_LOG_FLUSH_INTERVAL,
+                 max_buffer: int = ADMIN_LOG_BUFFER_SIZE):
+        super().__init__(None, flush_interval)
+        self.file_path = file_path
+        self.max_buffer = max_buffer
+        self._buffer: list[str] = []
+        self._size_flush_task: asyncio.Task | None = None
+        # (вид, значение) -> последние записи (ts, admin_id, action, target, details)
+        self._index: dict[tuple[str, str], deque] = {}
+        # Файл открыт в потоке записи на диск; время первой записи в нём — для ротации по возрасту
+        self._file = None
+        self._file_started: float | None = None
+
+    def _index_record(self, record: tuple):
+        _, admin_id, action, target, _ = record
+        for key in (('user', target), ('admin', admin_id), ('action', action)):
+            if key[1] is None:
+                continue
+            entries = self._index.get(key)
+            if entries is None:
+                entries = self._index[key] = deque(maxlen=AUDIT_INDEX_PER_KEY)
+            entries.append(record)
+
+    def append(self, timestamp: int, admin_id, action: str, target, details: str):
+        """Добавляет запись в индекс и буфер; при переполнении буфера запускает сброс."""
+        record = (timestamp, str(admin_id), action, None if target is None else str(target), details)
+        self._index_record(record)
+        self._buffer.append(json.dumps(dict(zip(('ts', 'admin', 'action', 'target', 'details'), record)),
+                                       ensure_ascii=False, separators=(',', ':')) + '\n')
+        if len(self._buffer) >= self.max_buffer and self._size_flush_task is None:
+            try:
+                self._size_flush_task = asyncio.get_running_loop().create_task(self._flush_full_buffer())
+            except RuntimeError:
+                pass  # Вне цикла событий запись произойдёт при следующем сбросе
+
+    def recent(self, kind: str, value) -> list[tuple]:
+        """Возвращает записи индекса по ключу, начиная с новых."""
+        entries = self._index.get((kind, str(value)))
+        return list(reversed(entries)) if entries else []
+
+    def search(self, kind: str, value) -> list[tuple]:
+        """
+        Читает записи по ключу из последнего архива и текущего файла журнала, начиная с новых
+        (для журналов других шардов, индекса которых нет в памяти). Выполняется в потоке записи.
+        """
+        field = {'user': 3, 'admin': 1, 'action': 2}[kind]
+        value = str(value)
+        entries = deque(maxlen=AUDIT_INDEX_PER_KEY)
+        for path in self.archives()[-1:] + [self.file_path]:
+            try:
+                entries.extend(record for record in self._read_records(path) if record[field] == value)
+            except FileNotFoundError:
+                pass
+        return list(reversed(entries))
+
+    def archives(self) -> list[str]:
+        """Пути к архивам журнала, от старых к новым."""
+        directory, name = os.path.split(self.file_path)
+        prefix = name.rsplit('.', 1)[0] + '-'
+        try:
+            names = os.listdir(directory)
+        except FileNotFoundError:
+            return []
+        return sorted(os.path.join(directory, archive) for archive in names
+                      if archive.startswith(prefix) and archive.endswith('.jsonl.gz'))
+
+    def _read_records(self, path: str):
+        opener = gzip.open if path.endswith('.gz') else open
+        with opener(path, 'rt', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    data = json.loads(line)
+                    yield (data['ts'], data['admin'], data['action'], data.get('target'), data.get('details', ''))
+                except (ValueError, KeyError):
+                    continue  # Недописанная строка после аварийной остановки
+
+    # Строка прежнего журнала: [время] Admin ID: ... | Action: ... | Details: ...
+    LEGACY_LINE = re.compile(r'^\[(.+?)\] Admin ID: (\S+) \| Action: (\S+) \| Details: (.*)$')
+    LEGACY_TARGET = re.compile(r'\b[Uu]ser (-?\d+)')
+
+    def import_legacy(self, path: str, owns=lambda target: True):
+        """
+        Однократно переносит записи текстового журнала прежних версий в начало текущего файла.
+        Пользователь берётся из подробностей ("User 123", "To user 123"); owns отбирает записи
+        этого журнала (в шардированном режиме — записи пользователей шарда).
+        Выполняется при запуске, до start(); повторный импорт отмечается файлом-маркером.
+        """
+        marker = self.file_path + '.legacy-imported'
+        if not os.path.exists(path) or os.path.exists(marker):
+            return
+        lines = []
+        try:
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    match = self.LEGACY_LINE.match(line.rstrip('\n'))
+                    if not match:
+                        continue
+                    stamp, admin_id, action, details = match.groups()
+                    try:
+                        ts = int(datetime.datetime.strptime(stamp, "%Y-%m-%d %H:%M:%S").timestamp())
+                    except ValueError:
+                        continue
+                    target = self.LEGACY_TARGET.search(details)
+                    target = target.group(1) if target else None
+                    if not owns(target):
+                        continue
+                    lines.append(json.dumps({'ts': ts, 'admin': admin_id, 'action': action, 'target': target,
+                                             'details': details}, ensure_ascii=False, separators=(',', ':')) + '\n')
+            tmp_path = self.file_path + '.tmp'
+            with open(tmp_path, 'w', encoding='utf-8') as out:
+                out.writelines(lines)
+                if os.path.exists(self.file_path):
+                    with open(self.file_path, encoding='utf-8') as current:
+                        shutil.copyfileobj(current, out)
+            os.replace(tmp_path, self.file_path)
+            open(marker, 'w').close()
+        except OSError as e:
+            logger.error(f"Не удалось импортировать прежний журнал {path}: {e}")
+            return
+        logger.info(f"Импортировано записей из {path} в журнал аудита: {len(lines)}")
+
+    def load(self):
+        """Строит индекс по последнему архиву и текущему файлу журнала."""
+        self._index.clear()
+        for path in self.archives()[-1:] + [self.file_path]:
+            try:
+                for record in self._read_records(path):
+                    if path == self.file_path and self._file_started is None:
+                        self._file_started = record[0]
+                    self._index_record(record)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.error(f"Не удалось прочитать журнал аудита {path}: {e}")
+
+    async def _flush_full_buffer(self):
+        try:
+            await self.flush()
+        finally:
+            self._size_flush_task = None
+
+    def _rotate(self):
+        """Переносит текущий файл в сжатый архив и удаляет лишние архивы."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        archive = (self.file_path.rsplit('.', 1)[0]
+                   + datetime.datetime.now().strftime('-%Y%m%d-%H%M%S-%f') + '.jsonl.gz')
+        with open(self.file_path, 'rb') as source, gzip.open(archive, 'wb') as target:
+            shutil.copyfileobj(source, target)
+        os.remove(self.file_path)
+        self._file_started = None
+        for old_archive in self.archives()[:-AUDIT_ARCHIVE_KEEP]:
+            os.remove(old_archive)
+
+    def _write(self, lines: list[str]):
+        if self._file is None:
+            self._file = open(self.file_path, 'a', encoding='utf-8')
+        if self._file_started is None:
+            self._file_started = json.loads(lines[0])['ts']
+        self._file.writelines(lines)
+        self._file.flush()
+        if (self._file.tell() >= AUDIT_ROTATE_SIZE
+                or time.time() - self._file_started >= AUDIT_ROTATE_INTERVAL):
+            self._rotate()
+
+    async def flush(self):
+        """Дописывает накопленные записи в файл."""
+        if not self._buffer:
+            return
+        lines, self._buffer = self._buffer, []
+        try:
+            await disk_writer.run(self._write, lines)
+        except OSError as e:
+            self._buffer = lines + self._buffer
+            logger.error(f"Не удалось записать журнал аудита: {e}")
+
+    async def stop(self):
+        await super().stop()
+        if self._file is not None:
+            await disk_writer.run(self._file.close)
+            self._file = None
+
+
+def audit_log_file(shard_id: int) -> str:
+    """Путь к журналу аудита шарда (без шардирования — общий файл)."""
+    if SHARD_COUNT == 1:
+        return AUDIT_LOG_FILE
+    return os.path.join(META_DIR, f'audit.{shard_id}.jsonl')
+
+
+def archive_dir(shard_id: int) -> str:
+    """Каталог архива пользователей шарда (без шардирования — общий каталог)."""
+    if SHARD_COUNT == 1:
+        return ARCHIVE_DIR
+    return os.path.join(META_DIR, f'archive.{shard_id}')
+
+
+def shard_stats_file(shard_id: int) -> str:
+    """Путь к файлу статистики шарда (без шардирования — общий файл)."""
+    if SHARD_COUNT == 1:
+        return STATS_FILE
+    return os.path.join(META_DIR, f'stats.{shard_id}.json')
+
+
+async def collect_stats(hours: int = 24) -> tuple[dict, list[tuple[int, int]]]:
+    """
+    Возвращает итоги статистики и почасовую гистограмму.
+    В шардированном режиме добавляет статистику остальных шардов из их файлов.
+    """
+    now = time.time()
+    totals = stats_engine.totals(now)
+    histogram = stats_engine.hourly_histogram(hours, now)
+    for shard_id in range(SHARD_COUNT):
+        if shard_id == SHARD_ID:
+            continue
+        data = await disk_writer.run(load_data, shard_stats_file(shard_id))
+        hourly = RollingWindow(StatsEngine.HOUR, StatsEngine.GLOBAL_WINDOWS[-1], StatsEngine.GLOBAL_WINDOWS)
+        hourly.load_dict(data.get('hourly', {}))
+        daily, weekly, monthly = hourly.totals(now)
+        totals['total_messages'] += data.get('total_messages', 0)
+        totals['daily_messages'] += daily
+        totals['weekly_messages'] += weekly
+        totals['monthly_messages'] += monthly
+        histogram = [(hour_start, count + other_count)
+                     for (hour_start, count), (_, other_count) in zip(histogram, hourly.last(hours, now))]
+    return totals, histogram
+
+
+users_store = UserStore(storage)
+user_archive = UserArchive(archive_dir(SHARD_ID))
+message_mapping = MessageMapping(storage)
+reply_mapping = MessageMapping(storage, table='replies')
+stats_engine = StatsEngine(shard_stats_file(SHARD_ID))
+admin_log = AdminLog(audit_log_file(SHARD_ID))
+
+
+class KeyedLock:
+    """
+    Блокировки по ключу (например, user_id).
+    Обновления одного пользователя обрабатываются по очереди,
+    а разных пользователей — параллельно. Неиспользуемые блокировки удаляются.
+    """
+
+    def __init__(self):
+        self._locks: dict[str, list] = {}
+
+    @contextlib.asynccontextmanager
+    async def lock(self, key):
+        key = str(key)
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        acquired = False
+        try:
+            if entry[0].locked():
+                # Пока обработчик ждёт блокировку, он не занимает место обработки обновлений
+                async with yield_update_slot():
+                    await entry[0].acquire()
+                    acquired = True
+            else:
+                await entry[0].acquire()
+                acquired = True
+            yield
+        finally:
+            if acquired:
+                entry[0].release()
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self._locks[key]
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+
+user_locks = KeyedLock()
+
+
+class TokenBucket:
+    """Ограничитель частоты запросов по алгоритму «ведро токенов»."""
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated', 'blocked_until')
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Возвращает, сколько секунд нужно подождать до появления токена."""
+        if now < self.blocked_until:
+            return self.blocked_until - now
+        self._refill(now)
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consume(self):
+        self.tokens -= 1
+
+    def is_idle(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.capacity and now >= self.blocked_until
+
+
+class SendQueueFull(Exception):
+    """Очередь отправки переполнена."""
+
+
+class SendScheduler:
+    """
+    Очередь исходящих запросов к Telegram.
+    Соблюдает общий лимит и лимиты отдельных чатов, выполняет запросы
+    в порядке приоритета и повторяет их после ошибки flood control (retry after).
+    Запросы в чат, лимит которого исчерпан, откладываются в очередь этого чата
+    и возвращаются в общую очередь, когда появится токен, — обработчики не простаивают.
+    """
+
+    def __init__(self, workers: int = SEND_WORKERS, max_retries: int = SEND_MAX_RETRIES,
+                 rate_share: float = 1.0):
+        self.workers = workers
+        self.max_retries = max_retries
+        # Доля общих лимитов, доступная этому процессу (при шардировании лимиты делятся между шардами)
+        self.rate_share = rate_share
+        self._queue: asyncio.PriorityQueue | None = None
+        self._sequence = itertools.count()
+        self._global_bucket = TokenBucket(SEND_GLOBAL_RATE * rate_share, max(1, SEND_GLOBAL_BURST * rate_share))
+        self._chat_buckets: dict[str, TokenBucket] = {}
+        # Отложенные запросы по чатам (куча по приоритету и порядку) и таймеры их возврата в очередь
+        self._deferred: dict[str, list] = {}
+        self._release_timers: dict[str, asyncio.TimerHandle] = {}
+        self._worker_tasks: list[asyncio.Task] = []
+        # Метрики
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+
+    @property
+    def queue_depth(self) -> int:
+        queued = self._queue.qsize() if self._queue is not None else 0
+        return queued + sum(len(waiting) for waiting in self._deferred.values())
+
+    def metrics(self) -> dict:
+        """Возвращает метрики очереди: глубину, число запросов и время ожидания."""
+        handled = self.sent + self.failed
+        return {
+            'queue_depth': self.queue_depth,
+            'sent': self.sent,
+            'failed': self.failed,
+            'retried': self.retried,
+            'wait_time_avg': self.wait_time_total / handled if handled else 0.0,
+            'wait_time_max': self.wait_time_max,
+        }
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        key = str(chat_id)
+        bucket = self._chat_buckets.get(key)
+        if bucket is None:
+            if key.startswith('-'):
+                bucket = TokenBucket(SEND_GROUP_CHAT_RATE * self.rate_share,
+                                     max(1, SEND_GROUP_CHAT_BURST * self.rate_share))
+            else:
+                bucket = TokenBucket(SEND_PRIVATE_CHAT_RATE, SEND_PRIVATE_CHAT_BURST)
+            self._chat_buckets[key] = bucket
+        return bucket
+
+    def _prune_buckets(self):
+        now = time.monotonic()
+        for key in [key for key, bucket in self._chat_buckets.items() if bucket.is_idle(now)]:
+            del self._chat_buckets[key]
+
+    async def send(self, priority: int, method, chat_id, *args, **kwargs):
+        """Ставит вызов method(chat_id, *args, **kwargs) в очередь и возвращает его результат."""
+        future = self._enqueue(priority, method, chat_id, args, kwargs)
+        async with yield_update_slot():
+            return await future
+
+    def submit(self, priority: int, method, chat_id, *args, **kwargs) -> asyncio.Future:
+        """
+        Ставит вызов в очередь, не дожидаясь его, и возвращает future с результатом.
+        Если в очереди уже SEND_QUEUE_LIMIT запросов, future завершается ошибкой SendQueueFull.
+        """
+        if self.queue_depth >= SEND_QUEUE_LIMIT:
+            metrics.inc('bot_send_queue_overflow_total')
+            future = asyncio.get_running_loop().create_future()
+            future.set_exception(SendQueueFull(f"в очереди отправки {self.queue_depth} запросов"))
+            return future
+        return self._enqueue(priority, method, chat_id, args, kwargs)
+
+    def _enqueue(self, priority: int, method, chat_id, args: tuple, kwargs: dict) -> asyncio.Future:
+        if self._queue is None:
+            self._queue = asyncio.PriorityQueue()
+        future = asyncio.get_running_loop().create_future()
+        job = [method, chat_id, args, kwargs, future, time.monotonic(), 0]
+        self._queue.put_nowait((priority, next(self._sequence), job))
+        return future
+
+    def _schedule_release(self, key: str, chat_bucket: TokenBucket):
+        """Планирует возврат следующего отложенного запроса чата, когда у чата появится токен."""
+        if key in self._deferred and key not in self._release_timers:
+            self._release_timers[key] = asyncio.get_running_loop().call_later(
+                chat_bucket.delay(time.monotonic()), self._release, key)
+
+    def _release(self, key: str):
+        """Возвращает в общую очередь первый отложенный запрос чата."""
+        del self._release_timers[key]
+        waiting = self._deferred.get(key)
+        while waiting and waiting[0][2][4].done():
+            heapq.heappop(waiting)
+        if waiting:
+            self._queue.put_nowait(heapq.heappop(waiting))
+        if not waiting:
+            self._deferred.pop(key, None)
+
+    async def _take_tokens(self, key: str, chat_bucket: TokenBucket, entry: tuple) -> bool:
+        """
+        Забирает токены чата и общего лимита. Если лимит чата исчерпан или в чате уже есть
+        более ранние отложенные запросы, откладывает запрос и возвращает False.
+        """
+        while True:
+            now = time.monotonic()
+            waiting = self._deferred.get(key)
+            if (waiting and waiting[0][:2] < entry[:2]) or chat_bucket.delay(now) > 0:
+                heapq.heappush(self._deferred.setdefault(key, []), entry)
+                self._schedule_release(key, chat_bucket)
+                return False
+            delay = self._global_bucket.delay(now)
+            if delay <= 0:
+                chat_bucket.consume()
+                self._global_bucket.consume()
+                self._schedule_release(key, chat_bucket)
+                return True
+            await asyncio.sleep(delay)
+
+    async def _worker(self):
+        while True:
+            priority, sequence, job = await self._queue.get()
+            method, chat_id, args, kwargs, future, enqueued_at, attempts = job
+            key = str(chat_id)
+            chat_bucket = self._chat_bucket(chat_id)
+            if future.done():
+                self._schedule_release(key, chat_bucket)
+                continue
+            if not await self._take_tokens(key, chat_bucket, (priority, sequence, job)):
+                continue
+            if attempts == 0:
+                wait_time = time.monotonic() - enqueued_at
+                self.wait_time_total += wait_time
+                self.wait_time_max = max(self.wait_time_max, wait_time)
+            try:
+                result = await method(chat_id, *args, **kwargs)
+            except TelegramRetryAfter as e:
+                if attempts >= self.max_retries:
+                    self.failed += 1
+                    future.set_exception(e)
+                    continue
+                # Telegram просит подождать: приостанавливаем отправку в этот чат и повторяем
+                self.retried += 1
+                chat_bucket.blocked_until = time.monotonic() + e.retry_after
+                logger.warning(f"Flood control для чата {chat_id}, повтор через {e.retry_after} с")
+                job[6] = attempts + 1
+                self._queue.put_nowait((priority, sequence, job))
+            except Exception as e:
+                self.failed += 1
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                self.sent += 1
+                if not future.done():
+                    future.set_result(result)
+            if len(self._chat_buckets) > 10000:
+                self._prune_buckets()
 
-# Создание директории meta
-os.makedirs(META_DIR, exist_ok=True)
+    def start(self):
+        """Запускает обработчики очереди."""
+        if self._queue is None:
+            self._queue = asyncio.PriorityQueue()
+        if not self._worker_tasks:
+            self._worker_tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
 
-# Пути к файлам данных
-USERS_DATA_FILE = os.path.join(META_DIR, 'users_data.json')
-MESSAGES_MAPPING_FILE = os.path.join(META_DIR, 'messages_mapping.json')
-REPLY_MAPPING_FILE = os.path.join(META_DIR, 'reply_mapping.json')
-LOG_FILE_NAME = os.path.join(META_DIR, 'admin_log.txt')
-MESSAGES_FILE = os.path.join(BOT_DIR, 'messages.json')
+    async def stop(self):
+        """Останавливает обработчики очереди."""
+        for timer in self._release_timers.values():
+            timer.cancel()
+        self._release_timers.clear()
+        for task in self._worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        self._worker_tasks = []
 
 
-# --- Утилиты для работы с данными ---
+send_scheduler = SendScheduler()
 
-def load_data(file_path: str) -> dict:
-    """Загружает данные из JSON-файла."""
-    if not os.path.exists(file_path):
-        return {}
+
+class ConcurrencyLimitMiddleware(BaseMiddleware):
+    """
+    Ограничивает число одновременно обрабатываемых обновлений.
+    Место освобождается, пока обработчик ждёт блокировку пользователя или очередь отправки
+    (yield_update_slot), поэтому ожидающие обновления не задерживают остальных пользователей.
+    """
+
+    def __init__(self, limit: int = MAX_CONCURRENT_UPDATES):
+        self._semaphore = asyncio.Semaphore(limit)
+
+    async def __call__(self, handler, event, data):
+        slot = UpdateSlot(self._semaphore)
+        await slot.acquire()
+        token = _update_slot.set(slot)
+        try:
+            return await handler(event, data)
+        finally:
+            _update_slot.reset(token)
+            slot.release()
+
+
+class UpdateSlot:
+    """Место обработки обновления, занятое задачей обработчика."""
+
+    __slots__ = ('semaphore', 'task', 'held')
+
+    def __init__(self, semaphore: asyncio.Semaphore):
+        self.semaphore = semaphore
+        self.task = asyncio.current_task()
+        self.held = False
+
+    async def acquire(self):
+        await self.semaphore.acquire()
+        self.held = True
+
+    def release(self):
+        if self.held:
+            self.held = False
+            self.semaphore.release()
+
+
+_update_slot: contextvars.ContextVar[UpdateSlot | None] = contextvars.ContextVar('update_slot', default=None)
+
+
+@contextlib.asynccontextmanager
+async def yield_update_slot():
+    """Освобождает место обработки текущего обновления на время ожидания."""
+    slot = _update_slot.get()
+    # Задачи, созданные обработчиком, наследуют контекст, но место принадлежит только ему
+    if slot is None or not slot.held or slot.task is not asyncio.current_task():
+        yield
+        return
+    slot.release()
     try:
-        with open(file_path, 'r', encoding='utf-8') as f:
-            return json.load(f)
-    except (json.JSONDecodeError, FileNotFoundError):
-        return {}
+        yield
+    finally:
+        await slot.acquire()
 
 
-def save_data(file_path: str, data: dict):
-    """Сохраняет данные в JSON-файл."""
-    with open(file_path, 'w', encoding='utf-8') as f:
-        json.dump(data, f, indent=4, ensure_ascii=False)
+class HandlerMetricsMiddleware(BaseMiddleware):
+    """Замеряет длительность и ошибки каждого зарегистрированного обработчика."""
+
+    async def __call__(self, handler, event, data):
+        handler_object = data.get('handler')
+        name = handler_object.callback.__name__ if handler_object is not None else 'unknown'
+        with metrics.timer('bot_handler', handler=name):
+            return await handler(event, data)
+
+
+class RequestMetricsMiddleware(BaseRequestMiddleware):
+    """Замеряет длительность и ошибки запросов к Bot API по методам."""
+
+    async def __call__(self, make_request, bot, method):
+        with metrics.timer('bot_api_request', method=method.__api_method__):
+            return await make_request(bot, method)
+
+
+def register_gauges():
+    """Регистрирует показатели состояния бота (значения читаются при выводе метрик)."""
+    metrics.describe('bot_users', 'gauge', 'Зарегистрированные пользователи')
+    metrics.gauge('bot_users', lambda: len(users_store))
+    metrics.describe('bot_archived_users', 'gauge', 'Пользователи в архиве')
+    metrics.gauge('bot_archived_users', lambda: len(user_archive))
+    metrics.describe('bot_active_bans', 'gauge', 'Активные баны')
+    metrics.gauge('bot_active_bans', lambda: len(ban_index))
+    metrics.describe('bot_mapping_entries', 'gauge', 'Записи сопоставления сообщений')
+    metrics.gauge('bot_mapping_entries', lambda: len(message_mapping), table='messages')
+    metrics.gauge('bot_mapping_entries', lambda: len(reply_mapping), table='replies')
+    metrics.describe('bot_send_queue_depth', 'gauge', 'Запросы в очереди отправки')
+    metrics.gauge('bot_send_queue_depth', lambda: send_scheduler.queue_depth)
+    metrics.describe('bot_send_requests', 'gauge', 'Запросы планировщика отправки с момента запуска')
+    for result in ('sent', 'failed', 'retried'):
+        metrics.gauge('bot_send_requests', lambda result=result: getattr(send_scheduler, result), result=result)
+    metrics.describe('bot_disk_queue_depth', 'gauge', 'Операции в очереди записи на диск')
+    metrics.gauge('bot_disk_queue_depth', lambda: disk_writer.pending)
+
+
+def metrics_file_path() -> str:
+    """Путь к файлу выгрузки метрик (при шардировании — отдельный файл для каждого шарда)."""
+    if SHARD_COUNT == 1:
+        return METRICS_FILE
+    root, ext = os.path.splitext(METRICS_FILE)
+    return f'{root}.{SHARD_ID}{ext}'
+
+
+def write_metrics_file(path: str, text: str):
+    """Атомарно записывает метрики в файл."""
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+async def dump_metrics():
+    """Выгружает текущие метрики в METRICS_FILE."""
+    try:
+        await disk_writer.run(write_metrics_file, metrics_file_path(), metrics.render())
+    except OSError as e:
+        logger.error(f"Не удалось выгрузить метрики: {e}")
+
+
+async def metrics_dump_loop():
+    """Фоновая задача: периодически выгружает метрики в файл."""
+    while True:
+        await asyncio.sleep(METRICS_DUMP_INTERVAL)
+        await dump_metrics()
+
+
+async def serve_metrics(port: int):
+    """Отдаёт метрики по HTTP (GET /metrics) до отмены задачи."""
+    async def handle(request: web.Request) -> web.Response:
+        return web.Response(text=metrics.render(), content_type='text/plain', charset='utf-8')
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, METRICS_HOST, port).start()
+        logger.info(f"Метрики доступны на http://{METRICS_HOST}:{port}/metrics")
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+register_gauges()
+
+
+# Тексты бота по умолчанию. messages.json переопределяет их; набор ключей и допустимые
+# подстановки {имя} в шаблонах проверяются по этому словарю
+DEFAULT_MESSAGES = {
+    "welcome_user": "Привет!",
+    "already_started": "С возвращением! Вы с нами с {formatted_date}.",
+    "help_message": "Это бот для связи с администратором.",
+    "msg_usage": "Использование: /msg <user_id> <текст>",
+    "id_not_numeric": "ID пользователя должен быть числом.",
+    "msg_sent_success": "Сообщение отправлено пользователю {user_id_to_send}.",
+    "msg_send_error": "Ошибка при отправке: {error}",
+    "who_usage": "Использование: /who <user_id> или ответьте на сообщение пользователя.",
+    "user_not_found": "Пользователь не найден.",
+    "user_info_template": "ID: {user_id}\nUsername: {username_info}\nПервый запуск: {formatted_date}",
+    "stats_template": (
+        "📊 <b>Статистика бота</b>\n\n"
+        "Всего сообщений: {total_messages}\n"
+        "Сообщений за месяц: {monthly_messages}\n"
+        "Сообщений за неделю: {weekly_messages}\n"
+        "Сообщений за сутки: {daily_messages}"),
+    "stats_hourly_title": "<b>Сообщения по часам (по мск):</b>",
+    "ban_usage": "Использование: /ban <user_id> [срок] [причина] или ответом на сообщение.",
+    "ban_user_not_found": "Пользователь не найден в базе данных.",
+    "user_already_banned": "Пользователь уже заблокирован.\nПричина: {reason}\nЗаблокирован до: {until}",
+    "user_ban_message_with_duration": "Вы были заблокированы.\nДлительность: {duration}\nПричина: {reason}",
+    "user_ban_message_permanent": "Вы были заблокированы навсегда.\nПричина: {reason}",
+    "admin_ban_success": "Пользователь с ID {user_id} успешно заблокирован.",
+    "unban_usage": "Не могу определить ID пользователя. Используйте /unban <ID> или ответьте на сообщение.",
+    "user_unbanned_message": "Вы были разблокированы.",
+    "admin_unban_success": "Пользователь с ID {user_id} разблокирован.",
+    "user_not_banned": "Пользователь не был заблокирован.",
+    "banned_list_title": "<b>Список заблокированных (страница {current_page}/{total_pages}):</b>\n",
+    "banned_user_template": (
+        "<b>ID:</b> <code>{user_id}</code>\n"
+        "<b>Username:</b> @{username}\n"
+        "<b>Причина:</b> {reason}\n"
+        "<b>До:</b> {until}\n"),
+    "no_banned_users": "Заблокированных пользователей нет.",
+    "find_usage": "Использование: /find <начало username> или /find без аргументов — недавно писавшие.",
+    "find_nothing": "Пользователи не найдены.",
+    "find_title": "<b>Пользователи @{prefix}… (страница {current_page}/{total_pages}, найдено {total}):</b>\n",
+    "find_recent_title": "<b>Недавно писавшие (страница {current_page}/{total_pages}):</b>\n",
+    "find_user_template": "<code>{user_id}</code> — @{username}, последнее сообщение: {last_active}",
+    "audit_usage": "Использование: /audit <user_id>, /audit admin <admin_id> или /audit action <действие>.",
+    "audit_empty": "Записей в журнале нет.",
+    "audit_title": "<b>Журнал аудита: {key} (страница {current_page}/{total_pages}):</b>\n",
+    "audit_entry_template": "<b>{date}</b>\n{action} (администратор <code>{admin_id}</code>)\n{details}",
+    "user_is_banned_message_with_reason": "Вы заблокированы.\nПричина: {reason}\nДо: {until}",
+    "error_sending_reply": "Не удалось отправить ответ пользователю {user_id}. Ошибка: {error}",
+    "broadcast_usage": "Ответьте командой /broadcast [дней] на сообщение для рассылки.",
+    "broadcast_started": "Рассылка начата, получателей: {total}.",
+    "broadcast_already_running": "Рассылка уже идёт. Остановить её: /broadcast stop",
+    "broadcast_cancelled": "Рассылка остановлена.",
+    "broadcast_not_running": "Рассылка не запущена.",
+    "broadcast_finished": (
+        "Рассылка завершена за {elapsed:.0f} с ({rate:.1f} сообщ./с).\n"
+        "Доставлено: {sent}\n"
+        "Заблокировали бота: {blocked}\n"
+        "Ошибок: {failed}"),
+    "topic_title": "{name} ({user_id})",
+    "spam_throttled_message": "Слишком много сообщений. Подождите немного.",
+    "spam_ban_reason": "Автоматическая блокировка: слишком много сообщений",
+    "admin_spam_ban_notice": "Пользователь {user_id} автоматически заблокирован за спам на {duration}.",
+}
+
+
+def check_template(text: str, allowed: set | None = None):
+    """
+    Проверяет шаблон str.format с именованными подстановками и возвращает функцию подстановки
+    (text.format_map). Выбрасывает ValueError, если шаблон некорректен или использует
+    подстановки не из allowed.
+    """
+    if not isinstance(text, str):
+        raise ValueError("шаблон должен быть строкой")
+    for _, field, spec, conversion in string.Formatter().parse(text):
+        if field is None:
+            continue
+        # Позиционные подстановки, обращения к атрибутам и индексам запрещены
+        if not field.isidentifier() or field.startswith('_'):
+            raise ValueError(f"недопустимая подстановка {{{field}}}")
+        if allowed is not None and field not in allowed:
+            raise ValueError(f"неизвестная подстановка {{{field}}}, допустимы: {', '.join(sorted(allowed)) or 'нет'}")
+        if conversion not in (None, 'r', 's', 'a'):
+            raise ValueError(f"неизвестное преобразование !{conversion}")
+        if '{' in spec or '}' in spec:
+            raise ValueError("вложенные подстановки не поддерживаются")
+    return text.format_map
+
+
+def template_fields(text: str) -> set:
+    """Имена подстановок шаблона."""
+    return {field for _, field, _, _ in string.Formatter().parse(text) if field is not None}
+
+
+class MessageCatalog:
+    """
+    Каталог текстов бота.
+    Шаблоны из messages.json и файлов других языков (messages.<язык>.json, например messages.en.json)
+    проверяются при загрузке по DEFAULT_MESSAGES; неизвестные ключи и шаблоны
+    с ошибками пропускаются с записью в лог, вместо них используется основной текст.
+    Язык выбирается по language_code пользователя. При изменении файлов каталог перечитывается
+    и подменяется целиком, поэтому обработчики видят либо старые, либо новые тексты.
+    """
+
+    def __init__(self, file_path: str, defaults: dict):
+        self.file_path = file_path
+        self._allowed = {key: template_fields(text) for key, text in defaults.items()}
+        self._defaults = {key: check_template(text) for key, text in defaults.items()}
+        # Шаблоны из файлов: язык (None — основной) -> {ключ: функция шаблона}
+        self._overrides: dict[str | None, dict] = {}
+        # Полные наборы шаблонов по языкам; language_code пользователей добавляются при первом обращении
+        self._locales: dict[str | None, dict] = {None: self._defaults}
+        self._mtimes: dict[str, int] = {}
+
+    def files(self) -> dict[str | None, str]:
+        """Файлы каталога по языкам (None — основной файл)."""
+        directory, name = os.path.split(self.file_path)
+        stem, extension = os.path.splitext(name)
+        files = {None: self.file_path}
+        for entry in os.listdir(directory or '.'):
+            locale = entry[len(stem) + 1:-len(extension)]
+            if entry.startswith(stem + '.') and entry.endswith(extension) and locale.replace('-', '').isalnum():
+                files[locale.lower()] = os.path.join(directory, entry)
+        return files
+
+    def _current_mtimes(self, files: dict) -> dict[str, int]:
+        mtimes = {}
+        for path in files.values():
+            with contextlib.suppress(FileNotFoundError):
+                mtimes[path] = os.stat(path).st_mtime_ns
+        return mtimes
+
+    def _load_file(self, path: str) -> dict:
+        data = load_data(path, strict=True)
+        if not isinstance(data, dict):
+            raise RuntimeError("ожидается объект JSON вида {ключ: шаблон}")
+        templates = {}
+        for key, text in data.items():
+            if key not in self._allowed:
+                logger.warning(f"{path}: неизвестный ключ '{key}' пропущен")
+                continue
+            try:
+                templates[key] = check_template(text, self._allowed[key])
+            except ValueError as e:
+                logger.error(f"{path}: шаблон '{key}' отклонён ({e}), используется текст по умолчанию")
+        return templates
+
+    def load(self):
+        """Загружает и проверяет все файлы каталога, затем подменяет каталог целиком."""
+        files = self.files()
+        mtimes = self._current_mtimes(files)
+        if self.file_path not in mtimes:
+            logger.warning(f"Файл сообщений '{self.file_path}' не найден. Используются значения по умолчанию.")
+        overrides = {}
+        for locale, path in files.items():
+            if path not in mtimes:
+                continue
+            try:
+                overrides[locale] = self._load_file(path)
+            except (OSError, RuntimeError) as e:
+                # Файл с ошибкой (например, сохранённый не до конца) не заменяет уже загруженные тексты
+                logger.error(f"Не удалось загрузить тексты из '{path}': {e}")
+                overrides[locale] = self._overrides.get(locale, {})
+        base = {**self._defaults, **overrides.get(None, {})}
+        locales = {locale: {**base, **templates} for locale, templates in overrides.items()}
+        locales[None] = base
+        self._overrides = overrides
+        # Каталог подменяется одним присваиванием
+        self._locales = locales
+        self._mtimes = mtimes
+
+    def reload_if_changed(self) -> bool:
+        """Перезагружает каталог, если файлы изменились (по времени изменения), появились или удалены."""
+        if self._current_mtimes(self.files()) == self._mtimes:
+            return False
+        self.load()
+        return True
 
+    def _resolve(self, locale: str) -> dict:
+        """Находит шаблоны для language_code (например, en-US -> en, иначе основной язык) и запоминает их."""
+        locales = self._locales
+        code = locale.lower()
+        templates = locales.get(code) or locales.get(code.split('-')[0]) or locales[None]
+        locales[locale] = templates
+        return templates
+
+    def render(self, key: str, locale: str | None = None, /, **values) -> str:
+        """Возвращает текст по ключу на языке locale (language_code пользователя) с подстановкой values."""
+        templates = self._locales.get(locale) or self._resolve(locale)
+        try:
+            return templates[key](values)
+        except (ValueError, TypeError, KeyError) as e:
+            # Например, спецификация формата не подходит к типу значения
+            logger.error(f"Не удалось подставить значения в шаблон '{key}': {e}")
+            return self._defaults[key](values)
+
+
+MESSAGES = MessageCatalog(MESSAGES_FILE, DEFAULT_MESSAGES)
+MESSAGES.load()
 
-try:
-    MESSAGES = load_data(MESSAGES_FILE)
-    if not MESSAGES:
-        logger.warning(f"Файл сообщений '{MESSAGES_FILE}' пуст или не найден. Используются значения по умолчанию.")
-except Exception as e:
-    logger.error(f"Ошибка при загрузке файла сообщений: {e}")
-    MESSAGES = {}
 
+async def messages_reload_loop():
+    """Фоновая задача: перечитывает тексты бота при изменении файлов messages*.json."""
+    while True:
+        await asyncio.sleep(MESSAGES_RELOAD_INTERVAL)
+        if await disk_writer.run(MESSAGES.reload_if_changed):
+            logger.info("Тексты бота перечитаны")
 
-def log_admin_action(admin_id, action_type, details):
-    """Логирование действий администратора."""
-    timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    log_entry = f"[{timestamp}] Admin ID: {admin_id} | Action: {action_type} | Details: {details}\n"
-    with open(LOG_FILE_NAME, 'a', encoding='utf-8') as f:
-        f.write(log_entry)
+
+def user_locale(message: Message) -> str | None:
+    """Язык пользователя, написавшего сообщение (language_code из Telegram)."""
+    return message.from_user.language_code if message.from_user else None
+
+
+def log_admin_action(admin_id, action_type, details, target_user_id=None):
+    """Записывает действие администратора в журнал аудита."""
+    admin_log.append(int(time.time()), admin_id, action_type, target_user_id, details)
 
 
 # --- Утилиты для работы с датой и временем ---
@@ -85,65 +2329,519 @@ def get_russian_month(month_number: int) -> str:
     return months.get(month_number, '')
 
 
-def format_datetime_for_message(dt_obj: datetime.datetime) -> str:
-    """Форматирует объект datetime в строку для сообщения (по МСК)."""
+def format_datetime_for_message(timestamp: int) -> str:
+    """Форматирует время (в секундах Unix) в строку для сообщения (по МСК)."""
     moscow_tz = timezone(timedelta(hours=3))
-    dt_moscow = dt_obj.astimezone(moscow_tz)
+    dt_moscow = datetime.datetime.fromtimestamp(timestamp, moscow_tz)
     return f"{dt_moscow.day} {get_russian_month(dt_moscow.month)} {dt_moscow.year} в {dt_moscow.hour:02}:{dt_moscow.minute:02} (по мск)"
 
 
 # --- Основная логика бота ---
 
-def cleanup_old_messages():
-    """Удаляет старые сообщения (старше 30 дней) из файла-отображения."""
-    messages_mapping = load_data(MESSAGES_MAPPING_FILE)
-    thirty_days_ago = datetime.datetime.now() - timedelta(days=30)
+async def mapping_cleanup_loop():
+    """Фоновая задача: удаляет устаревшие записи сопоставления сообщений."""
+    while True:
+        await asyncio.sleep(MAPPING_CLEANUP_INTERVAL)
+        evicted = message_mapping.evict_expired() + reply_mapping.evict_expired()
+        if evicted:
+            logger.info(f"Удалено устаревших записей сопоставления: {evicted}")
 
-    # Используем dict comprehension для большей эффективности
-    new_mapping = {
-        user_msg_id: data
-        for user_msg_id, data in messages_mapping.items()
-        if datetime.datetime.fromtimestamp(data.get('timestamp', 0)) > thirty_days_ago
-    }
-    save_data(MESSAGES_MAPPING_FILE, new_mapping)
 
+def replied_message_id(message: Message) -> int | None:
+    """Возвращает ID сообщения, на которое ответили (начало темы форума не считается ответом)."""
+    reply = message.reply_to_message
+    if reply is None or (message.is_topic_message and reply.message_id == message.message_thread_id):
+        return None
+    return reply.message_id
 
-def is_user_banned(user_id: int) -> (bool, str | None):
+
+def find_mapped_user(admin_message_id) -> str | None:
+    """Возвращает ID пользователя, к переписке с которым относится сообщение в чате администраторов."""
+    entry = message_mapping.get(admin_message_id) or reply_mapping.get(admin_message_id)
+    return entry['user_id'] if entry else None
+
+
+def find_thread_message(user_id, user_message_id) -> str | None:
+    """Возвращает сообщение в чате администраторов, соответствующее сообщению в чате пользователя."""
+    return (reply_mapping.find_admin_message(user_id, user_message_id)
+            or message_mapping.find_admin_message(user_id, user_message_id))
+
+
+class BanIndex:
     """
-    Проверяет, заблокирован ли пользователь.
-    Также снимает блокировку, если ее срок истек (побочный эффект).
+    Индекс активных банов: user_id -> (окончание в секундах Unix, причина).
+    ID хранятся в отсортированном списке для постраничного вывода,
+    а сроки окончания — в min-куче, чтобы истёкшие баны снимались фоновой задачей.
     """
-    users_data = load_data(USERS_DATA_FILE)
-    user_id_str = str(user_id)
 
-    if user_id_str in users_data and 'banned_until' in users_data[user_id_str]:
-        ban_end_time_str = users_data[user_id_str]['banned_until']
+    def __init__(self):
+        self._bans: dict[str, tuple[int, str | None]] = {}
+        self._sorted_ids: list[int] = []
+        self._expiry_heap: list[tuple[int, str]] = []
 
-        if ban_end_time_str == datetime.datetime.max.isoformat():
-            return True, "навсегда"
+    def __len__(self) -> int:
+        return len(self._bans)
 
-        ban_end_time = datetime.datetime.fromisoformat(ban_end_time_str)
+    def get(self, user_id) -> tuple[int, str | None] | None:
+        return self._bans.get(str(user_id))
+
+    def add(self, user_id, until: int, reason: str | None = None):
+        """Добавляет или обновляет бан пользователя."""
+        user_id_str = str(user_id)
+        if user_id_str not in self._bans:
+            bisect.insort(self._sorted_ids, int(user_id_str))
+        self._bans[user_id_str] = (until, reason)
+        if until != PERMANENT_BAN_UNTIL:
+            heapq.heappush(self._expiry_heap, (until, user_id_str))
+
+    def remove(self, user_id):
+        """Удаляет бан пользователя из индекса (запись в куче удаляется лениво)."""
+        user_id_str = str(user_id)
+        if self._bans.pop(user_id_str, None) is None:
+            return
+        position = bisect.bisect_left(self._sorted_ids, int(user_id_str))
+        del self._sorted_ids[position]
+
+    def rebuild(self, users):
+        """Строит индекс по парам (user_id, данные пользователя)."""
+        self._bans.clear()
+        self._sorted_ids.clear()
+        self._expiry_heap.clear()
+        for user_id, user_data in users:
+            until = user_data.banned_until
+            if until is not None:
+                self._bans[user_id] = (until, user_data.ban_reason)
+                if until != PERMANENT_BAN_UNTIL:
+                    self._expiry_heap.append((until, user_id))
+        self._sorted_ids = sorted(int(user_id) for user_id in self._bans)
+        heapq.heapify(self._expiry_heap)
+
+    def page(self, start: int, count: int) -> list[tuple[str, int, str | None]]:
+        """Возвращает срез банов [start, start + count) в порядке возрастания ID."""
+        result = []
+        for user_id in self._sorted_ids[start:start + count]:
+            until, reason = self._bans[str(user_id)]
+            result.append((str(user_id), until, reason))
+        return result
+
+    def pop_expired(self, now: float) -> list[str]:
+        """Извлекает из кучи ID пользователей, чей бан истёк к моменту now."""
+        expired = []
+        while self._expiry_heap and self._expiry_heap[0][0] <= now:
+            until, user_id = heapq.heappop(self._expiry_heap)
+            ban = self._bans.get(user_id)
+            # Запись могла устареть: бан сняли или продлили
+            if ban is not None and ban[0] == until:
+                expired.append(user_id)
+        return expired
+
+
+ban_index = BanIndex()
+
+
+class UserSearchIndex:
+    """
+    Индекс поиска пользователей: username в нижнем регистре хранятся в отсортированном
+    списке (поиск по началу — bisect), а ID пользователей — в порядке последнего сообщения.
+    """
+
+    def __init__(self):
+        self._names: list[str] = []
+        self._name_ids = array('q')
+        # user_id от давно писавших к недавним: при сообщении пользователь переставляется в конец
+        # (dict сохраняет порядок вставки и занимает меньше памяти, чем OrderedDict)
+        self._activity: dict[str, None] = {}
+
+    def rebuild(self, users):
+        """Строит индекс по парам (user_id, данные пользователя)."""
+        names = sorted((sys.intern(user_data.username.lower()), int(user_id))
+                       for user_id, user_data in users if user_data.username)
+        self._names = [name for name, _ in names]
+        self._name_ids = array('q', (user_id for _, user_id in names))
+        self._activity = dict.fromkeys(
+            user_id for user_id, _ in sorted(users, key=lambda item: item[1].last_message_date))
+
+    def set_username(self, user_id, old_username: str | None, new_username: str | None):
+        """Переносит пользователя в индексе со старого username на новый."""
+        user_id_int = int(user_id)
+        if old_username:
+            name = old_username.lower()
+            position = bisect.bisect_left(self._names, name)
+            while position < len(self._names) and self._names[position] == name:
+                if self._name_ids[position] == user_id_int:
+                    del self._names[position]
+                    del self._name_ids[position]
+                    break
+                position += 1
+        if new_username:
+            name = sys.intern(new_username.lower())
+            position = bisect.bisect_right(self._names, name)
+            self._names.insert(position, name)
+            self._name_ids.insert(position, user_id_int)
+
+    def remove(self, user_id: str, username: str | None):
+        """Убирает пользователя из индекса (при переносе в архив)."""
+        self.set_username(user_id, username, None)
+        self._activity.pop(user_id, None)
+
+    def touch(self, user_id: str):
+        """Отмечает, что пользователь только что написал."""
+        self._activity.pop(user_id, None)
+        self._activity[user_id] = None
+
+    def search(self, prefix: str, start: int, count: int) -> tuple[int, list[str]]:
+        """Возвращает число пользователей с username, начинающимся с prefix, и срез их ID."""
+        prefix = prefix.lower()
+        low = bisect.bisect_left(self._names, prefix)
+        high = bisect.bisect_left(self._names, prefix[:-1] + chr(ord(prefix[-1]) + 1), low)
+        page = self._name_ids[low + start:min(low + start + count, high)]
+        return high - low, [str(user_id) for user_id in page]
+
+    def recent(self, start: int, count: int) -> tuple[int, list[str]]:
+        """Возвращает число пользователей и срез их ID от недавно писавших."""
+        return len(self._activity), list(itertools.islice(reversed(self._activity), start, start + count))
+
+
+user_search = UserSearchIndex()
+
+
+def update_username(user_id: str, user_data: UserRecord, username: str | None):
+    """Запоминает новый username пользователя и обновляет индекс поиска."""
+    if username == user_data.username:
+        return
+    user_search.set_username(user_id, user_data.username, username)
+    user_data.username = sys.intern(username) if username else None
+    users_store.mark_dirty(user_id)
+
+
+def format_ban_until(until: int) -> str:
+    """Форматирует дату окончания бана для сообщения."""
+    if until == PERMANENT_BAN_UNTIL:
+        return "навсегда"
+    return format_datetime_for_message(until)
 
-        if ban_end_time > datetime.datetime.now():
-            return True, format_datetime_for_message(ban_end_time)
-        else:
-            # Срок бана истек, снимаем бан
-            del users_data[user_id_str]['banned_until']
-            if 'ban_reason' in users_data[user_id_str]:
-                del users_data[user_id_str]['ban_reason']
-            save_data(USERS_DATA_FILE, users_data)
 
+def is_user_banned(user_id: int) -> (bool, str | None):
+    """Проверяет по индексу банов, заблокирован ли пользователь."""
+    ban = ban_index.get(user_id)
+    if ban is None:
+        return False, None
+
+    until = ban[0]
+    if until > time.time():
+        return True, format_ban_until(until)
     return False, None
 
 
-async def is_admin(user_id: int, chat_id: int, bot: Bot) -> bool:
-    """Проверяет, является ли пользователь администратором чата."""
+def lift_ban(user_id) -> bool:
+    """Снимает бан пользователя. Возвращает True, если бан был."""
+    ban_index.remove(user_id)
+    user_data = users_store.get(user_id)
+    if user_data is None or user_data.banned_until is None:
+        return False
+    user_data.banned_until = None
+    user_data.ban_reason = None
+    users_store.mark_dirty(user_id)
+    return True
+
+
+async def ban_expiry_loop():
+    """Фоновая задача: снимает баны, срок которых истёк."""
+    while True:
+        await asyncio.sleep(BAN_EXPIRY_CHECK_INTERVAL)
+        for user_id in ban_index.pop_expired(time.time()):
+            lift_ban(user_id)
+            logger.info(f"Срок бана пользователя {user_id} истёк, бан снят")
+
+
+def is_archivable(user_data: UserRecord, cutoff: int) -> bool:
+    """Проверяет, можно ли перенести пользователя в архив: не писал с cutoff, не заблокирован и без темы форума."""
+    return (max(user_data.last_message_date, user_data.first_launch) < cutoff
+            and user_data.banned_until is None and user_data.topic_id is None)
+
+
+async def archive_inactive_users() -> int:
+    """Переносит в архив до ARCHIVE_BATCH_SIZE неактивных пользователей. Возвращает число перенесённых."""
+    cutoff = int(time.time()) - ARCHIVE_AFTER_DAYS * 86400
+    users = {}
+    for position, (user_id, user_data) in enumerate(list(users_store.items())):
+        if is_archivable(user_data, cutoff):
+            users[user_id] = user_data.to_row()
+            if len(users) >= ARCHIVE_BATCH_SIZE:
+                break
+        if position % 10000 == 9999:
+            await asyncio.sleep(0)
+    if not users:
+        return 0
+
+    # Из основного хранилища пользователи удаляются только после записи архива на диск
     try:
-        admins = await bot.get_chat_administrators(chat_id)
-        return any(admin.user.id == user_id for admin in admins)
-    except TelegramAPIError as e:
-        logger.error(f"Ошибка при проверке статуса администратора: {e}")
+        await user_archive.add(users, users_store.persisted_ids())
+    except (OSError, RuntimeError) as e:
+        logger.error(f"Не удалось перенести пользователей в архив: {e}")
+        return 0
+    archived = 0
+    for user_id, row in users.items():
+        user_data = users_store.get(user_id)
+        if user_data is None:
+            continue
+        if user_data.to_row() != row:
+            # Пользователь написал, пока записывался архив: он остаётся среди активных
+            user_archive.discard(user_id)
+            continue
+        users_store.remove(user_id)
+        user_search.remove(user_id, user_data.username)
+        archived += 1
+    metrics.inc('bot_users_archived_total', archived)
+    return archived
+
+
+async def archive_loop():
+    """Фоновая задача: переносит в архив пользователей, которые давно не писали."""
+    while True:
+        await asyncio.sleep(ARCHIVE_CHECK_INTERVAL)
+        total = 0
+        while True:
+            archived = await archive_inactive_users()
+            total += archived
+            if archived < ARCHIVE_BATCH_SIZE:
+                break
+        if total:
+            logger.info(f"В архив перенесено пользователей: {total}")
+
+
+async def rehydrate_user(user_id: str) -> UserRecord | None:
+    """Возвращает данные пользователя, при необходимости поднимая их из архива. Вызывается под блокировкой пользователя."""
+    user_data = users_store.get(user_id)
+    if user_data is not None or user_id not in user_archive:
+        return user_data
+    try:
+        user_data = await disk_writer.run(user_archive.load_user, user_id)
+    except (OSError, RuntimeError) as e:
+        logger.error(f"Не удалось прочитать пользователя {user_id} из архива: {e}")
+        return None
+    blocked = user_archive.is_blocked(user_id)
+    user_archive.discard(user_id)
+    if user_data is None:
+        return None
+    if blocked and user_data.blocked_at is None:
+        # Блокировку бота заметила рассылка, пока пользователь был в архиве
+        user_data.blocked_at = int(time.time())
+    users_store.add(user_id, user_data)
+    user_search.set_username(user_id, None, user_data.username)
+    user_search.touch(user_id)
+    metrics.inc('bot_users_rehydrated_total')
+    logger.info(f"Пользователь {user_id} возвращён из архива")
+    return user_data
+
+
+def register_user(user_id: str, username: str | None) -> UserRecord:
+    """Создаёт запись нового пользователя. Вызывается под блокировкой пользователя."""
+    now = int(time.time())
+    user_data = UserRecord(first_launch=now, last_message_date=now, username=username)
+    users_store.add(user_id, user_data)
+    user_search.set_username(user_id, None, user_data.username)
+    user_search.touch(user_id)
+    return user_data
+
+
+class SpamGuard:
+    """
+    Ограничение частоты сообщений пользователей: «ведро токенов» на пользователя.
+    Отброшенные сообщения считаются в скользящем окне; при превышении порога
+    пользователь получает автоматический бан, длительность которого растёт с каждым повтором.
+    """
+
+    def __init__(self):
+        self._buckets: dict[str, TokenBucket] = {}
+        # user_id -> время отброшенных сообщений в окне SPAM_VIOLATION_WINDOW
+        self._violations: dict[str, deque] = {}
+        # user_id -> число автоматических банов (хранится до перезапуска)
+        self._strikes: dict[str, int] = {}
+        self._pruned_at = time.monotonic()
+
+    def allow(self, user_id: str, now: float) -> bool:
+        """Расходует токен пользователя. Возвращает False, если сообщение нужно отбросить."""
+        if now - self._pruned_at > SPAM_VIOLATION_WINDOW:
+            self._prune(now)
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            bucket = self._buckets[user_id] = TokenBucket(SPAM_RATE, SPAM_BURST)
+        if bucket.delay(now) > 0:
+            return False
+        bucket.consume()
+        return True
+
+    def violation(self, user_id: str, now: float) -> tuple[bool, bool]:
+        """Учитывает отброшенное сообщение. Возвращает (первое ли нарушение в окне, пора ли банить)."""
+        violations = self._violations.get(user_id)
+        if violations is None:
+            violations = self._violations[user_id] = deque(maxlen=SPAM_BAN_THRESHOLD)
+        while violations and now - violations[0] > SPAM_VIOLATION_WINDOW:
+            violations.popleft()
+        first = not violations
+        violations.append(now)
+        return first, len(violations) >= SPAM_BAN_THRESHOLD
+
+    def ban_duration(self, user_id: str) -> timedelta:
+        """Регистрирует автоматический бан и возвращает его длительность."""
+        strikes = self._strikes.get(user_id, 0)
+        self._strikes[user_id] = strikes + 1
+        self._violations.pop(user_id, None)
+        return timedelta(seconds=min(SPAM_BAN_DURATION * SPAM_BAN_ESCALATION ** strikes, SPAM_BAN_MAX_DURATION))
+
+    def _prune(self, now: float):
+        self._pruned_at = now
+        for user_id in [user_id for user_id, bucket in self._buckets.items() if bucket.is_idle(now)]:
+            del self._buckets[user_id]
+        for user_id in [user_id for user_id, violations in self._violations.items()
+                        if not violations or now - violations[-1] > SPAM_VIOLATION_WINDOW]:
+            del self._violations[user_id]
+
+
+spam_guard = SpamGuard()
+
+
+async def throttle_user_message(message: Message, bot: Bot) -> bool:
+    """
+    Проверяет лимит сообщений пользователя до любой работы с хранилищем и пересылки.
+    Возвращает True, если сообщение отброшено.
+    """
+    if not SPAM_RATE:
         return False
+    user_id = str(message.chat.id)
+    now = time.monotonic()
+    # Элементы уже начатого альбома считаются одним сообщением
+    if message.media_group_id and media_group_forwarder.has_group(user_id, message.media_group_id):
+        return False
+    if spam_guard.allow(user_id, now):
+        return False
+
+    metrics.inc('bot_spam_dropped_total')
+    first, ban = spam_guard.violation(user_id, now)
+    if ban:
+        await spam_ban(user_id, bot, message.from_user.username if message.from_user else None)
+    elif first and not is_user_banned(int(user_id))[0]:
+        log_admin_action(bot.id, "SPAM_THROTTLE", f"User {user_id} exceeded message rate limit", user_id)
+        try:
+            await send_scheduler.send(PRIORITY_NOTIFICATION, bot.send_message, user_id,
+                                      MESSAGES.render("spam_throttled_message", user_locale(message)))
+        except TelegramAPIError:
+            pass
+    return True
+
+
+async def spam_ban(user_id: str, bot: Bot, username: str | None = None):
+    """Автоматически банит пользователя за спам так же, как команда /ban."""
+    reason = MESSAGES.render("spam_ban_reason")
+    async with user_locks.lock(user_id):
+        if is_user_banned(int(user_id))[0]:
+            return
+        duration = spam_guard.ban_duration(user_id)
+        ban_end_time = int(time.time() + duration.total_seconds())
+        user_data = await rehydrate_user(user_id)
+        if user_data is None:
+            # Пользователь не запускал /start: запись нужна, чтобы бан сохранился
+            user_data = register_user(user_id, username)
+        user_data.banned_until = ban_end_time
+        user_data.ban_reason = reason
+        users_store.mark_dirty(user_id)
+        ban_index.add(user_id, ban_end_time, reason)
+
+    metrics.inc('bot_spam_bans_total')
+    log_admin_action(bot.id, "AUTO_BAN_USER", f"User {user_id} banned for spam. Duration: {duration}", user_id)
+    try:
+        await send_scheduler.send(
+            PRIORITY_NOTIFICATION, bot.send_message, user_id,
+            MESSAGES.render("user_ban_message_with_duration", duration=str(duration), reason=reason))
+    except TelegramAPIError:
+        pass  # Пользователь мог заблокировать бота
+    try:
+        await send_scheduler.send(
+            PRIORITY_NOTIFICATION, bot.send_message, ADMIN_CHAT_ID,
+            MESSAGES.render("admin_spam_ban_notice", user_id=user_id, duration=str(duration)))
+    except TelegramAPIError:
+        pass
+
+
+class AdminCache:
+    """
+    Кэш администраторов чата с ограниченным временем жизни.
+    Одновременные запросы ожидают один общий вызов get_chat_administrators,
+    устаревший список отдаётся сразу, пока в фоне идёт обновление,
+    а при ошибке API используется последний известный список.
+    """
+
+    def __init__(self, ttl: float = ADMINS_CACHE_TTL):
+        self.ttl = ttl
+        self._admins: dict[str, frozenset] = {}
+        self._expires_at: dict[str, float] = {}
+        self._inflight: dict[str, asyncio.Task] = {}
+        # Чаты, в которых изменились права: следующий запрос ждёт свежий список
+        self._invalidated: set[str] = set()
+
+    def invalidate(self, chat_id):
+        """
+        Помечает кэш чата устаревшим: следующий запрос обратится к API,
+        а прежний список остаётся на случай ошибки API.
+        """
+        key = str(chat_id)
+        if key in self._expires_at:
+            self._expires_at[key] = 0.0
+            self._invalidated.add(key)
+
+    async def _fetch(self, key: str, chat_id, bot: Bot) -> frozenset:
+        admins = await bot.get_chat_administrators(chat_id)
+        admin_ids = frozenset(admin.user.id for admin in admins)
+        self._admins[key] = admin_ids
+        self._expires_at[key] = time.monotonic() + self.ttl
+        self._invalidated.discard(key)
+        return admin_ids
+
+    def _refresh(self, key: str, chat_id, bot: Bot) -> asyncio.Task:
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._fetch(key, chat_id, bot))
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._on_refresh_done(key, t))
+        return task
+
+    def _on_refresh_done(self, key: str, task: asyncio.Task):
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Ошибка при обновлении списка администраторов: {task.exception()}")
+
+    async def get_admins(self, chat_id, bot: Bot) -> frozenset | None:
+        """Возвращает множество ID администраторов чата или None, если список недоступен."""
+        key = str(chat_id)
+        cached = self._admins.get(key)
+        if cached is not None and key not in self._invalidated:
+            if self._expires_at[key] <= time.monotonic():
+                # Отдаём устаревший список, обновление идёт в фоне
+                self._refresh(key, chat_id, bot)
+            return cached
+
+        try:
+            return await asyncio.shield(self._refresh(key, chat_id, bot))
+        except TelegramAPIError:
+            return self._admins.get(key)
+
+
+admin_cache = AdminCache()
+
+
+async def is_admin(user_id: int, chat_id: int, bot: Bot) -> bool:
+    """Проверяет, является ли пользователь администратором чата."""
+    admins = await admin_cache.get_admins(chat_id, bot)
+    return admins is not None and user_id in admins
+
+
+async def admin_member_updated(event: types.ChatMemberUpdated):
+    """Сбрасывает кэш администраторов при изменении прав участника группы."""
+    admin_statuses = ("creator", "administrator")
+    if event.old_chat_member.status in admin_statuses or event.new_chat_member.status in admin_statuses:
+        admin_cache.invalidate(event.chat.id)
 
 
 # --- Обработчики команд ---
@@ -151,34 +2849,29 @@ async def is_admin(user_id: int, chat_id: int, bot: Bot) -> bool:
 async def start_command(message: Message):
     """Обрабатывает команду /start."""
     user_id = str(message.chat.id)
-    if is_user_banned(int(user_id))[0]:
-        return
+    async with user_locks.lock(user_id):
+        if is_user_banned(int(user_id))[0]:
+            return
 
-    users_data = load_data(USERS_DATA_FILE)
-    now = datetime.datetime.now()
-
-    if user_id not in users_data:
-        users_data[user_id] = {
-            'first_launch': now.isoformat(),
-            'total_messages': 0,
-            'monthly_messages': 0,
-            'weekly_messages': 0,
-            'last_message_date': now.isoformat(),
-            'username': message.from_user.username if message.from_user else "unknown"
-        }
-        save_data(USERS_DATA_FILE, users_data)
-        await message.reply(MESSAGES.get("welcome_user", "Привет!"))
-    else:
-        first_launch_dt = datetime.datetime.fromisoformat(users_data[user_id]['first_launch'])
-        formatted_date = format_datetime_for_message(first_launch_dt)
-        await message.reply(
-            MESSAGES.get("already_started", "С возвращением! Вы с нами с {formatted_date}.").format(
-                formatted_date=formatted_date))
+        user_data = await rehydrate_user(user_id)
+
+        if user_data is None:
+            register_user(user_id, message.from_user.username if message.from_user else "unknown")
+            await message.reply(MESSAGES.render("welcome_user", user_locale(message)))
+        else:
+            # Пользователь снова пишет боту, значит, разблокировал его
+            if user_data.blocked_at is not None:
+                user_data.blocked_at = None
+                users_store.mark_dirty(user_id)
+            if message.from_user:
+                update_username(user_id, user_data, message.from_user.username)
+            formatted_date = format_datetime_for_message(user_data.first_launch)
+            await message.reply(MESSAGES.render("already_started", user_locale(message), formatted_date=formatted_date))
 
 
 async def help_command(message: Message):
     """Обрабатывает команду /help."""
-    await message.reply(MESSAGES.get("help_message", "Это бот для связи с администратором."))
+    await message.reply(MESSAGES.render("help_message", user_locale(message)))
 
 
 async def msg_admin_command(message: Message, bot: Bot):
@@ -186,96 +2879,313 @@ async def msg_admin_command(message: Message, bot: Bot):
     if not await is_admin(message.from_user.id, ADMIN_CHAT_ID, bot):
         return
 
-    args = message.text.split(maxsplit=2)
-    if len(args) < 3:
-        await message.reply(MESSAGES.get("msg_usage", "Использование: /msg <user_id> <текст>"))
-        return
+    args = message.text.split(maxsplit=2)
+    if len(args) < 3:
+        await message.reply(MESSAGES.render("msg_usage"))
+        return
+
+    _, user_id_to_send, text_to_send = args
+
+    if not user_id_to_send.isdigit():
+        await message.reply(MESSAGES.render("id_not_numeric"))
+        return
+
+    try:
+        sent_message = await send_scheduler.send(PRIORITY_ADMIN_REPLY, bot.send_message, user_id_to_send,
+                                                 text_to_send)
+        # Ответ пользователя на это сообщение попадёт в ветку команды
+        reply_mapping.add(message.message_id, user_id_to_send, sent_message.message_id, time.time())
+        await message.reply(MESSAGES.render("msg_sent_success", user_id_to_send=user_id_to_send))
+        log_admin_action(message.from_user.id, "SEND_MSG",
+                         f"To user {user_id_to_send}: '{text_to_send[:50]}...'", user_id_to_send)
+    except TelegramAPIError as e:
+        await message.reply(MESSAGES.render("msg_send_error", error=e))
+
+
+async def who_admin_command(message: Message, bot: Bot):
+    """Обрабатывает команду /who для получения информации о пользователе."""
+    if not await is_admin(message.from_user.id, ADMIN_CHAT_ID, bot):
+        return
+
+    target_user_id = None
+    reply_id = replied_message_id(message)
+    if reply_id:
+        target_user_id = find_mapped_user(reply_id)
+    elif len(message.text.split()) > 1:
+        target_user_id = message.text.split()[1]
+    else:
+        target_user_id = topic_registry.user_for_thread(message.message_thread_id)
+
+    if not target_user_id:
+        await message.reply(MESSAGES.render("who_usage"))
+        return
+
+    async with user_locks.lock(target_user_id):
+        user_info = await rehydrate_user(target_user_id)
+
+    if user_info:
+        formatted_date = format_datetime_for_message(user_info.first_launch)
+        username_info = f"@{user_info.username}" if user_info.username else "не указан"
+
+        text = MESSAGES.render("user_info_template", user_id=target_user_id, username_info=username_info,
+                               formatted_date=formatted_date)
+        await message.reply(text, parse_mode='HTML')
+        log_admin_action(message.from_user.id, "GET_USER_INFO", f"For user {target_user_id}", target_user_id)
+    else:
+        await message.reply(MESSAGES.render("user_not_found"))
+
+
+async def stats_admin_command(message: Message, bot: Bot):
+    """Обрабатывает команду /stats для получения статистики."""
+    if not await is_admin(message.from_user.id, ADMIN_CHAT_ID, bot):
+        return
+
+    totals, histogram = await collect_stats(24)
+    text = MESSAGES.render("stats_template", **totals)
+
+    args = message.text.split()[1:]
+    if args and args[0] in ('hours', 'часы'):
+        # Почасовая гистограмма за последние сутки (по МСК)
+        moscow_tz = timezone(timedelta(hours=3))
+        peak = max((count for _, count in histogram), default=0) or 1
+        lines = [
+            f"{datetime.datetime.fromtimestamp(hour_start, moscow_tz).hour:02}:00 {'▇' * round(10 * count / peak)} {count}"
+            for hour_start, count in histogram
+        ]
+        text += "\n\n" + MESSAGES.render("stats_hourly_title") + "\n" + "\n".join(lines)
+
+    await message.reply(text)
+
+
+def broadcast_file() -> str:
+    """Путь к файлу прогресса рассылки (при шардировании — отдельный файл для каждого шарда)."""
+    if SHARD_COUNT == 1:
+        return BROADCAST_FILE
+    return os.path.join(META_DIR, f'broadcast.{SHARD_ID}.json')
+
+
+class Broadcaster:
+    """
+    Рассылка сообщения из чата администраторов пользователям.
+    Получатели обходятся по возрастанию ID пачками по BROADCAST_CONCURRENCY,
+    сообщения копируются через планировщик отправки с низшим приоритетом.
+    Прогресс (последний обработанный ID) сохраняется в файл, поэтому после
+    перезапуска рассылка продолжается с места остановки.
+    """
+
+    def __init__(self):
+        self.state: dict | None = None
+        self._task: asyncio.Task | None = None
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    @staticmethod
+    def _recipients(state: dict) -> list[int]:
+        """Возвращает ID оставшихся получателей по возрастанию."""
+        last_user_id = state['last_user_id']
+        active_since = state['active_since']
+        recipients = []
+        for user_id, data in users_store.items():
+            if data.blocked_at is not None or ban_index.get(user_id) is not None:
+                continue
+            if active_since and max(data.last_message_date, data.first_launch) < active_since:
+                continue
+            if last_user_id is None or int(user_id) > last_user_id:
+                recipients.append(int(user_id))
+        for user_id, active_at, blocked in user_archive.entries():
+            if blocked or (active_since and active_at < active_since) or user_id in users_store:
+                continue
+            if last_user_id is None or user_id > last_user_id:
+                recipients.append(user_id)
+        recipients.sort()
+        return recipients
+
+    def start(self, bot: Bot, from_chat_id: int, message_id: int, admin_id: int, days: int | None) -> int:
+        """Начинает рассылку. Возвращает число получателей."""
+        self.state = {
+            'from_chat_id': from_chat_id, 'message_id': message_id, 'admin_id': admin_id,
+            'active_since': time.time() - days * 86400 if days else None, 'last_user_id': None,
+            'sent': 0, 'blocked': 0, 'failed': 0, 'elapsed': 0.0,
+        }
+        recipients = self._recipients(self.state)
+        self._task = asyncio.create_task(self._run(bot, recipients))
+        return len(recipients)
+
+    def resume(self, bot: Bot):
+        """Продолжает рассылку, прерванную остановкой бота."""
+        if not os.path.exists(broadcast_file()):
+            return
+        self.state = load_data(broadcast_file())
+        if not self.state:
+            return
+        recipients = self._recipients(self.state)
+        logger.info(f"Продолжение рассылки, осталось получателей: {len(recipients)}")
+        self._task = asyncio.create_task(self._run(bot, recipients))
+
+    async def _save(self):
+        await user_archive.save_index()
+        try:
+            await disk_writer.run(save_data, broadcast_file(), dict(self.state))
+        except OSError as e:
+            logger.error(f"Не удалось сохранить прогресс рассылки: {e}")
+
+    async def _send(self, bot: Bot, user_id: int):
+        state = self.state
+        try:
+            await send_scheduler.send(PRIORITY_BROADCAST, bot.copy_message, user_id,
+                                      state['from_chat_id'], state['message_id'])
+            state['sent'] += 1
+        except TelegramForbiddenError:
+            # Пользователь заблокировал бота: следующие рассылки его пропустят
+            state['blocked'] += 1
+            user_data = users_store.get(user_id)
+            if user_data is not None:
+                user_data.blocked_at = int(time.time())
+                users_store.mark_dirty(user_id)
+            else:
+                user_archive.mark_blocked(user_id)
+        except TelegramAPIError as e:
+            state['failed'] += 1
+            logger.warning(f"Рассылка: не удалось отправить сообщение {user_id}: {e}")
+
+    async def _run(self, bot: Bot, recipients: list[int]):
+        state = self.state
+        started = time.monotonic() - state['elapsed']
+        saved_at = time.monotonic()
+        await self._save()
+        try:
+            for start in range(0, len(recipients), BROADCAST_CONCURRENCY):
+                batch = recipients[start:start + BROADCAST_CONCURRENCY]
+                await asyncio.gather(*(self._send(bot, user_id) for user_id in batch))
+                state['last_user_id'] = batch[-1]
+                state['elapsed'] = time.monotonic() - started
+                if time.monotonic() - saved_at >= BROADCAST_SAVE_INTERVAL:
+                    saved_at = time.monotonic()
+                    await self._save()
+        except asyncio.CancelledError:
+            # Остановка бота: прогресс сохраняется, рассылка продолжится при запуске
+            state['elapsed'] = time.monotonic() - started
+            await self._save()
+            raise
+
+        state['elapsed'] = time.monotonic() - started
+        await user_archive.save_index()
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(broadcast_file())
+        self.state = None
+        log_admin_action(state['admin_id'], "BROADCAST",
+                         f"Sent: {state['sent']}, blocked: {state['blocked']}, failed: {state['failed']}")
+        await self._report(bot, state)
+
+    @staticmethod
+    async def _report(bot: Bot, state: dict):
+        elapsed = state['elapsed']
+        handled = state['sent'] + state['blocked'] + state['failed']
+        text = MESSAGES.render("broadcast_finished", elapsed=elapsed, rate=handled / elapsed if elapsed else 0.0,
+                               sent=state['sent'], blocked=state['blocked'], failed=state['failed'])
+        try:
+            await send_scheduler.send(PRIORITY_NOTIFICATION, bot.send_message, ADMIN_CHAT_ID, text)
+        except TelegramAPIError as e:
+            logger.error(f"Не удалось отправить отчёт о рассылке: {e}")
+
+    async def cancel(self) -> bool:
+        """Отменяет рассылку без возможности продолжения. Возвращает False, если рассылки нет."""
+        if not self.running:
+            return False
+        await self.stop()
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(broadcast_file())
+        self.state = None
+        return True
 
-    _, user_id_to_send, text_to_send = args
+    async def stop(self):
+        """Приостанавливает рассылку (при остановке бота), сохраняя прогресс."""
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
 
-    if not user_id_to_send.isdigit():
-        await message.reply(MESSAGES.get("id_not_numeric", "ID пользователя должен быть числом."))
-        return
 
-    try:
-        await bot.send_message(user_id_to_send, text_to_send)
-        await message.reply(
-            MESSAGES.get("msg_sent_success", "Сообщение отправлено пользователю {user_id_to_send}.").format(
-                user_id_to_send=user_id_to_send))
-        log_admin_action(message.from_user.id, "SEND_MSG",
-                         f"To user {user_id_to_send}: '{text_to_send[:50]}...'")
-    except TelegramAPIError as e:
-        await message.reply(MESSAGES.get("msg_send_error", "Ошибка при отправке: {error}").format(error=e))
+broadcaster = Broadcaster()
 
 
-async def who_admin_command(message: Message, bot: Bot):
-    """Обрабатывает команду /who для получения информации о пользователе."""
+async def broadcast_admin_command(message: Message, bot: Bot):
+    """Обрабатывает команду /broadcast: рассылает пользователям сообщение, на которое ответили."""
     if not await is_admin(message.from_user.id, ADMIN_CHAT_ID, bot):
         return
 
-    target_user_id = None
-    if message.reply_to_message:
-        messages_mapping = load_data(MESSAGES_MAPPING_FILE)
-        target_user_id = messages_mapping.get(str(message.reply_to_message.message_id), {}).get('user_id')
-    elif len(message.text.split()) > 1:
-        target_user_id = message.text.split()[1]
+    args = message.text.split()[1:]
+    if args and args[0] == 'stop':
+        if await broadcaster.cancel():
+            log_admin_action(message.from_user.id, "BROADCAST_STOP", "Broadcast cancelled")
+            await _reply_broadcast(message, "broadcast_cancelled")
+        else:
+            await _reply_broadcast(message, "broadcast_not_running")
+        return
 
-    if not target_user_id:
-        await message.reply(
-            MESSAGES.get("who_usage", "Использование: /who <user_id> или ответьте на сообщение пользователя."))
+    reply_id = replied_message_id(message)
+    if not reply_id or (args and not args[0].isdigit()):
+        # Ошибка одинакова во всех шардах, отвечает нулевой
+        if SHARD_ID == 0:
+            await message.reply(MESSAGES.render("broadcast_usage"))
+        return
+    if broadcaster.running:
+        await _reply_broadcast(message, "broadcast_already_running")
         return
 
-    users_data = load_data(USERS_DATA_FILE)
-    user_info = users_data.get(str(target_user_id))
+    days = int(args[0]) if args else None
+    total = broadcaster.start(bot, message.chat.id, reply_id, message.from_user.id, days)
+    log_admin_action(message.from_user.id, "BROADCAST_START",
+                     f"Message {reply_id}, recipients: {total}, active days: {days or 'all'}")
+    await _reply_broadcast(message, "broadcast_started", total)
 
-    if user_info:
-        first_launch_dt = datetime.datetime.fromisoformat(user_info['first_launch'])
-        formatted_date = format_datetime_for_message(first_launch_dt)
-        username_info = f"@{user_info['username']}" if 'username' in user_info else "не указан"
-
-        text = MESSAGES.get("user_info_template",
-                            "ID: {user_id}\nUsername: {username_info}\nПервый запуск: {formatted_date}").format(
-            user_id=target_user_id,
-            username_info=username_info,
-            formatted_date=formatted_date
-        )
-        await message.reply(text, parse_mode='HTML')
-        log_admin_action(message.from_user.id, "GET_USER_INFO", f"For user {target_user_id}")
-    else:
-        await message.reply(MESSAGES.get("user_not_found", "Пользователь не найден."))
 
+def broadcast_result_file(shard_id: int) -> str:
+    """Путь к файлу итога команды /broadcast шарда (через него шарды сообщают итог нулевому)."""
+    return os.path.join(META_DIR, f'broadcast_result.{shard_id}.json')
 
-async def stats_admin_command(message: Message, bot: Bot):
-    """Обрабатывает команду /stats для получения статистики."""
-    if not await is_admin(message.from_user.id, ADMIN_CHAT_ID, bot):
-        return
 
-    users_data = load_data(USERS_DATA_FILE)
-    total_messages = sum(user.get('total_messages', 0) for user in users_data.values())
-
-    now = datetime.datetime.now()
-    one_month_ago = now - timedelta(days=30)
-    one_week_ago = now - timedelta(days=7)
-
-    monthly_messages = 0
-    weekly_messages = 0
-
-    for user in users_data.values():
-        last_message_date_str = user.get('last_message_date')
-        if last_message_date_str:
-            last_message_date = datetime.datetime.fromisoformat(last_message_date_str)
-            if last_message_date > one_month_ago:
-                monthly_messages += user.get('monthly_messages', 0)
-            if last_message_date > one_week_ago:
-                weekly_messages += user.get('weekly_messages', 0)
-
-    text = MESSAGES.get("stats_template",
-                        "📊 <b>Статистика бота</b>\n\nВсего сообщений: {total_messages}\nСообщений за месяц: {monthly_messages}\nСообщений за неделю: {weekly_messages}").format(
-        total_messages=total_messages,
-        monthly_messages=monthly_messages,
-        weekly_messages=weekly_messages
-    )
-    await message.reply(text)
+async def _reply_broadcast(message: Message, status: str, total: int = 0):
+    """
+    Отвечает на команду /broadcast. При шардировании команду выполняет каждый шард для своих
+    пользователей: шарды записывают итог в файл, а нулевой собирает итоги и отвечает один раз.
+    """
+    if SHARD_COUNT > 1:
+        result = {'command': message.message_id, 'status': status, 'total': total}
+        if SHARD_ID != 0:
+            try:
+                await disk_writer.run(save_data, broadcast_result_file(SHARD_ID), result)
+            except OSError as e:
+                logger.error(f"Не удалось записать итог команды /broadcast: {e}")
+            return
+        results = [result] + await _collect_broadcast_results(message.message_id)
+        statuses = {shard_result['status'] for shard_result in results}
+        status = next(candidate for candidate in ("broadcast_started", "broadcast_cancelled",
+                                                  "broadcast_already_running", "broadcast_not_running")
+                      if candidate in statuses)
+        total = sum(shard_result['total'] for shard_result in results)
+    await message.reply(MESSAGES.render(status, total=total))
+
+
+async def _collect_broadcast_results(command_id: int) -> list[dict]:
+    """Ждёт итоги команды от остальных шардов (не дольше SHARD_MAPPING_WAIT)."""
+    deadline = time.monotonic() + SHARD_MAPPING_WAIT
+    results = {}
+    while True:
+        for shard_id in range(1, SHARD_COUNT):
+            if shard_id not in results:
+                result = await disk_writer.run(load_data, broadcast_result_file(shard_id))
+                if result.get('command') == command_id:
+                    results[shard_id] = result
+        if len(results) == SHARD_COUNT - 1:
+            return list(results.values())
+        if time.monotonic() >= deadline:
+            logger.warning(f"Итог команды /broadcast не получен от шардов: "
+                           f"{sorted(set(range(1, SHARD_COUNT)) - set(results))}")
+            return list(results.values())
+        await asyncio.sleep(0.1)
 
 
 def _parse_ban_args(args: list) -> (timedelta | None, str | None):
@@ -321,62 +3231,55 @@ async def ban_admin_command(message: Message, bot: Bot):
     args = message.text.split()[1:]
     target_user_id = None
 
-    if message.reply_to_message:
-        messages_mapping = load_data(MESSAGES_MAPPING_FILE)
-        target_user_id = messages_mapping.get(str(message.reply_to_message.message_id), {}).get('user_id')
+    reply_id = replied_message_id(message)
+    if reply_id:
+        target_user_id = find_mapped_user(reply_id)
     elif args and args[0].isdigit():
         target_user_id = args.pop(0)
+    else:
+        target_user_id = topic_registry.user_for_thread(message.message_thread_id)
 
     if not target_user_id:
-        await message.reply(
-            MESSAGES.get("ban_usage", "Использование: /ban <user_id> [срок] [причина] или ответом на сообщение."))
+        await message.reply(MESSAGES.render("ban_usage"))
         return
 
-    users_data = load_data(USERS_DATA_FILE)
-    user_id_str = str(target_user_id)
-    if user_id_str not in users_data:
-        await message.reply(MESSAGES.get("ban_user_not_found", "Пользователь не найден в базе данных."))
-        return
+    async with user_locks.lock(target_user_id):
+        user_data = await rehydrate_user(target_user_id)
+        if user_data is None:
+            await message.reply(MESSAGES.render("ban_user_not_found"))
+            return
 
-    is_banned, ban_until_text = is_user_banned(target_user_id)
-    if is_banned:
-        ban_reason = users_data.get(user_id_str, {}).get('ban_reason', 'не указана')
-        await message.reply(
-            MESSAGES.get("user_already_banned",
-                         "Пользователь уже заблокирован.\nПричина: {reason}\nЗаблокирован до: {until}").format(
-                reason=ban_reason, until=ban_until_text)
-        )
-        return
+        is_banned, ban_until_text = is_user_banned(target_user_id)
+        if is_banned:
+            ban_reason = user_data.ban_reason or 'не указана'
+            await message.reply(MESSAGES.render("user_already_banned", reason=ban_reason, until=ban_until_text))
+            return
 
-    ban_duration, reason_str = _parse_ban_args(args)
+        ban_duration, reason_str = _parse_ban_args(args)
 
-    ban_end_time = datetime.datetime.now() + ban_duration if ban_duration else datetime.datetime.max
-    users_data[user_id_str]['banned_until'] = ban_end_time.isoformat()
-    if reason_str:
-        users_data[user_id_str]['ban_reason'] = reason_str
-    save_data(USERS_DATA_FILE, users_data)
+        ban_end_time = int(time.time() + ban_duration.total_seconds()) if ban_duration else PERMANENT_BAN_UNTIL
+        user_data.banned_until = ban_end_time
+        if reason_str:
+            user_data.ban_reason = reason_str
+        users_store.mark_dirty(target_user_id)
+        ban_index.add(target_user_id, ban_end_time, reason_str)
 
     # Формирование сообщения пользователю
     if ban_duration:
-        user_ban_message = MESSAGES.get("user_ban_message_with_duration",
-                                        "Вы были заблокированы.\nДлительность: {duration}\nПричина: {reason}").format(
-            duration=str(ban_duration),
-            reason=reason_str or "не указана")
+        user_ban_message = MESSAGES.render("user_ban_message_with_duration", duration=str(ban_duration),
+                                           reason=reason_str or "не указана")
     else:
-        user_ban_message = MESSAGES.get("user_ban_message_permanent",
-                                        "Вы были заблокированы навсегда.\nПричина: {reason}").format(
-            reason=reason_str or "не указана")
+        user_ban_message = MESSAGES.render("user_ban_message_permanent", reason=reason_str or "не указана")
 
     try:
-        await bot.send_message(target_user_id, user_ban_message)
+        await send_scheduler.send(PRIORITY_NOTIFICATION, bot.send_message, target_user_id, user_ban_message)
     except TelegramAPIError:
         pass  # Пользователь мог заблокировать бота
 
-    await message.reply(
-        MESSAGES.get("admin_ban_success", "Пользователь с ID {user_id} успешно заблокирован.").format(
-            user_id=target_user_id))
+    await message.reply(MESSAGES.render("admin_ban_success", user_id=target_user_id))
     log_admin_action(message.from_user.id, "BAN_USER",
-                     f"User {target_user_id} banned. Duration: {str(ban_duration) or 'Permanent'}. Reason: {reason_str or 'Not specified'}")
+                     f"User {target_user_id} banned. Duration: {str(ban_duration) or 'Permanent'}. Reason: {reason_str or 'Not specified'}",
+                     target_user_id)
 
 
 async def unban_admin_command(message: Message, bot: Bot):
@@ -385,39 +3288,32 @@ async def unban_admin_command(message: Message, bot: Bot):
         return
 
     target_user_id = None
-    if message.reply_to_message:
-        messages_mapping = load_data(MESSAGES_MAPPING_FILE)
-        target_user_id = messages_mapping.get(str(message.reply_to_message.message_id), {}).get('user_id')
+    reply_id = replied_message_id(message)
+    if reply_id:
+        target_user_id = find_mapped_user(reply_id)
     elif len(message.text.split()) > 1:
         target_user_id = message.text.split()[1]
+    else:
+        target_user_id = topic_registry.user_for_thread(message.message_thread_id)
 
     if not target_user_id:
-        await message.reply(
-            MESSAGES.get("unban_usage",
-                         "Не могу определить ID пользователя. Используйте /unban <ID> или ответьте на сообщение."))
+        await message.reply(MESSAGES.render("unban_usage"))
         return
 
-    users_data = load_data(USERS_DATA_FILE)
-    user_id_str = str(target_user_id)
-
-    if user_id_str in users_data and 'banned_until' in users_data[user_id_str]:
-        del users_data[user_id_str]['banned_until']
-        if 'ban_reason' in users_data[user_id_str]:
-            del users_data[user_id_str]['ban_reason']
-        save_data(USERS_DATA_FILE, users_data)
+    async with user_locks.lock(target_user_id):
+        lifted = lift_ban(target_user_id)
 
+    if lifted:
         try:
-            await bot.send_message(target_user_id,
-                                   MESSAGES.get("user_unbanned_message", "Вы были разблокированы."))
+            await send_scheduler.send(PRIORITY_NOTIFICATION, bot.send_message, target_user_id,
+                                      MESSAGES.render("user_unbanned_message"))
         except TelegramAPIError:
             pass
 
-        await message.reply(
-            MESSAGES.get("admin_unban_success", "Пользователь с ID {user_id} разблокирован.").format(
-                user_id=target_user_id))
-        log_admin_action(message.from_user.id, "UNBAN_USER", f"User {target_user_id} unbanned.")
+        await message.reply(MESSAGES.render("admin_unban_success", user_id=target_user_id))
+        log_admin_action(message.from_user.id, "UNBAN_USER", f"User {target_user_id} unbanned.", target_user_id)
     else:
-        await message.reply(MESSAGES.get("user_not_banned", "Пользователь не был заблокирован."))
+        await message.reply(MESSAGES.render("user_not_banned"))
 
 
 async def banlist_admin_command(message: Message, bot: Bot):
@@ -429,40 +3325,39 @@ async def banlist_admin_command(message: Message, bot: Bot):
 
 async def _send_banlist_page(message: Message, bot: Bot, page: int):
     """Отправляет страницу со списком заблокированных пользователей."""
-    users_data = load_data(USERS_DATA_FILE)
-    banned_users_list = []
+    bans, users = ban_index, users_store
+    if SHARD_COUNT > 1:
+        # Каждый шард знает только свои баны, поэтому общий список берём из хранилища
+        users = await disk_writer.run(storage.load_bans)
+        bans = BanIndex()
+        bans.rebuild(users.items())
 
-    for user_id, user_info in users_data.items():
-        is_banned, ban_until_text = is_user_banned(user_id)
-        if is_banned:
-            banned_users_list.append({
-                'user_id': user_id,
-                'username': user_info.get('username', 'неизвестный'),
-                'reason': user_info.get('ban_reason', 'не указана'),
-                'until': ban_until_text
-            })
-
-    if not banned_users_list:
-        await message.reply(MESSAGES.get("no_banned_users", "Заблокированных пользователей нет."))
+    total_users = len(bans)
+    if not total_users:
+        await message.reply(MESSAGES.render("no_banned_users"))
         return
 
-    total_users = len(banned_users_list)
     total_pages = (total_users + PAGE_SIZE - 1) // PAGE_SIZE
     page = max(1, min(page, total_pages))
 
     start_index = (page - 1) * PAGE_SIZE
-    paginated_users = banned_users_list[start_index:start_index + PAGE_SIZE]
+    paginated_users = [
+        {
+            'user_id': user_id,
+            'username': getattr(users.get(user_id), 'username', None) or 'неизвестный',
+            'reason': reason or 'не указана',
+            'until': format_ban_until(until)
+        }
+        for user_id, until, reason in bans.page(start_index, PAGE_SIZE)
+    ]
 
     user_lines = [
-        MESSAGES.get("banned_user_template",
-                     "<b>ID:</b> <code>{user_id}</code>\n<b>Username:</b> @{username}\n<b>Причина:</b> {reason}\n<b>До:</b> {until}\n").format(
-            **user)
+        MESSAGES.render("banned_user_template", **user)
         for user in paginated_users
     ]
 
-    message_text = MESSAGES.get("banned_list_title",
-                                "<b>Список заблокированных (страница {current_page}/{total_pages}):</b>\n").format(
-        current_page=page, total_pages=total_pages) + "\n---\n".join(user_lines)
+    message_text = (MESSAGES.render("banned_list_title", current_page=page, total_pages=total_pages)
+                    + "\n---\n".join(user_lines))
 
     # Кнопки пагинации
     keyboard = []
@@ -485,6 +3380,170 @@ async def _send_banlist_page(message: Message, bot: Bot, page: int):
     log_admin_action(message.from_user.id, "GET_BANLIST", f"Page {page}")
 
 
+async def audit_admin_command(message: Message, bot: Bot):
+    """Обрабатывает команду /audit: последние действия по пользователю, администратору или типу действия."""
+    if not await is_admin(message.from_user.id, ADMIN_CHAT_ID, bot):
+        return
+
+    args = message.text.split()[1:]
+    kind, value = 'user', None
+    if len(args) == 2 and args[0] in ('admin', 'action'):
+        kind, value = args[0], args[1].upper() if args[0] == 'action' else args[1]
+        # Ключ передаётся в кнопках пагинации, а callback_data ограничена 64 байтами
+        if len(_audit_callback_data(kind, value, AUDIT_INDEX_PER_KEY).encode()) > 64:
+            value = None
+    elif args and args[0].isdigit():
+        value = args[0]
+    elif not args:
+        reply_id = replied_message_id(message)
+        value = find_mapped_user(reply_id) if reply_id else topic_registry.user_for_thread(message.message_thread_id)
+
+    if value is None:
+        await message.reply(MESSAGES.render("audit_usage"))
+        return
+    await _send_audit_page(message, kind, value, 1)
+
+
+def _audit_callback_data(kind: str, value: str, page: int) -> str:
+    return f"audit:{kind}:{value}:{page}"
+
+
+async def _send_audit_page(message: Message, kind: str, value: str, page: int):
+    """Отправляет страницу журнала аудита по ключу индекса."""
+    records = admin_log.recent(kind, value)
+    if SHARD_COUNT > 1 and kind != 'user':
+        # Действия администратора пишут все шарды, а в памяти есть индекс только своего журнала
+        for shard_id in range(SHARD_COUNT):
+            if shard_id != SHARD_ID:
+                try:
+                    records += await disk_writer.run(AdminLog(audit_log_file(shard_id)).search, kind, value)
+                except OSError as e:
+                    logger.error(f"Не удалось прочитать журнал аудита шарда {shard_id}: {e}")
+        records.sort(key=lambda record: record[0], reverse=True)
+        del records[AUDIT_INDEX_PER_KEY:]
+    if not records:
+        await message.reply(MESSAGES.render("audit_empty"))
+        return
+
+    total_pages = (len(records) + PAGE_SIZE - 1) // PAGE_SIZE
+    page = max(1, min(page, total_pages))
+    start_index = (page - 1) * PAGE_SIZE
+
+    entry_lines = [
+        MESSAGES.render("audit_entry_template", date=format_datetime_for_message(timestamp), action=action,
+                        admin_id=admin_id, details=html.escape(details))
+        for timestamp, admin_id, action, _, details in records[start_index:start_index + PAGE_SIZE]
+    ]
+    message_text = MESSAGES.render("audit_title", key=html.escape(f"{kind} {value}"), current_page=page,
+                                   total_pages=total_pages) + "\n---\n".join(entry_lines)
+
+    # Кнопки пагинации
+    keyboard = []
+    row = []
+    if page > 1:
+        row.append(InlineKeyboardButton(text="<< Назад", callback_data=_audit_callback_data(kind, value, page - 1)))
+    if page < total_pages:
+        row.append(InlineKeyboardButton(text="Вперед >>", callback_data=_audit_callback_data(kind, value, page + 1)))
+    if row:
+        keyboard.append(row)
+
+    reply_markup = InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+    if isinstance(message, types.CallbackQuery):
+        await message.message.edit_text(message_text, reply_markup=reply_markup)
+    else:
+        await message.reply(message_text, reply_markup=reply_markup)
+
+
+async def audit_button_handler(callback_query: types.CallbackQuery, bot: Bot):
+    """Обрабатывает нажатия кнопок пагинации журнала аудита."""
+    await callback_query.answer()
+    if not await is_admin(callback_query.from_user.id, ADMIN_CHAT_ID, bot):
+        return
+    # Значение ключа может содержать двоеточие, поэтому номер страницы отделяется справа
+    prefix, page = callback_query.data.rsplit(':', 1)
+    _, kind, value = prefix.split(':', 2)
+    await _send_audit_page(callback_query, kind, value, int(page))
+
+
+def _is_username_prefix(text: str) -> bool:
+    return 0 < len(text) <= 32 and all(char.isascii() and (char.isalnum() or char == '_') for char in text)
+
+
+async def find_admin_command(message: Message, bot: Bot):
+    """Обрабатывает команду /find: поиск пользователей по началу username или список недавно писавших."""
+    if not await is_admin(message.from_user.id, ADMIN_CHAT_ID, bot):
+        return
+
+    args = message.text.split()[1:]
+    prefix = args[0].lstrip('@').lower() if args else ''
+    if args and not _is_username_prefix(prefix):
+        await message.reply(MESSAGES.render("find_usage"))
+        return
+    await _send_find_page(message, prefix, 1)
+
+
+async def _send_find_page(message: Message, prefix: str, page: int):
+    """Отправляет страницу результатов поиска пользователей."""
+    start_index = (page - 1) * PAGE_SIZE
+    if SHARD_COUNT > 1:
+        # Каждый шард знает только своих пользователей, поэтому ищем в общем хранилище
+        total, users = await disk_writer.run(storage.search_users, prefix, start_index, PAGE_SIZE)
+        user_ids = list(users)
+    elif prefix:
+        users = users_store
+        total, user_ids = user_search.search(prefix, start_index, PAGE_SIZE)
+    else:
+        users = users_store
+        total, user_ids = user_search.recent(start_index, PAGE_SIZE)
+
+    if not total:
+        await message.reply(MESSAGES.render("find_nothing"))
+        return
+
+    total_pages = (total + PAGE_SIZE - 1) // PAGE_SIZE
+    if page > total_pages:
+        return await _send_find_page(message, prefix, total_pages)
+
+    user_lines = []
+    for user_id in user_ids:
+        user_data = users.get(user_id)
+        user_lines.append(MESSAGES.render(
+            "find_user_template", user_id=user_id,
+            username=getattr(user_data, 'username', None) or 'неизвестный',
+            last_active=format_datetime_for_message(user_data.last_message_date) if user_data else 'неизвестно'))
+
+    title = MESSAGES.render("find_title" if prefix else "find_recent_title", prefix=prefix, current_page=page,
+                            total_pages=total_pages, total=total)
+    message_text = title + "\n".join(user_lines)
+
+    # Кнопки пагинации
+    keyboard = []
+    row = []
+    if page > 1:
+        row.append(InlineKeyboardButton(text="<< Назад", callback_data=f"find:{prefix}:{page - 1}"))
+    if page < total_pages:
+        row.append(InlineKeyboardButton(text="Вперед >>", callback_data=f"find:{prefix}:{page + 1}"))
+    if row:
+        keyboard.append(row)
+
+    reply_markup = InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+    if isinstance(message, types.CallbackQuery):
+        await message.message.edit_text(message_text, reply_markup=reply_markup)
+    else:
+        await message.reply(message_text, reply_markup=reply_markup)
+
+
+async def find_button_handler(callback_query: types.CallbackQuery, bot: Bot):
+    """Обрабатывает нажатия кнопок пагинации результатов поиска."""
+    await callback_query.answer()
+    if not await is_admin(callback_query.from_user.id, ADMIN_CHAT_ID, bot):
+        return
+    _, prefix, page = callback_query.data.split(':')
+    await _send_find_page(callback_query, prefix, int(page))
+
+
 async def button_handler(callback_query: types.CallbackQuery, bot: Bot):
     """Обрабатывает нажатия кнопок пагинации."""
     await callback_query.answer()
@@ -494,89 +3553,584 @@ async def button_handler(callback_query: types.CallbackQuery, bot: Bot):
 
 # --- Обработчики сообщений ---
 
+class TopicRegistry:
+    """
+    Темы форума в чате администраторов (FORUM_TOPICS): у каждого пользователя своя тема.
+    Тема создаётся при первом сообщении, её ID сохраняется в записи пользователя (topic_id),
+    а обратный индекс по ID темы позволяет отвечать пользователю без поиска по сообщениям.
+    """
+
+    def __init__(self):
+        self._by_user: dict[str, int] = {}
+        self._by_thread: dict[int, str] = {}
+        # Пересылки в очереди отправки и повторные пересылки в заново созданные темы
+        self._pending: set = set()
+
+    def rebuild(self, users_items):
+        """Перестраивает индекс по данным пользователей."""
+        self._by_user = {user_id: data.topic_id for user_id, data in users_items if data.topic_id}
+        self._by_thread = {thread_id: user_id for user_id, thread_id in self._by_user.items()}
+
+    def user_for_thread(self, thread_id) -> str | None:
+        return self._by_thread.get(thread_id) if thread_id else None
+
+    async def thread_for(self, user_id: str, bot: Bot) -> int | None:
+        """Возвращает тему пользователя, создавая её при необходимости. Вызывается под блокировкой пользователя."""
+        if not FORUM_TOPICS:
+            return None
+        thread_id = self._by_user.get(user_id)
+        if thread_id is not None:
+            return thread_id
+
+        user_data = users_store.get(user_id)
+        name = f"@{user_data.username}" if user_data and user_data.username else "Пользователь"
+        title = MESSAGES.render("topic_title", name=name, user_id=user_id)
+        topic = await send_scheduler.send(PRIORITY_FORWARD, bot.create_forum_topic, ADMIN_CHAT_ID, title[:128])
+        thread_id = topic.message_thread_id
+        self._by_user[user_id] = thread_id
+        self._by_thread[thread_id] = user_id
+        if user_data is not None:
+            user_data.topic_id = thread_id
+            users_store.mark_dirty(user_id)
+            if SHARD_COUNT > 1:
+                # Главный процесс ищет владельца темы в общей базе
+                await users_store.flush()
+        return thread_id
+
+    def forget(self, user_id: str):
+        """Забывает тему пользователя (например, удалённую администраторами)."""
+        thread_id = self._by_user.pop(user_id, None)
+        self._by_thread.pop(thread_id, None)
+        user_data = users_store.get(user_id)
+        if user_data is not None and user_data.topic_id is not None:
+            user_data.topic_id = None
+            users_store.mark_dirty(user_id)
+
+    async def submit(self, user_id: str, bot: Bot, send, on_sent, what: str):
+        """
+        Пересылает в тему пользователя, не дожидаясь отправки: send(message_thread_id) ставит запрос
+        в очередь отправки и возвращает future, а on_sent(результат) вызывается после отправки.
+        Обработчик не занимает блокировку пользователя, пока исчерпан лимит чата администраторов;
+        порядок сохраняется, потому что запросы в один чат отправляются по очереди.
+        Вызывается под блокировкой пользователя.
+        """
+        try:
+            thread_id = await self.thread_for(user_id, bot)
+        except TelegramAPIError as e:
+            logger.error(f"Не удалось переслать {what} от {user_id}: {e}")
+            return
+        self._track(send(thread_id)).add_done_callback(
+            lambda future: self._on_sent(future, user_id, bot, send, on_sent, what, thread_id))
+
+    def _track(self, future):
+        self._pending.add(future)
+        future.add_done_callback(self._pending.discard)
+        return future
+
+    def _on_sent(self, future, user_id: str, bot: Bot, send, on_sent, what: str, thread_id: int | None):
+        if future.cancelled():
+            return
+        error = future.exception()
+        if error is None:
+            on_sent(future.result())
+        elif (isinstance(error, TelegramBadRequest) and thread_id is not None
+              and 'thread not found' in str(error).lower()):
+            self._track(asyncio.create_task(self._resend(user_id, bot, send, on_sent, what, thread_id)))
+        else:
+            logger.error(f"Не удалось переслать {what} от {user_id}: {error}")
+
+    async def _resend(self, user_id: str, bot: Bot, send, on_sent, what: str, thread_id: int):
+        """Пересылает заново в новую тему вместо удалённой."""
+        try:
+            async with user_locks.lock(user_id):
+                # Тему могла уже пересоздать пересылка другого сообщения
+                if self._by_user.get(user_id) == thread_id:
+                    logger.warning(f"Тема пользователя {user_id} не найдена, создаётся новая")
+                    self.forget(user_id)
+                new_thread_id = await self.thread_for(user_id, bot)
+            on_sent(await send(new_thread_id))
+        except (TelegramAPIError, SendQueueFull) as e:
+            logger.error(f"Не удалось переслать {what} от {user_id}: {e}")
+
+    async def drain(self, timeout: float = SEND_DRAIN_TIMEOUT):
+        """Ждёт отправки пересылок из очереди (при остановке бота), не дольше timeout секунд."""
+        deadline = time.monotonic() + timeout
+        # Повторные пересылки добавляются, пока идёт ожидание, поэтому множество проверяется заново
+        while self._pending:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                logger.warning(f"Не отправлено пересылок при остановке: {len(self._pending)}")
+                return
+            await asyncio.wait(set(self._pending), timeout=remaining)
+
+
+topic_registry = TopicRegistry()
+
+
+class MediaGroupForwarder:
+    """
+    Собирает элементы альбома (сообщения с одинаковым media_group_id)
+    и пересылает их администраторам одним вызовом forward_messages.
+    """
+
+    def __init__(self, window: float = MEDIA_GROUP_WINDOW):
+        self.window = window
+        # user_id -> media_group_id -> (bot, список message_id)
+        self._pending: dict[str, dict[str, tuple[Bot, list[int]]]] = {}
+        self._timers: dict[tuple[str, str], asyncio.Task] = {}
+
+    def has_pending(self, user_id) -> bool:
+        return str(user_id) in self._pending
+
+    def has_group(self, user_id, group_id) -> bool:
+        return str(group_id) in self._pending.get(str(user_id), ())
+
+    async def add(self, message: Message, bot: Bot):
+        """Добавляет элемент альбома. Вызывается под блокировкой пользователя."""
+        user_id = str(message.chat.id)
+        group_id = str(message.media_group_id)
+        groups = self._pending.setdefault(user_id, {})
+        message_ids = groups.setdefault(group_id, (bot, []))[1]
+        message_ids.append(message.message_id)
+
+        timer = self._timers.pop((user_id, group_id), None)
+        if timer is not None:
+            timer.cancel()
+        if len(message_ids) >= MEDIA_GROUP_MAX_SIZE:
+            await self._forward(user_id, group_id)
+        else:
+            self._timers[(user_id, group_id)] = asyncio.create_task(self._flush_later(user_id, group_id))
+
+    async def _flush_later(self, user_id: str, group_id: str):
+        await asyncio.sleep(self.window)
+        self._timers.pop((user_id, group_id), None)
+        async with user_locks.lock(user_id):
+            await self._forward(user_id, group_id)
+
+    async def flush_user(self, user_id):
+        """Пересылает все ожидающие альбомы пользователя. Вызывается под блокировкой пользователя."""
+        user_id = str(user_id)
+        for group_id in list(self._pending.get(user_id, {})):
+            timer = self._timers.pop((user_id, group_id), None)
+            if timer is not None:
+                timer.cancel()
+            await self._forward(user_id, group_id)
+
+    async def _forward(self, user_id: str, group_id: str):
+        groups = self._pending.get(user_id)
+        if not groups or group_id not in groups:
+            return
+        bot, message_ids = groups.pop(group_id)
+        if not groups:
+            del self._pending[user_id]
+
+        message_ids.sort()
+        await topic_registry.submit(
+            user_id, bot,
+            lambda thread_id: send_scheduler.submit(PRIORITY_FORWARD, bot.forward_messages, ADMIN_CHAT_ID,
+                                                    user_id, message_ids, message_thread_id=thread_id),
+            lambda forwarded: message_mapping.add_many(zip((item.message_id for item in forwarded), message_ids),
+                                                       user_id, time.time()),
+            "альбом")
+
+    async def stop(self):
+        """Пересылает все ожидающие альбомы (при остановке бота)."""
+        for timer in self._timers.values():
+            timer.cancel()
+        self._timers.clear()
+        for user_id in list(self._pending):
+            async with user_locks.lock(user_id):
+                await self.flush_user(user_id)
+
+
+media_group_forwarder = MediaGroupForwarder()
+
+
 async def handle_user_message(message: Message, bot: Bot):
     """Обрабатывает сообщения от обычных пользователей."""
-    user_id = str(message.chat.id)
-    is_banned, ban_until_text = is_user_banned(int(user_id))
-
-    if is_banned:
-        users_data = load_data(USERS_DATA_FILE)
-        ban_reason = users_data.get(user_id, {}).get('ban_reason', 'не указана')
-        await message.reply(
-            MESSAGES.get("user_is_banned_message_with_reason",
-                         "Вы заблокированы.\nПричина: {reason}\nДо: {until}").format(
-                reason=ban_reason, until=ban_until_text)
-        )
+    if await throttle_user_message(message, bot):
         return
 
-    # Обновление статистики пользователя
-    users_data = load_data(USERS_DATA_FILE)
-    now = datetime.datetime.now()
-    if user_id in users_data:
-        user_data = users_data[user_id]
-        user_data['total_messages'] = user_data.get('total_messages', 0) + 1
+    user_id = str(message.chat.id)
+    # Блокировка сохраняет порядок пересылки сообщений одного пользователя
+    async with user_locks.lock(user_id):
+        is_banned, ban_until_text = is_user_banned(int(user_id))
 
-        last_message_date = datetime.datetime.fromisoformat(user_data['last_message_date'])
-        if now - last_message_date > timedelta(days=30):
-            user_data['monthly_messages'] = 1
-        else:
-            user_data['monthly_messages'] = user_data.get('monthly_messages', 0) + 1
+        if is_banned:
+            user_data = users_store.get(user_id)
+            ban_reason = (user_data.ban_reason if user_data is not None else None) or 'не указана'
+            await message.reply(MESSAGES.render("user_is_banned_message_with_reason", user_locale(message),
+                                                reason=ban_reason, until=ban_until_text))
+            return
 
-        if now - last_message_date > timedelta(days=7):
-            user_data['weekly_messages'] = 1
-        else:
-            user_data['weekly_messages'] = user_data.get('weekly_messages', 0) + 1
+        # Обновление статистики пользователя
+        now = time.time()
+        user_data = await rehydrate_user(user_id)
+        if user_data is not None:
+            user_data.total_messages += 1
+            user_data.weekly_messages, user_data.monthly_messages = stats_engine.record(user_id, now)
+            user_data.last_message_date = int(now)
+            user_data.blocked_at = None
+            users_store.mark_dirty(user_id)
+            user_search.touch(user_id)
+            if message.from_user:
+                update_username(user_id, user_data, message.from_user.username)
 
-        user_data['last_message_date'] = now.isoformat()
-        save_data(USERS_DATA_FILE, users_data)
+        # Элементы альбома пересылаются одним запросом после небольшой задержки
+        if message.media_group_id:
+            await media_group_forwarder.add(message, bot)
+            return
 
-    # Пересылка сообщения администратору
+        # Сначала пересылаем ожидающие альбомы, чтобы сохранить порядок сообщений
+        if media_group_forwarder.has_pending(user_id):
+            await media_group_forwarder.flush_user(user_id)
+
+        # Ответ на сообщение из переписки копируется в ту же ветку чата администраторов,
+        # остальные сообщения пересылаются
+        thread_message_id = None
+        if message.reply_to_message:
+            thread_message_id = find_thread_message(user_id, message.reply_to_message.message_id)
+
+        def forward(topic_thread_id: int | None) -> asyncio.Future:
+            if thread_message_id:
+                return send_scheduler.submit(
+                    PRIORITY_FORWARD, bot.copy_message, ADMIN_CHAT_ID, user_id, message.message_id,
+                    message_thread_id=topic_thread_id,
+                    reply_parameters=ReplyParameters(message_id=int(thread_message_id),
+                                                     allow_sending_without_reply=True))
+            return send_scheduler.submit(PRIORITY_FORWARD, bot.forward_message, ADMIN_CHAT_ID, user_id,
+                                         message.message_id, message_thread_id=topic_thread_id)
+
+        # Пересылка ставится в очередь: обработчик не ждёт, пока освободится лимит чата администраторов
+        await topic_registry.submit(
+            user_id, bot, forward,
+            lambda forwarded_message: message_mapping.add(forwarded_message.message_id, user_id,
+                                                          message.message_id, now),
+            "сообщение")
+
+
+async def send_admin_reply(message: Message, bot: Bot, user_id: str):
+    """Копирует сообщение администратора пользователю и запоминает копию для ответов."""
     try:
-        forwarded_message = await bot.forward_message(ADMIN_CHAT_ID, user_id, message.message_id)
-        messages_mapping = load_data(MESSAGES_MAPPING_FILE)
-        messages_mapping[str(forwarded_message.message_id)] = {
-            'user_id': user_id,
-            'user_message_id': message.message_id,
-            'timestamp': now.timestamp()
-        }
-        save_data(MESSAGES_MAPPING_FILE, messages_mapping)
-        cleanup_old_messages()
+        copied_message = await send_scheduler.send(PRIORITY_ADMIN_REPLY, bot.copy_message, user_id,
+                                                   message.chat.id, message.message_id)
+        reply_mapping.add(message.message_id, user_id, copied_message.message_id, time.time())
+        log_admin_action(message.from_user.id, "REPLY_TO_USER", f"To user {user_id}", user_id)
     except TelegramAPIError as e:
-        logger.error(f"Не удалось переслать сообщение от {user_id}: {e}")
+        await send_scheduler.send(PRIORITY_NOTIFICATION, bot.send_message, ADMIN_CHAT_ID,
+                                  MESSAGES.render("error_sending_reply", user_id=user_id, error=e),
+                                  message_thread_id=message.message_thread_id)
 
 
 async def handle_admin_reply(message: Message, bot: Bot):
     """Обрабатывает ответы администраторов на сообщения пользователей."""
-    if not message.reply_to_message or not await is_admin(message.from_user.id, ADMIN_CHAT_ID, bot):
+    reply_id = replied_message_id(message)
+    if not reply_id or not await is_admin(message.from_user.id, ADMIN_CHAT_ID, bot):
+        return
+
+    # Ответить можно на пересланное сообщение пользователя или на любой ответ в его ветке
+    user_id = find_mapped_user(reply_id)
+
+    if user_id:
+        await send_admin_reply(message, bot, user_id)
+
+
+# Служебные сообщения тем форума, которые не пересылаются пользователю
+TOPIC_SERVICE_CONTENT_TYPES = frozenset({
+    ContentType.FORUM_TOPIC_CREATED, ContentType.FORUM_TOPIC_EDITED, ContentType.FORUM_TOPIC_CLOSED,
+    ContentType.FORUM_TOPIC_REOPENED, ContentType.PINNED_MESSAGE,
+})
+
+
+def in_user_topic(message: Message) -> bool:
+    """Фильтр: сообщение в теме форума, принадлежащей пользователю."""
+    return (bool(message.is_topic_message) and message.content_type not in TOPIC_SERVICE_CONTENT_TYPES
+            and topic_registry.user_for_thread(message.message_thread_id) is not None)
+
+
+async def handle_topic_message(message: Message, bot: Bot):
+    """Отправляет пользователю сообщения администраторов из его темы (ответ не требуется)."""
+    if not await is_admin(message.from_user.id, ADMIN_CHAT_ID, bot):
         return
+    # Явный ответ на сообщение другого пользователя имеет приоритет над темой
+    reply_id = replied_message_id(message)
+    user_id = (find_mapped_user(reply_id) if reply_id else None) or topic_registry.user_for_thread(
+        message.message_thread_id)
+    await send_admin_reply(message, bot, user_id)
+
+
+# --- Режим webhook ---
+
+class WebhookServer:
+    """
+    HTTP-сервер для приёма обновлений от Telegram (режим webhook).
+    Обновления складываются в ограниченную очередь и обрабатываются
+    фиксированным числом обработчиков; при переполнении очереди сервер
+    отвечает 503, и Telegram повторяет доставку позже.
+    """
 
-    messages_mapping = load_data(MESSAGES_MAPPING_FILE)
-    reply_to_message_id = str(message.reply_to_message.message_id)
+    def __init__(self, dp: Dispatcher, bot: Bot, queue_size: int = WEBHOOK_QUEUE_SIZE,
+                 workers: int = WEBHOOK_WORKERS):
+        self.dp = dp
+        self.bot = bot
+        self.workers = workers
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=queue_size)
+        self._worker_tasks: list[asyncio.Task] = []
+        metrics.describe('bot_webhook_queue_depth', 'gauge', 'Обновления в очереди webhook-сервера')
+        metrics.gauge('bot_webhook_queue_depth', lambda: self.queue_depth)
 
-    if reply_to_message_id in messages_mapping:
-        user_id = messages_mapping[reply_to_message_id]['user_id']
+    @property
+    def queue_depth(self) -> int:
+        return self._queue.qsize()
+
+    async def handle(self, request: web.Request) -> web.Response:
+        """Принимает обновление от Telegram."""
+        if WEBHOOK_SECRET and not hmac.compare_digest(
+                request.headers.get("X-Telegram-Bot-Api-Secret-Token", "").encode(), WEBHOOK_SECRET.encode()):
+            return web.Response(status=401)
         try:
-            await bot.copy_message(user_id, message.chat.id, message.message_id)
-            log_admin_action(message.from_user.id, "REPLY_TO_USER", f"To user {user_id}")
-        except TelegramAPIError as e:
-            await bot.send_message(ADMIN_CHAT_ID, MESSAGES.get("error_sending_reply",
-                                                               "Не удалось отправить ответ пользователю {user_id}. Ошибка: {error}").format(
-                user_id=user_id, error=e))
+            update = types.Update.model_validate(await request.json(), context={"bot": self.bot})
+        except ValueError:
+            return web.Response(status=400)
 
+        try:
+            await asyncio.wait_for(self._queue.put(update), timeout=WEBHOOK_ENQUEUE_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning("Очередь обновлений переполнена, обновление отклонено")
+            return web.Response(status=503)
+        return web.Response()
 
-# --- Запуск бота ---
+    async def _worker(self):
+        while True:
+            update = await self._queue.get()
+            try:
+                await self.dp.feed_update(self.bot, update)
+            except Exception as e:
+                logger.error(f"Ошибка при обработке обновления {update.update_id}: {e}")
+            finally:
+                self._queue.task_done()
 
-async def main() -> None:
-    """Главная функция для запуска бота."""
-    # Упрощенное создание файлов
-    for file_path in [USERS_DATA_FILE, MESSAGES_MAPPING_FILE, REPLY_MAPPING_FILE, MESSAGES_FILE]:
-        if not os.path.exists(file_path):
-            save_data(file_path, {})
-    if not os.path.exists(LOG_FILE_NAME):
-        open(LOG_FILE_NAME, 'a').close()
+    async def run(self):
+        """Запускает сервер и работает до отмены задачи."""
+        app = web.Application()
+        app.router.add_post(WEBHOOK_PATH, self.handle)
+        runner = web.AppRunner(app)
+        await runner.setup()
+        self._worker_tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        try:
+            await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+            if WEBHOOK_URL:
+                await self.bot.set_webhook(WEBHOOK_URL, secret_token=WEBHOOK_SECRET or None,
+                                           allowed_updates=self.dp.resolve_used_update_types())
+            logger.info(f"Webhook-сервер слушает {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+            await asyncio.Event().wait()
+        finally:
+            await runner.cleanup()
+            # Дообрабатываем уже принятые обновления
+            try:
+                await asyncio.wait_for(self._queue.join(), timeout=WEBHOOK_DRAIN_TIMEOUT)
+            except asyncio.TimeoutError:
+                logger.warning(f"Не обработано обновлений при остановке: {self._queue.qsize()}")
+            for task in self._worker_tasks:
+                task.cancel()
+            await asyncio.gather(*self._worker_tasks, return_exceptions=True)
 
-    bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+
+# --- Шардирование ---
+
+# Команды администраторов, которые выполняет шард-владелец пользователя
+SHARDED_ADMIN_COMMANDS = ('/msg', '/who', '/ban', '/unban', '/audit')
+
+
+def shard_for_user(user_id) -> int:
+    """Возвращает номер шарда, которому принадлежат данные пользователя."""
+    return abs(int(user_id)) % SHARD_COUNT
+
+
+def configure_shard(shard_id: int, shard_count: int):
+    """Настраивает процесс как шард: пересоздаёт объекты, которые зависят от номера шарда."""
+    global SHARD_ID, SHARD_COUNT, storage, users_store, message_mapping, reply_mapping, stats_engine, send_scheduler
+    global admin_log, user_archive
+    SHARD_ID, SHARD_COUNT = shard_id, shard_count
+    storage.close()
+    storage = create_storage()
+    users_store = UserStore(storage)
+    user_archive = UserArchive(archive_dir(shard_id))
+    message_mapping = MessageMapping(storage, flush_interval=SHARD_MAPPING_FLUSH_INTERVAL)
+    reply_mapping = MessageMapping(storage, table='replies', flush_interval=SHARD_MAPPING_FLUSH_INTERVAL)
+    stats_engine = StatsEngine(shard_stats_file(shard_id))
+    admin_log = AdminLog(audit_log_file(shard_id))
+    # Лимиты Telegram общие для бота, поэтому делятся между шардами
+    send_scheduler = SendScheduler(rate_share=1 / shard_count)
+
+
+async def _lookup_storage(lookup, key, wait: bool = False):
+    """
+    Ищет в общем хранилище (в потоке записи, не блокируя цикл событий). С wait поиск повторяется,
+    пока шард не запишет данные, но не дольше SHARD_MAPPING_WAIT.
+    """
+    deadline = time.monotonic() + SHARD_MAPPING_WAIT
+    while True:
+        result = await disk_writer.run(lookup, key)
+        if result is not None or not wait or time.monotonic() >= deadline:
+            return result
+        await asyncio.sleep(0.1)
+
+
+async def _find_mapping_user(admin_message_id, wait: bool) -> str | None:
+    """Ищет пользователя по сообщению в чате администраторов."""
+    entry = await _lookup_storage(storage.get_mapping, admin_message_id, wait)
+    return entry['user_id'] if entry else None
+
+
+async def route_update(update: types.Update, bot_id: int) -> list[int]:
+    """Определяет шарды, которым нужно передать обновление."""
+    if update.chat_member is not None:
+        # Кэш администраторов есть в каждом шарде
+        return list(range(SHARD_COUNT))
+    message = update.message
+    if message is None:
+        callback_data = update.callback_query.data if update.callback_query is not None else None
+        if callback_data and callback_data.startswith('audit:user:'):
+            # Журнал аудита пользователя ведёт шард пользователя
+            return [shard_for_user(callback_data.split(':')[2])]
+        # Остальные колбэки (пагинация /banlist) обрабатывает нулевой шард
+        return [0]
+    if str(message.chat.id) != str(ADMIN_CHAT_ID):
+        return [shard_for_user(message.chat.id)]
+
+    parts = (message.text or '').split()
+    command = parts[0].split('@')[0] if parts and parts[0].startswith('/') else None
+    if command == '/broadcast':
+        # Каждый шард рассылает сообщение своим пользователям
+        return list(range(SHARD_COUNT))
+    target_user_id = None
+    reply_id = replied_message_id(message)
+    if command == '/msg' or (command in SHARDED_ADMIN_COMMANDS and not reply_id):
+        if len(parts) > 1 and parts[1].isdigit():
+            target_user_id = parts[1]
+    elif reply_id and (command is None or command in SHARDED_ADMIN_COMMANDS):
+        # Ждать записи сопоставления от шарда имеет смысл только для сообщений бота (пересылок):
+        # ответы администраторов записаны заранее, а переписка администраторов не сопоставляется вовсе
+        replied_from = message.reply_to_message.from_user
+        target_user_id = await _find_mapping_user(reply_id, wait=replied_from is not None
+                                                  and replied_from.id == bot_id)
+    if (target_user_id is None and message.is_topic_message and command != '/msg'
+            and (command is None or command in SHARDED_ADMIN_COMMANDS)):
+        # Тема пользователя записывается в общую базу до первой пересылки в неё, поэтому ждать не нужно
+        target_user_id = await _lookup_storage(storage.find_topic_user, message.message_thread_id)
+    return [shard_for_user(target_user_id)] if target_user_id else [0]
+
+
+class ShardRouterMiddleware(BaseMiddleware):
+    """Middleware главного процесса: передаёт обновление шардам вместо локальной обработки."""
+
+    def __init__(self, queues: list):
+        self.queues = queues
+
+    async def __call__(self, handler, event: types.Update, data):
+        payload = event.model_dump(mode='json', exclude_none=True)
+        for shard_id in await route_update(event, data['bot'].id):
+            queue = self.queues[shard_id]
+            try:
+                queue.put_nowait(payload)
+            except QueueFull:
+                # Шард не успевает: ждём места в очереди, не блокируя цикл событий
+                await asyncio.get_running_loop().run_in_executor(None, queue.put, payload)
+
+
+def run_shard_worker(shard_id: int, shard_count: int, update_queue, result_queue=None,
+                     overrides: dict | None = None, session_factory=None):
+    """
+    Точка входа процесса-шарда.
+    overrides позволяет переопределить константы конфигурации, а session_factory —
+    подставить свою сессию Bot API (используется тестовым стендом).
+    """
+    if overrides:
+        globals().update(overrides)
+    configure_shard(shard_id, shard_count)
+    asyncio.run(_shard_worker_main(update_queue, result_queue, session_factory))
+
+
+async def _shard_worker_main(update_queue, result_queue, session_factory):
+    load_state()
+    session = session_factory() if session_factory is not None else None
+    bot = Bot(token=BOT_TOKEN, session=session, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+    bot.session.middleware(RequestMetricsMiddleware())
+    dp = build_dispatcher()
+    background_tasks = start_services()
+    broadcaster.resume(bot)
+    loop = asyncio.get_running_loop()
+    # Ограничивает только число принятых обновлений; одновременную обработку ограничивает ConcurrencyLimitMiddleware
+    slots = asyncio.Semaphore(MAX_PENDING_UPDATES)
+    in_flight: set[asyncio.Task] = set()
+    processed = 0
+
+    def on_update_done(task: asyncio.Task):
+        in_flight.discard(task)
+        slots.release()
+        if not task.cancelled() and task.exception() is not None:
+            logger.error(f"Шард {SHARD_ID}: ошибка при обработке обновления: {task.exception()}")
+
+    if result_queue is not None:
+        result_queue.put(('ready', SHARD_ID))
+    logger.info(f"Шард {SHARD_ID}/{SHARD_COUNT} запущен, пользователей: {len(users_store)}")
+    try:
+        stopping = False
+        while not stopping:
+            batch = [await loop.run_in_executor(None, update_queue.get)]
+            # Забираем всё, что уже накопилось в очереди, без лишних переключений потоков
+            while len(batch) < 100 and not update_queue.empty():
+                batch.append(update_queue.get_nowait())
+            for payload in batch:
+                if payload is None:
+                    stopping = True
+                    break
+                await slots.acquire()
+                update = types.Update.model_validate(payload, context={"bot": bot})
+                task = asyncio.create_task(dp.feed_update(bot, update))
+                in_flight.add(task)
+                task.add_done_callback(on_update_done)
+                processed += 1
+        await asyncio.gather(*in_flight, return_exceptions=True)
+        if result_queue is not None:
+            result_queue.put(('done', SHARD_ID, processed))
+    finally:
+        await stop_services(background_tasks)
+        await bot.session.close()
+
+
+def start_shard_processes(shard_count: int, result_queue=None, overrides: dict | None = None,
+                          session_factory=None) -> tuple[list, list]:
+    """Запускает процессы-шарды. Возвращает их очереди обновлений и процессы."""
+    context = multiprocessing.get_context('spawn')
+    queues = [context.Queue(SHARD_QUEUE_SIZE) for _ in range(shard_count)]
+    processes = [
+        context.Process(target=run_shard_worker, name=f'shard-{shard_id}',
+                        args=(shard_id, shard_count, queues[shard_id], result_queue, overrides, session_factory))
+        for shard_id in range(shard_count)
+    ]
+    for process in processes:
+        process.start()
+    return queues, processes
+
+
+def stop_shard_processes(queues: list, processes: list):
+    """Просит шарды завершиться после обработки очереди и дожидается их."""
+    for queue in queues:
+        queue.put(None)
+    for process in processes:
+        process.join()
+
+
+# --- Запуск бота ---
+
+def build_dispatcher() -> Dispatcher:
+    """Создаёт диспетчер и регистрирует обработчики."""
     dp = Dispatcher()
+    dp.update.outer_middleware(ConcurrencyLimitMiddleware(MAX_CONCURRENT_UPDATES))
+    for observer in (dp.message, dp.callback_query, dp.chat_member):
+        observer.middleware(HandlerMetricsMiddleware())
 
     # Регистрация обработчиков
     dp.message.register(start_command, CommandStart())
@@ -587,22 +4141,142 @@ async def main() -> None:
     dp.message.register(msg_admin_command, Command("msg"), admin_filter)
     dp.message.register(who_admin_command, Command("who"), admin_filter)
     dp.message.register(stats_admin_command, Command("stats"), admin_filter)
+    dp.message.register(broadcast_admin_command, Command("broadcast"), admin_filter)
     dp.message.register(ban_admin_command, Command("ban"), admin_filter)
     dp.message.register(unban_admin_command, Command("unban"), admin_filter)
     dp.message.register(banlist_admin_command, Command("banlist"), admin_filter)
+    dp.message.register(audit_admin_command, Command("audit"), admin_filter)
+    dp.message.register(find_admin_command, Command("find"), admin_filter)
 
     # Обработка сообщений и колбэков
+    dp.message.register(handle_topic_message, admin_filter, in_user_topic)
     dp.message.register(handle_admin_reply, admin_filter, F.reply_to_message)
     dp.message.register(handle_user_message, F.chat.id != ADMIN_CHAT_ID)
     dp.callback_query.register(button_handler, F.data.startswith('banlist_'))
+    dp.callback_query.register(audit_button_handler, F.data.startswith('audit:'))
+    dp.callback_query.register(find_button_handler, F.data.startswith('find:'))
+    dp.chat_member.register(admin_member_updated, admin_filter)
+    return dp
+
+
+def load_state():
+    """Создаёт недостающие файлы и загружает данные в память."""
+    # Упрощенное создание файлов
+    data_files = [MESSAGES_FILE]
+    if STORAGE_BACKEND in ("json", "log"):
+        data_files += [USERS_DATA_FILE, MESSAGES_MAPPING_FILE, REPLY_MAPPING_FILE]
+    for file_path in data_files:
+        if not os.path.exists(file_path):
+            save_data(file_path, {})
+
+    users_store.load()
+    user_archive.load(users_store)
+    # Записи без пользователя достаются нулевому шарду
+    admin_log.import_legacy(LEGACY_ADMIN_LOG_FILE, lambda target: (
+        shard_for_user(target) == SHARD_ID if target is not None else SHARD_ID == 0))
+    admin_log.load()
+    ban_index.rebuild(users_store.items())
+    user_search.rebuild(users_store.items())
+    topic_registry.rebuild(users_store.items())
+    for mapping in (message_mapping, reply_mapping):
+        mapping.load()
+        mapping.evict_expired()
+    stats_engine.load(users_store.items())
+
+
+def start_services() -> list[asyncio.Task]:
+    """Запускает фоновые задачи. Возвращает задачи, которые нужно отменить при остановке."""
+    users_store.start()
+    message_mapping.start()
+    reply_mapping.start()
+    stats_engine.start()
+    admin_log.start()
+    send_scheduler.start()
+    tasks = [asyncio.create_task(ban_expiry_loop()), asyncio.create_task(mapping_cleanup_loop())]
+    if ARCHIVE_AFTER_DAYS:
+        tasks.append(asyncio.create_task(archive_loop()))
+    if MESSAGES_RELOAD_INTERVAL:
+        tasks.append(asyncio.create_task(messages_reload_loop()))
+    if METRICS_PORT:
+        tasks.append(asyncio.create_task(serve_metrics(METRICS_PORT + SHARD_ID)))
+    if METRICS_FILE:
+        tasks.append(asyncio.create_task(metrics_dump_loop()))
+    return tasks
+
 
+async def stop_services(background_tasks: list[asyncio.Task]):
+    """Останавливает фоновые задачи и сохраняет все данные."""
+    await media_group_forwarder.stop()
+    await topic_registry.drain()
+    await broadcaster.stop()
+    await send_scheduler.stop()
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    await user_archive.save_index()
+    await users_store.stop()
+    await message_mapping.stop()
+    await reply_mapping.stop()
+    await stats_engine.stop()
+    await admin_log.stop()
+    if METRICS_FILE:
+        await dump_metrics()
+    disk_writer.shutdown()
+    storage.close()
+
+
+async def receive_updates(dp: Dispatcher, bot: Bot):
+    """Получает обновления в выбранном режиме (long polling или webhook)."""
+    if RUN_MODE == "webhook":
+        await WebhookServer(dp, bot).run()
+    else:
+        await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types(),
+                               close_bot_session=False)
+
+
+async def run_shard_router(dp: Dispatcher, bot: Bot):
+    """Главный процесс шардированного режима: принимает обновления и раздаёт их шардам."""
+    if STORAGE_BACKEND != "sqlite":
+        raise RuntimeError('Для шардирования нужно общее хранилище: STORAGE_BACKEND = "sqlite"')
+    queues, processes = start_shard_processes(SHARD_COUNT)
+    dp.update.outer_middleware(ShardRouterMiddleware(queues))
+    try:
+        logger.info(f"Бот запущен в шардированном режиме, шардов: {SHARD_COUNT}.")
+        await receive_updates(dp, bot)
+    finally:
+        await asyncio.get_running_loop().run_in_executor(None, stop_shard_processes, queues, processes)
+
+
+async def main() -> None:
+    """Главная функция для запуска бота."""
+    bot = Bot(token=BOT_TOKEN, default=DefaultBotProperties(parse_mode=ParseMode.HTML))
+    bot.session.middleware(RequestMetricsMiddleware())
+    dp = build_dispatcher()
+
+    if SHARD_COUNT > 1:
+        try:
+            await run_shard_router(dp, bot)
+        except Exception as e:
+            logger.critical(f"Критическая ошибка при запуске бота: {e}")
+        finally:
+            await bot.session.close()
+        return
+
+    load_state()
+    background_tasks = start_services()
+    broadcaster.resume(bot)
     try:
         logger.info("Бот запущен.")
-        await dp.start_polling(bot)
+        await receive_updates(dp, bot)
     except Exception as e:
         logger.critical(f"Критическая ошибка при запуске бота: {e}")
+    finally:
+        await stop_services(background_tasks)
+        await bot.session.close()
 
 
 if __name__ == "__main__":
-    import asyncio
-    asyncio.run(main())
\ No newline at end of file
+    if sys.argv[1:] == ["migrate"]:
+        migrate_json_to_sqlite()
+    else:
+        asyncio.run(main())
\ No newline at end of file